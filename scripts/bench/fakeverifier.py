@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+"""
+Stand-in vLEI verifier for benchmarking the regulation portal service
+
+Serves the endpoints the service calls, with the verifier's polling behaviour: a presentation
+or report is answered 202 when submitted, then 404 while it is being verified and 200 once
+it is done. Also serves /keystate/{aid} for VERIFY_MODE=local, answering the key registered
+by the load generator.
+
+    python scripts/bench/fakeverifier.py --port 7676 --latency 0.005 --verify-time 0.2
+"""
+import argparse
+import falcon
+import json
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+class State(object):
+
+    def __init__(self, latency, verify_time):
+        self.latency = latency
+        self.verify_time = verify_time
+        self.lock = threading.Lock()
+        self.logins = {}
+        self.reports = {}
+        self.keys = {}
+
+    def wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+class Authorizations(object):
+
+    def __init__(self, state):
+        self.state = state
+
+    def on_get(self, req, resp, aid):
+        self.state.wait()
+        ready = self.state.logins.get(aid)
+        if ready is None or time.time() < ready[0]:
+            resp.status = falcon.HTTP_404
+            resp.media = {"title": falcon.HTTP_404, "description": f"{aid} is not authorized"}
+            return
+        resp.media = {"aid": aid, "said": ready[1]}
+
+class Presentations(object):
+
+    def __init__(self, state):
+        self.state = state
+
+    def on_put(self, req, resp, said):
+        self.state.wait()
+        body = req.bounded_stream.read()
+        # the load generator sends the AID it logs in with as the presentation
+        aid = body.decode("utf-8").strip() or said
+        with self.state.lock:
+            self.state.logins[aid] = (time.time() + self.state.verify_time, said)
+        resp.status = falcon.HTTP_202
+        resp.media = {"said": said}
+
+class Reports(object):
+
+    def __init__(self, state):
+        self.state = state
+
+    def on_get(self, req, resp, aid, dig):
+        self.state.wait()
+        report = self.state.reports.get((aid, dig))
+        if report is None or time.time() < report["ready"]:
+            resp.status = falcon.HTTP_404
+            resp.media = {"title": falcon.HTTP_404, "description": f"{dig} is not verified"}
+            return
+        resp.media = {"submitter": aid, "filename": "report.zip", "status": "verified",
+                      "contentType": report["contentType"], "size": report["size"],
+                      "message": f"Report {dig} has been verified"}
+
+    def on_post(self, req, resp, aid, dig):
+        self.state.wait()
+        size = 0
+        while chunk := req.bounded_stream.read(64 * 1024):
+            size += len(chunk)
+        with self.state.lock:
+            self.state.reports[(aid, dig)] = {"ready": time.time() + self.state.verify_time, "size": size,
+                                              "contentType": req.content_type}
+        resp.status = falcon.HTTP_202
+        resp.media = {"submitter": aid, "dig": dig}
+
+class Requests(object):
+
+    def __init__(self, state):
+        self.state = state
+
+    def on_post(self, req, resp, aid):
+        self.state.wait()
+        resp.status = falcon.HTTP_202
+        resp.media = {"aid": aid}
+
+class KeyStates(object):
+
+    def __init__(self, state):
+        self.state = state
+
+    def on_get(self, req, resp, aid):
+        self.state.wait()
+        keys = self.state.keys.get(aid)
+        if keys is None:
+            resp.status = falcon.HTTP_404
+            return
+        resp.media = {"i": aid, "s": "0", "k": keys}
+
+    def on_put(self, req, resp, aid):
+        self.state.keys[aid] = json.loads(req.bounded_stream.read())["k"]
+        resp.status = falcon.HTTP_204
+
+def create(latency=0.0, verify_time=0.2):
+    state = State(latency, verify_time)
+    app = falcon.App()
+    app.add_route("/authorizations/{aid}", Authorizations(state))
+    app.add_route("/presentations/{said}", Presentations(state))
+    app.add_route("/reports/{aid}/{dig}", Reports(state))
+    app.add_route("/request/verify/{aid}", Requests(state))
+    app.add_route("/keystate/{aid}", KeyStates(state))
+    return app
+
+class ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in vLEI verifier for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=7676)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds added to every call. Default is 0.")
+    parser.add_argument("--verify-time", type=float, default=0.2,
+                        help="Seconds a presentation or report stays 404 before it is verified. Default is 0.2.")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, create(args.latency, args.verify_time),
+                         server_class=ThreadingServer, handler_class=QuietHandler)
+    print(f"Fake verifier listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+"""
+Load generator for the regulation portal service
+
+Logs in a set of AIDs and then drives login, upload, status and header verification requests
+with signify signed headers, reporting throughput and latency percentiles per scenario.
+
+    python scripts/bench/loadgen.py --url http://127.0.0.1:8000 --requests 500 --concurrency 16
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import statistics
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from keri.core import coring
+
+Fields = ("@method", "@path", "signify-resource", "signify-timestamp")
+
+class Client(object):
+    """ An AID with a single ed25519 key, signing requests the way signify-ts does """
+
+    def __init__(self, url, index):
+        self.url = url
+        self.signer = coring.Signer(raw=index.to_bytes(32, "big"), transferable=False)
+        self.aid = self.signer.verfer.qb64
+        self.said = coring.Diger(ser=self.aid.encode("utf-8")).qb64
+        self.local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def headers(self, method, path) -> dict:
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        created = int(time.time())
+        params = (f"({' '.join(Fields)});created={created};keyid={self.signer.verfer.qb64};alg=ed25519")
+        base = "\n".join([f'"@method": {method}', f'"@path": {path}', f'"signify-resource": {self.aid}',
+                          f'"signify-timestamp": {timestamp}', f'"@signature-params: {params}"'])
+        cig = self.signer.sign(base.encode("utf-8"))
+        quoted = " ".join(f'"{field}"' for field in Fields)
+        return {"Signify-Resource": self.aid, "Signify-Timestamp": timestamp,
+                "Signature-Input": f'signify=({quoted});created={created};keyid="{self.signer.verfer.qb64}";alg="ed25519"',
+                "Signature": f'indexed="?0";signify="{cig.qb64}"'}
+
+    def request(self, method, path, **kwargs) -> requests.Response:
+        headers = {**self.headers(method, path), **kwargs.pop("headers", {})}
+        return self.session.request(method, f"{self.url}{path}", headers=headers, **kwargs)
+
+    def login(self):
+        body = json.dumps({"aid": self.aid, "said": self.said, "vlei": self.aid})
+        return self.session.post(f"{self.url}/login", data=body, headers={"Content-Type": "application/json"})
+
+    def package(self, size) -> bytes:
+        """ A report package of about size bytes that passes the service's package check, with random content """
+        content = os.urandom(size)
+        cig = self.signer.sign(content)
+        manifest = {"documentInfo": {"signatures": [{"file": "../reports/report.bin", "aid": self.aid,
+                                                     "sigs": [cig.qb64]}]}}
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            archive.writestr("report/META-INF/reports.json", json.dumps(manifest))
+            archive.writestr("report/reports/report.bin", content)
+        return buffer.getvalue()
+
+    def upload(self, size):
+        report = self.package(size)
+        dig = coring.Diger(ser=report).qb64
+        return self.request("POST", f"/upload/{self.aid}/{dig}", headers={"Content-Type": "application/zip"},
+                            data=report)
+
+    def status(self):
+        return self.request("GET", f"/status/{self.aid}")
+
+    def header(self):
+        return self.request("GET", "/verify/header")
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def run(name, clients, call, count, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        client = clients[i % len(clients)]
+        started = time.perf_counter()
+        try:
+            ok = call(client).status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += 0 if ok else 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(count)))
+    wall = time.perf_counter() - started
+    print(f"{name:<8} {count:>8} {errors:>7} {count / wall:>10.1f} {percentile(latencies, 0.5) * 1000:>9.1f} "
+          f"{percentile(latencies, 0.99) * 1000:>9.1f} {statistics.fmean(latencies) * 1000:>9.1f}")
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the regulation portal service")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Service under test.")
+    parser.add_argument("--verifier", default="http://127.0.0.1:7676",
+                        help="Fake verifier, the AIDs' keys are registered there for VERIFY_MODE=local.")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Requests per scenario. Default is 200.")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Concurrent clients. Default is 8.")
+    parser.add_argument("--aids", type=int, default=8, help="Distinct AIDs sending requests. Default is 8.")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Bytes per uploaded report. Default is 64 KiB.")
+    parser.add_argument("--scenarios", default="login,header,status,upload",
+                        help="Comma separated scenarios to run, in order.")
+    args = parser.parse_args()
+
+    clients = [Client(args.url.rstrip("/"), i + 1) for i in range(args.aids)]
+    for client in clients:
+        try:
+            requests.put(f"{args.verifier}/keystate/{client.aid}", data=json.dumps({"k": [client.aid]}))
+        except requests.RequestException:
+            pass
+        response = client.login()
+        if response.status_code >= 400:
+            print(f"login of {client.aid} failed {response.status_code} {response.text[:200]}")
+
+    scenarios = {
+        "login": lambda client: client.login(),
+        "header": lambda client: client.header(),
+        "status": lambda client: client.status(),
+        "upload": lambda client: client.upload(args.size),
+    }
+    print(f"{'scenario':<8} {'requests':>8} {'errors':>7} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for name in args.scenarios.split(","):
+        run(name, clients, scenarios[name], args.requests, args.concurrency)
+
+if __name__ == "__main__":
+    main()
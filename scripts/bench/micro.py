@@ -0,0 +1,73 @@
+# -*- encoding: utf-8 -*-
+"""
+Micro-benchmarks of the regulation portal service hot path
+
+Times signature base construction in AuthSigs.signatures, a full AuthSigs.verify answered
+from the signature cache, and serialize() of a verifier response.
+
+    python scripts/bench/micro.py --number 20000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+bench = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench)
+# the app package reads its data files relative to src/regps, like the service does
+os.chdir(os.path.join(bench, "..", "..", "src", "regps"))
+sys.path.insert(0, os.getcwd())
+
+import requests
+
+from loadgen import Client
+
+class Request(object):
+    """ The parts of a falcon request AuthSigs reads """
+
+    def __init__(self, method, path, headers):
+        self.method = method
+        self.path = path
+        self.headers = headers
+
+def response(text: str) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = text.encode("utf-8")
+    resp.encoding = "utf-8"
+    resp.headers["Content-Type"] = "application/json"
+    return resp
+
+def report(name, number, seconds):
+    print(f"{name:<28} {number / seconds:>12.0f} ops/s {seconds / number * 1e6:>10.2f} us/op")
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the service hot path")
+    parser.add_argument("-n", "--number", type=int, default=10000, help="Calls per benchmark. Default is 10000.")
+    args = parser.parse_args()
+
+    from app.service import AuthSigs
+    from app.signatures import signature_cache
+    from app.tasks import serialize
+
+    client = Client("http://127.0.0.1:8000", 1)
+    path = f"/upload/{client.aid}/EC7b6S50sY26HTj6AtQiWMDMucsBxMvThkmrKUBXVMf0"
+    req = Request("POST", path, client.headers("POST", path))
+    auth = AuthSigs()
+
+    report("AuthSigs.signatures", args.number,
+           timeit.timeit(lambda: auth.signatures(req), number=args.number))
+
+    ok = {"status_code": 202, "text": "{}", "headers": {"Content-Type": "application/json"}}
+    for aid, cig, ser, inputage in auth.signatures(req):
+        signature_cache.remember(aid, inputage, cig, ser, ok)
+    report("AuthSigs.verify (cached)", args.number,
+           timeit.timeit(lambda: auth.verify(req), number=args.number))
+
+    body = response('{"submitter": "%s", "filename": "report.zip", "status": "verified", '
+                    '"contentType": "application/zip", "size": 4467, "message": "ok"}' % client.aid)
+    report("serialize", args.number, timeit.timeit(lambda: serialize(body), number=args.number))
+
+if __name__ == "__main__":
+    main()
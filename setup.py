@@ -73,18 +73,22 @@ setup(
         'asyncio>=3.4.3',
         'celery>=5.3.0',
         'dataclasses_json>=0.5.7',
-        'falcon>=3.1.0',
+        'falcon>=4.0.0',
         'gunicorn>=20.1.0',
         'http_sfv>=0.9.8',
+        'httpx>=0.24.1',
+        'prometheus_client>=0.17.0',
         'redis>=4.5.5',
         'requests>=2.31.0',
         'swagger-ui-py>=22.7.13',
+        'uvicorn>=0.22.0',
         'keri @ git+https://git@github.com/WebOfTrust/keripy.git'
     ],
     extras_require={
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        'fast': ['orjson>=3.8.0'],
     },
     tests_require=[
         'coverage>=5.5',
@@ -1,5 +1,15 @@
-from app.service import falcon_app, swagger_ui
+import logging
 
-print("Starting RegPS...")
-app = falcon_app()
-api_doc=swagger_ui(app)
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+def __getattr__(name):
+    # the WSGI app is built when gunicorn asks for app:app, so the cli and the celery workers
+    # can import app modules without building it
+    if name not in ("app", "api_doc"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from app.service import falcon_app, swagger_ui
+    global app, api_doc
+    logger.info("Starting RegPS...")
+    app = falcon_app()
+    api_doc = swagger_ui(app)
+    return globals()[name]
@@ -0,0 +1,395 @@
+from app.aiotasks import check_login, check_upload, upload, upload_batch, verify_vlei, verify_req
+from app import service
+from app.service import answer_page, not_modified, page_params, refresh_jobs, swagger_ui
+from app.events import AsyncSubscription, astream, hub, record, replay
+from app.keystate import keystates, local_verification
+from app.logs import begin, bind, payload
+from app.metrics import AsyncMetrics, AsyncMetricsResource, header_verification_seconds, header_verifications_total
+from app.quotas import quotas
+from app.results import dumps, loads, parsed, respond
+from app.signatures import signature_cache, unauthorized
+from app.spool import aspool, aspool_part, parts
+from app.store import status_pages, store
+from app.tracing import AsyncTracing, span
+from app.tasks import async_logins, async_uploads, enqueue_login, enqueue_upload, job_pending, job_progress
+from app.tasks import batch_id, batch_max_reports, batch_status, status_entry, upload_index
+from app.verifier import degraded
+import asyncio
+import contextlib
+import falcon
+import falcon.asgi
+from falcon import media
+from falcon.http_status import HTTPStatus
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# the status store, quotas and event hub may wait on redis or lmdb, their calls run in threads
+# to keep the event loop serving other requests
+
+class AuthSigs(service.AuthSigs):
+    """ ASGI header verification, the signature base is built by service.AuthSigs """
+
+    async def process_request(self, req, resp):
+        logger.debug("Processing header verification request %s", req)
+        with header_verification_seconds.time(), span("auth"):
+            result = await self.verify(req)
+        if result['status_code'] >= 400:
+            respond(resp, result)
+            logger.warning("Header verification failed request %s", resp)
+            return resp
+        else :
+            logger.debug("Header verification succeeded %s", resp)
+
+    async def on_get(self, req, resp):
+        return await self.process_request(req, resp)
+
+    async def verify(self, req):
+        logger.debug("verifying req %s", req)
+
+        signatures = self.signatures(req)
+        if not signatures:
+            return unauthorized("Request headers are not signed")
+
+        result="{'status_code': 404, 'text': '{\"title\": \"404 Not Found\", \"description\": \"No result\"}', 'headers': {'Content-Type': 'application/json'}}"
+        for aid, cig, ser, inputage in signatures:
+            rejected = signature_cache.screen(aid, inputage, cig)
+            if rejected:
+                logger.warning("AuthSigs.verify: rejected %s %s", aid, payload(rejected['text']))
+                header_verifications_total.labels("rejected").inc()
+                return rejected
+            result = signature_cache.lookup(aid, inputage, cig, ser)
+            if result is not None:
+                header_verifications_total.labels("cache").inc()
+            else:
+                logger.debug("verifying %s %s %s", aid, ser, cig)
+                source = "local"
+                if local_verification():
+                    if keystates.cached(aid, inputage.keyid):
+                        result = keystates.verify(aid, cig, ser, inputage.keyid)
+                    else:
+                        # resolving the key state blocks, keep it off the event loop
+                        result = await asyncio.to_thread(keystates.verify, aid, cig, ser, inputage.keyid)
+                if result is None:
+                    source = "remote"
+                    result = await verify_req(aid,cig,ser)
+                header_verifications_total.labels(source).inc()
+                logger.debug("AuthSigs.on_post: result %s", payload(result))
+                if result['status_code'] >= 400:
+                    return result
+                signature_cache.remember(aid, inputage, cig, ser, result)
+
+        return result
+
+verSig = AuthSigs()
+
+class LoginTask(object):
+
+    async def on_post(self, req, resp):
+        logger.debug("LoginTask.on_post")
+        try:
+            with span("body"):
+                raw_json = await req.stream.read()
+            data = loads(raw_json)
+            bind(aid=data.get('aid'))
+            await asyncio.to_thread(quotas.take_login, req.remote_addr)
+            logger.debug("LoginTask.on_post: sending data %s", payload(data))
+            if async_logins:
+                entry = await asyncio.to_thread(enqueue_login, data['aid'], data['said'], data['vlei'])
+                logger.info("LoginTask.on_post: queued login job %s", entry['job'])
+                resp.status = falcon.HTTP_202
+                resp.data = dumps(entry)
+                resp.content_type = falcon.MEDIA_JSON
+                return
+            result = await verify_vlei(data['aid'], data['said'], data['vlei'])
+
+            logger.debug("LoginTask.on_post: received data %s", result['status_code'])
+            # 202 means the verifier is still working on the presentation, the user is not logged in yet
+            if(result["status_code"] < 400 and result["status_code"] != falcon.http_status_to_code(falcon.HTTP_202)):
+                logger.debug("Logged in user, checking status...")
+                await asyncio.to_thread(store.login, data['aid'])
+            respond(resp, result)
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            logger.exception("LoginTask.on_post: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+    async def on_get(self, req, resp, aid):
+        logger.debug("LoginTask.on_get")
+        try:
+            logger.debug("LoginTask.on_get: sending aid %s", aid)
+            result = await check_login(aid)
+            logger.debug("LoginTask.on_get: received data %s", payload(result))
+            # logins finished by a celery worker are only seen here
+            if(result["status_code"] == falcon.http_status_to_code(falcon.HTTP_200)):
+                await asyncio.to_thread(store.login, aid)
+            respond(resp, result)
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            logger.exception("LoginTask.on_get: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+class UploadTask(object):
+
+    async def on_post(self, req, resp, aid, dig):
+        logger.debug("UploadTask.on_post %s", req)
+        sig_check = await verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("UploadTask.on_post: Invalid signature on headers")
+            return sig_check
+        try:
+            await asyncio.to_thread(quotas.take, aid)
+            # the body is spooled and its digest checked before anything is sent to the verifier
+            with span("body"):
+                report, rejected = await aspool(req.stream, dig, req.content_type, req.content_length)
+            with report:
+                logger.debug("UploadTask.on_post: request for %s %s %s bytes %s", aid, dig, report.size, req.content_type)
+                if rejected:
+                    logger.warning("UploadTask.on_post: rejected %s %s %s", aid, dig, payload(rejected['text']))
+                    respond(resp, rejected)
+                    return
+                # digests the verifier already decided are answered by upload() straight away
+                if async_uploads and upload_index.result(aid, dig) is None:
+                    if(not await asyncio.to_thread(store.logged_in, aid)):
+                        logger.warning("UploadTask.on_post: Error aid not logged in %s", aid)
+                        resp.text = f"AID not logged in: {aid}"
+                        resp.status = falcon.HTTP_401
+                        return
+                    entry = await asyncio.to_thread(lambda: enqueue_upload(aid, dig, req.content_type, report.read()))
+                    logger.info("UploadTask.on_post: queued upload job %s for %s: %s", entry['job'], aid, dig)
+                    await asyncio.to_thread(record, aid, dig, entry)
+                    resp.status = falcon.HTTP_202
+                    resp.data = dumps(entry)
+                    resp.content_type = falcon.MEDIA_JSON
+                    return
+                result = await upload(aid, dig, req.content_type, report)
+                logger.debug("UploadTask.on_post: received data %s", payload(result))
+
+                respond(resp, result)
+                # add to status dict
+                if(not await asyncio.to_thread(store.logged_in, aid)):
+                    logger.warning("UploadTask.on_post: Error aid not logged in %s", aid)
+                    resp.text = f"AID not logged in: {aid}"
+                    resp.status = falcon.HTTP_401
+                else:
+                    logger.debug("UploadTask.on_post added uploadStatus for %s: %s", aid, dig)
+                    # replaces the entry of an earlier upload of the digest
+                    await asyncio.to_thread(record, aid, dig, parsed(result))
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            logger.exception("UploadTask.on_post: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+    async def on_get(self, req, resp, aid, dig):
+        logger.debug("UploadTask.on_get")
+        sig_check = await verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("UploadTask.on_get: Invalid signature on headers")
+            return sig_check
+        try:
+            entry = await asyncio.to_thread(store.find, aid, dig)
+            if entry is not None and job_pending(entry):
+                entry = await asyncio.to_thread(job_progress, entry)
+                await asyncio.to_thread(record, aid, dig, entry)
+                if job_pending(entry):
+                    logger.debug("UploadTask.on_get: upload job %s is %s", entry['job'], entry['status'])
+                    resp.status = falcon.HTTP_202
+                    resp.data = dumps(entry)
+                    resp.content_type = falcon.MEDIA_JSON
+                    return
+            logger.debug("UploadTask.on_get: sending aid %s for dig %s", aid, dig)
+            result = await check_upload(aid, dig)
+            logger.debug("UploadTask.on_get: received data %s", payload(result))
+            respond(resp, result)
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            logger.exception("UploadTask.on_get: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+class StatusTask(object):
+
+    async def on_get(self, req, resp, aid):
+        logger.debug("StatusTask.on_get request %s", req)
+        sig_check = await verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("StatusTask.on_get: Invalid signature on headers")
+            return sig_check
+        cursor, limit, since = page_params(req)
+        try:
+            logger.debug("StatusTask.on_get: aid %s", aid)
+            if async_uploads:
+                await asyncio.to_thread(refresh_jobs, aid)
+            version = await asyncio.to_thread(store.version, aid)
+            if version is None:
+                logger.warning("StatusTask.on_get: Cannot find status for %s", aid)
+                resp.text = f"AID not logged in: {aid}"
+                resp.status = falcon.HTTP_401
+            elif not not_modified(req, resp, aid, version, cursor, limit, since):
+                # only the page is read in a thread, falcon's request and response stay on the event loop
+                answer_page(resp, await asyncio.to_thread(status_pages.page, aid, version, cursor, limit, since))
+        except Exception as e:
+            logger.exception("StatusTask.on_get: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+class BatchTask(object):
+
+    async def on_post(self, req, resp, aid):
+        logger.debug("BatchTask.on_post %s", req)
+        sig_check = await verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("BatchTask.on_post: Invalid signature on headers")
+            return sig_check
+        try:
+            if(not await asyncio.to_thread(store.logged_in, aid)):
+                logger.warning("BatchTask.on_post: Error aid not logged in %s", aid)
+                resp.text = f"AID not logged in: {aid}"
+                resp.status = falcon.HTTP_401
+                return
+            with contextlib.ExitStack() as spools:
+                digs, reports, rejected = [], [], []
+                async for part in parts(req.stream, req.content_type, req.content_length, asgi=True):
+                    if not part.name:
+                        raise falcon.HTTPBadRequest(description="Every report must be named by its digest")
+                    if len(digs) == batch_max_reports:
+                        raise falcon.HTTPPayloadTooLarge(description=f"More than {batch_max_reports} reports in a batch")
+                    report, rejection = await aspool_part(part)
+                    spools.enter_context(report)
+                    digs.append(part.name)
+                    if rejection:
+                        logger.warning("BatchTask.on_post: rejected %s %s %s", aid, part.name, payload(rejection['text']))
+                        rejected.append(status_entry(rejection, submitter=aid, dig=part.name))
+                    else:
+                        reports.append((part.name, report.form, report))
+                if not digs:
+                    raise falcon.HTTPBadRequest(description="No reports in the batch")
+                await asyncio.to_thread(quotas.take, aid, len(digs))
+                batch = batch_id(digs)
+                logger.info("BatchTask.on_post: batch %s of %s reports from %s", batch, len(digs), aid)
+                if async_uploads:
+                    for dig, contype, report in reports:
+                        entry = await asyncio.to_thread(lambda: enqueue_upload(aid, dig, contype, report.read(), batch))
+                        await asyncio.to_thread(record, aid, dig, entry)
+                    resp.status = falcon.HTTP_202
+                else:
+                    for (dig, _, _), result in zip(reports, await upload_batch(aid, reports)):
+                        await asyncio.to_thread(record, aid, dig, status_entry(result, submitter=aid, batch=batch))
+                    resp.status = falcon.HTTP_200
+            resp.data = dumps(await asyncio.to_thread(batch_status, aid, batch, [dict(entry, batch=batch) for entry in rejected]))
+            resp.content_type = falcon.MEDIA_JSON
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            logger.exception("BatchTask.on_post: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+    async def on_get(self, req, resp, aid, batch):
+        logger.debug("BatchTask.on_get")
+        sig_check = await verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("BatchTask.on_get: Invalid signature on headers")
+            return sig_check
+        try:
+            if async_uploads:
+                await asyncio.to_thread(refresh_jobs, aid)
+            result = await asyncio.to_thread(batch_status, aid, batch)
+            if result is None:
+                resp.status = falcon.HTTP_404
+                resp.text = f"Unknown batch {batch} of {aid}"
+                return
+            resp.status = falcon.HTTP_200
+            resp.data = dumps(result)
+            resp.content_type = falcon.MEDIA_JSON
+        except Exception as e:
+            logger.exception("BatchTask.on_get: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+class EventsTask(object):
+
+    async def on_get(self, req, resp, aid):
+        logger.debug("EventsTask.on_get request %s", req)
+        sig_check = await verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("EventsTask.on_get: Invalid signature on headers")
+            return sig_check
+        subscription = AsyncSubscription(aid)
+        hub.subscribe(subscription)
+        logger.debug("EventsTask.on_get: subscribed to %s", aid)
+        resp.cache_control = ["no-cache"]
+        resp.set_header("X-Accel-Buffering", "no")
+        resp.sse = astream(subscription, await asyncio.to_thread(replay, aid, req.get_header("Last-Event-ID")))
+
+class RequestContext(object):
+
+    async def process_request(self, req, resp):
+        resp.set_header('X-Request-ID', begin(req.get_header('X-Request-ID')))
+
+    async def process_resource(self, req, resp, resource, params):
+        bind(aid=params.get("aid"), dig=params.get("dig"))
+
+class HandleCORS(object):
+    async def process_request(self, req, resp):
+        resp.set_header('Access-Control-Allow-Origin', '*')
+        resp.set_header('Access-Control-Allow-Methods', '*')
+        resp.set_header('Access-Control-Allow-Headers', '*')
+        resp.set_header('Access-Control-Max-Age', 1728000)  # 20 days
+        if req.method == 'OPTIONS':
+            raise HTTPStatus(falcon.HTTP_200, text='\n')
+
+class PingResource:
+   async def on_get(self, req, resp):
+      """Handles GET requests, answers 200 even when calls to the verifier are being turned away"""
+      resp.status = falcon.HTTP_200
+      resp.content_type = falcon.MEDIA_TEXT
+      reasons = degraded()
+      resp.text = (
+         'Pong' if not reasons else f"Pong, degraded: {'; '.join(reasons)}"
+      )
+
+def falcon_app():
+    app = falcon.asgi.App(middleware=falcon.CORSMiddleware(
+    allow_origins='*', allow_credentials='*',
+    expose_headers=['cesr-attachment', 'cesr-date', 'content-type', 'signature', 'signature-input',
+                    'signify-resource', 'signify-timestamp', 'x-request-id', 'etag', 'x-status-seq',
+                    'x-next-cursor', 'server-timing']))
+    app.add_middleware([RequestContext(), AsyncTracing(), AsyncMetrics()])
+    if os.getenv("ENABLE_CORS", "false").lower() in ("true", "1"):
+        logger.info("CORS enabled")
+        app.add_middleware(middleware=HandleCORS())
+    app.req_options.media_handlers.update(media.Handlers())
+    app.resp_options.media_handlers.update(media.Handlers())
+
+    app.add_route('/ping', PingResource())
+    app.add_route('/metrics', AsyncMetricsResource())
+    app.add_route('/login', LoginTask())
+    app.add_route("/checklogin/{aid}", LoginTask())
+    app.add_route('/upload/{aid}/{dig}', UploadTask())
+    app.add_route("/checkupload/{aid}/{dig}", UploadTask())
+    app.add_route("/uploads/{aid}", BatchTask())
+    app.add_route("/uploads/{aid}/{batch}", BatchTask())
+    app.add_route("/status/{aid}", StatusTask())
+    app.add_route("/status/{aid}/events", EventsTask())
+    app.add_route("/verify/header", verSig)
+
+    return app
+
+def main():
+    logger.info("Starting RegPS (ASGI)...")
+    app = falcon_app()
+    api_doc=swagger_ui(app)
+
+    return app
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import asyncio
+import falcon
+import httpx
+import logging
+from app.events import hub
+from app.flights import flights
+from app.logs import bind, payload
+from app.packages import packages
+from app.polling import expired, not_found, poller
+from app.quotas import scheduler
+from app.results import serialize
+from app.spool import ReportSpool
+from app.tasks import UploadIndex, authorizations, batch_concurrency, failure, status_entry
+from app.tasks import upload_index
+from app.tracing import span
+from app.verifier import auths, presentations, reports, requests_verify
+from app.verifier import auths_url, presentations_url, reports_url, request_url
+
+logger = logging.getLogger(__name__)
+
+# the authorizations and the event hub may wait on redis, their calls run in threads to keep
+# the event loop serving other requests
+
+async def check_login(aid: str) -> dict:
+    """ Authorization of aid, concurrent checks of an AID share one call to the verifier """
+
+    async def fetch():
+        with span("check"):
+            result = serialize(await _login(aid))
+        await asyncio.to_thread(authorizations.put, aid, result)
+        return result
+
+    return await asyncio.to_thread(authorizations.get, aid) or await flights.ado(("auth", aid), fetch, poller.deadline) or await fetch()
+
+async def _login(aid: str) -> httpx.Response:
+    logger.debug("checking login: %s", aid)
+    logger.debug("getting from %s%s", auths_url, aid)
+    gres = await auths.aget(aid, headers={"Content-Type": "application/json"})
+    logger.debug("login status: %s", gres)
+    return gres
+
+async def verify_vlei(aid: str, said: str, vlei: str) -> dict:
+    # first check to see if we're already logged in
+    logger.debug("Login verification started %s %s %s", aid, said, payload(vlei))
+
+    login_result = await check_login(aid)
+    logger.debug("Login check %s %s", login_result['status_code'], payload(login_result))
+
+    if login_result["status_code"] == falcon.http_status_to_code(falcon.HTTP_OK):
+        logger.debug("already logged in")
+        return login_result
+    else:
+        # a presentation submitted again while it is being verified joins the first one
+        result = await flights.ado(("login", aid, said), lambda: _present(aid, said, vlei), poller.deadline)
+        if result is None:
+            return expired(True, f"Login verification for {aid} is still in progress", aid=aid, said=said)
+        return result
+
+async def _present(aid: str, said: str, vlei: str) -> dict:
+    # waits its turn behind the logins and uploads of other AIDs
+    async with scheduler.aslot(aid):
+        # a new presentation may change the AID's authorization
+        await asyncio.to_thread(authorizations.invalidate, aid)
+        logger.debug("putting to %s%s", presentations_url, said)
+        with span("present"):
+            presentation_result = serialize(await presentations.aput(said, key=aid, headers={"Content-Type": "application/json+cesr"}, content=vlei))
+        logger.debug("put response %s", payload(presentation_result))
+
+        if presentation_result["status_code"] == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
+            with span("poll", kind="login"):
+                login_response, final = await poller.apoll(lambda: _login(aid), not_found, kind="login")
+            logger.debug("polling result %s", login_response)
+            if not final:
+                return expired(login_response, f"Login verification for {aid} is still in progress", aid=aid, said=said)
+            login_result = serialize(login_response)
+            await asyncio.to_thread(authorizations.put, aid, login_result)
+            await asyncio.to_thread(hub.publish, aid, "login", status_entry(login_result, aid=aid, said=said, status="verified"))
+            return login_result
+        else:
+            return presentation_result
+
+async def verify_req(aid,cig,ser):
+    logger.debug("Request verification started aid = %s, cig = %s, ser = %s", aid, cig, ser)
+    logger.debug("posting to %s%s", request_url, aid)
+    with span("verify-req"):
+        pres = serialize(await requests_verify.apost(aid, params={"sig": cig,"data": ser}))
+    logger.debug("post response %s", payload(pres))
+    return pres
+
+async def check_upload(aid: str, dig: str) -> dict:
+    """ Verifier result of the report dig, concurrent checks of a digest share one call """
+
+    async def fetch():
+        with span("check"):
+            result = serialize(await _upload(aid, dig))
+        upload_index.record(aid, dig, result)
+        return result
+
+    return upload_index.result(aid, dig) or await flights.ado(("report", aid, dig), fetch, poller.deadline) or await fetch()
+
+async def _upload(aid: str, dig: str) -> httpx.Response:
+    logger.debug("checking upload: aid %s and dig %s", aid, dig)
+    logger.debug("getting from %s%s/%s", reports_url, aid, dig)
+    reports_response = await reports.aget(f"{aid}/{dig}", headers={"Content-Type": "application/json"})
+    logger.debug("upload status: %s", reports_response)
+    return reports_response
+
+async def upload(aid: str, dig: str, contype: str, report) -> dict:
+    result = upload_index.result(aid, dig)
+    if result is not None:
+        logger.debug("already verified %s %s", aid, dig)
+        return result
+    result = await packages.acheck(aid, dig, contype, report)
+    if result is not None:
+        upload_index.record(aid, dig, result)
+        return result
+
+    async def post():
+        async with scheduler.aslot(aid):
+            result = await _post_report(aid, dig, contype, report)
+        upload_index.record(aid, dig, result)
+        return result
+
+    result = await flights.ado(("upload", aid, dig), post, poller.deadline)
+    if result is None:
+        return expired(True, f"Report {dig} from {aid} is still being verified",
+                       submitter=aid, dig=dig, status="pending")
+    return result
+
+async def _post_report(aid: str, dig: str, contype: str, report) -> dict:
+    logger.debug("report type %s", type(report))
+    # first check to see if we've already uploaded
+    with span("check"):
+        upload_response = await _upload(aid, dig)
+    checked = serialize(upload_response)
+    if upload_response.status_code == falcon.http_status_to_code(falcon.HTTP_ACCEPTED) or UploadIndex.final(checked):
+        logger.debug("already uploaded")
+        return checked
+    else:
+        logger.debug("posting to %s%s/%s", reports_url, aid, dig)
+        headers = {"Content-Type": contype}
+        if isinstance(report, ReportSpool):
+            headers["Content-Length"] = str(report.size)
+            report = report.abody()
+        with span("post", dig=dig):
+            presentation_result = serialize(await reports.apost(f"{aid}/{dig}", headers=headers, content=report))
+        logger.debug("post response %s", payload(presentation_result))
+
+        if presentation_result["status_code"] == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
+            with span("poll", kind="upload"):
+                upload_response, final = await poller.apoll(lambda: _upload(aid, dig), not_found, kind="upload")
+            logger.debug("polling result %s", upload_response)
+            if not final:
+                return expired(upload_response, f"Report {dig} from {aid} is still being verified",
+                               submitter=aid, dig=dig, status="pending")
+            return serialize(upload_response)
+        else:
+            return presentation_result
+
+async def upload_batch(aid: str, reports: list) -> list:
+    """ upload() each (dig, contype, report), at most batch_concurrency at a time, results in order """
+    limit = asyncio.Semaphore(batch_concurrency)
+
+    async def one(dig, contype, report):
+        # each gathered task runs in a copy of the context, so the dig stays its own
+        bind(dig=dig)
+        async with limit:
+            try:
+                return await upload(aid, dig, contype, report)
+            except Exception as e:
+                logger.exception("upload_batch: %s %s failed", aid, dig)
+                return failure(e)
+
+    return list(await asyncio.gather(*(one(*item) for item in reports)))
@@ -0,0 +1,239 @@
+import falcon
+import hashlib
+import json
+import logging
+import threading
+from app.verifier import setting
+
+logger = logging.getLogger(__name__)
+
+# serve the OpenAPI document and swagger ui at /api/doc, turn off in production to skip them
+api_doc_enabled = setting('API_DOC', "true").lower() in ("true", "1")
+
+def document() -> dict:
+    """ The OpenAPI document of the service, with the example credential read from app/data """
+    vlei_contents = None
+    with open('app/data/credential.cesr', 'r') as cfile:
+        vlei_contents = cfile.read()
+
+    config = {"openapi":"3.0.1",
+            "info":{"title":"Regulator portal service api","description":"Regulator web portal service api","version":"1.0.0"},
+            "servers":[{"url":"http://127.0.0.1:8000","description":"local server"}],
+            "tags":[{"name":"default","description":"default tag"}],
+            "paths":{"/ping":{"get":{"tags":["default"],"summary":"output pong.","responses":{"200":{"description":"OK","content":{"application/text":{"schema":{"type":"object","example":"Pong"}}}}}}},
+                    "/login":{"post":{"tags":["default"],
+                                        "summary":"Given an AID and vLEI, returns information about the login",
+                                        "requestBody":{"required":"true","content":{"application/json":{"schema":{"type":"object","properties":{
+                                            "aid":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                            "said":{"type":"string","example":"EAPHGLJL1s6N4w1Hje5po6JPHu47R9-UoJqLweAci2LV"},
+                                            "vlei":{"type":"string","example":f"{vlei_contents}"}
+                                            }}}}},
+                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
+                                            "aid": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
+                                            "said": "EBdaAMrpqfB0PlTgI3juS8UFgIPAXC1NZd1jSk6acenf"
+                                        }}}}}}
+                                        }},
+                    "/checklogin/{aid}":{"get":{"tags":["default"],
+                                        "summary":"Given an AID returns information about the login",
+                                        "parameters":[{"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"}],
+                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
+                                            "aid": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
+                                            "said": "EBdaAMrpqfB0PlTgI3juS8UFgIPAXC1NZd1jSk6acenf"
+                                        }}}}}}
+                                        }},
+                    "/upload/{aid}/{dig}":{"post":{"tags":["default"],
+                                        "summary":"Given an AID and DIG, returns information about the upload",
+                                        "parameters":[
+                                                    {"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"},
+                                                      {"in":"path","name":"dig","required":"true","schema":{"type":"string","minimum":1,"example":"EC7b6S50sY26HTj6AtQiWMDMucsBxMvThkmrKUBXVMf0"},"description":"The digest of the upload"},
+                                                    {"in":"header","name":"Signature","required":"true",
+                                                    "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BCLs_wv3X6YFoFhB7acH_BePXS7zjBJPvuChdr01cM60Igf_sxYsah9sLHP-pMSYFs1Y6zYUo58HVG8tRd4X1IC\""},
+                                                    "description":"The signature of the data"},
+                                                    {"in":"header","name":"Signature-Input","required":"true",
+                                                    "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690462814;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
+                                                    "description":"The signature of the data"},
+                                                    {"in":"header","name":"Signify-Resource","required":"true",
+                                                    "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                                    "description":"The aid that siged the data"},
+                                                    {"in":"header","name":"signify-timestamp","required":"true",
+                                                    "schema":{"type":"string","example":"2023-07-27T13:00:14.802000+00:00"},
+                                                    "description":"The timestamp of the data"}  
+                                                      ],
+                                        "requestBody":{"required":"true","content":{"multipart/form-data":{"schema":{"type":"object","properties":{
+                                            "upload":{"type":"string","format":"binary","description":"The report package, such as app/data/report.zip"}
+                                            }}}}},
+                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
+                                            "submitter": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
+                                            "filename": "test_ifgroup2023.zip",
+                                            "status": "verified",
+                                            "contentType": "application/zip",
+                                            "size": 4467,
+                                            "message": "All 6 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk)."
+                                        }}}}}},
+                                        }},
+                    "/uploads/{aid}":{"post":{"tags":["default"],
+                                        "summary":"Given an AID, uploads several reports, each a part named by its digest",
+                                        "parameters":[
+                                                    {"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"},
+                                                    {"in":"header","name":"Signature","required":"true",
+                                                    "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BCLs_wv3X6YFoFhB7acH_BePXS7zjBJPvuChdr01cM60Igf_sxYsah9sLHP-pMSYFs1Y6zYUo58HVG8tRd4X1IC\""},
+                                                    "description":"The signature of the data"},
+                                                    {"in":"header","name":"Signature-Input","required":"true",
+                                                    "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690462814;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
+                                                    "description":"The signature of the data"},
+                                                    {"in":"header","name":"Signify-Resource","required":"true",
+                                                    "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                                    "description":"The aid that siged the data"},
+                                                    {"in":"header","name":"signify-timestamp","required":"true",
+                                                    "schema":{"type":"string","example":"2023-07-27T13:00:14.802000+00:00"},
+                                                    "description":"The timestamp of the data"}
+                                                      ],
+                                        "requestBody":{"required":"true","content":{"multipart/form-data":{"schema":{"type":"object","properties":{
+                                            "EC7b6S50sY26HTj6AtQiWMDMucsBxMvThkmrKUBXVMf0":{"type":"string","format":"binary","description":"A report package, named by its digest"}
+                                            },"additionalProperties":{"type":"string","format":"binary"}}}}},
+                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
+                                            "batch": "3f1c0a3e2b6d4f6c9a1e5b7d8c2f4a60",
+                                            "submitter": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
+                                            "status": "verified",
+                                            "counts": {"verified": 1},
+                                            "reports": [{"submitter": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk", "filename": "test_ifgroup2023.zip",
+                                                         "status": "verified", "contentType": "application/zip", "size": 4467,
+                                                         "message": "All 6 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk).",
+                                                         "batch": "3f1c0a3e2b6d4f6c9a1e5b7d8c2f4a60", "dig": "EC7b6S50sY26HTj6AtQiWMDMucsBxMvThkmrKUBXVMf0", "seq": 1697640000001}]
+                                        }}}}}},
+                                        }},
+                    # "/checkupload/{aid}/{dig}":{"get":{"tags":["default"],
+                    #                     "summary":"Given an AID and DIG returns information about the upload status",
+                    #                     "parameters":[{"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"},
+                    #                                   {"in":"path","name":"dig","required":"true","schema":{"type":"string","minimum":1,"example":"EAPHGLJL1s6N4w1Hje5po6JPHu47R9-UoJqLweAci2LV"},"description":"The digest of the upload"}],
+                    #                     "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
+                    #                                             "submitter": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
+                    #                                             "filename": "DUMMYLEI123456789012.IND_FR_IF010200_IFTM_2022-12-31_20220222134211000.zip",
+                    #                                             "status": "failed",
+                    #                                             "contentType": "application/zip",
+                    #                                             "size": 3390,
+                    #                                             "message": "No signatures found in manifest file"
+                    #                     }}}}}},
+                    #                     }},
+                    "/status/{aid}":{"get":{"tags":["default"],
+                                        "summary":"Given an AID returns information about the upload status",
+                                        "parameters":[
+                                            {"in":"header","name":"Signature","required":"true",
+                                             "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BAbJnlOwYCgQ-1SExPKoPR8AyF2luTrP207oFRSOqKNwpYIviOgA-Fp4Z11At2f3NWBwUbQRWEB8Tu3es1l_QUI\""},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signature-Input","required":"true",
+                                             "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690386592;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signify-Resource","required":"true",
+                                             "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                             "description":"The aid that siged the data"},
+                                            {"in":"header","name":"signify-timestamp","required":"true",
+                                             "schema":{"type":"string","example":"2023-07-26T15:49:52.571000+00:00"},
+                                             "description":"The timestamp of the data"},
+                                            {"in":"path","name":"aid","required":"true",
+                                             "schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                             "description":"The AID"},
+                                            {"in":"query","name":"cursor","required":"false",
+                                             "schema":{"type":"integer","minimum":0},
+                                             "description":"seq of the last entry already read, from the X-Next-Cursor header of the previous page"},
+                                            {"in":"query","name":"limit","required":"false",
+                                             "schema":{"type":"integer","minimum":1},
+                                             "description":"Most entries returned"},
+                                            {"in":"query","name":"since","required":"false",
+                                             "schema":{"type":"integer","minimum":0},
+                                             "description":"Only entries added or updated after this sequence number, from the X-Status-Seq header"}
+                                        ],
+                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
+                                            "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk": [
+                                                "{\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"filename\": \"test_MetaInfReportJson_noSigs.zip\", \"status\": \"failed\", \"contentType\": \"application/zip\", \"size\": 3059, \"message\": \"5 files from report package not signed {'parameters.csv', 'FilingIndicators.csv', 'report.json', 'i_10.01.csv', 'i_10.02.csv'}, []\"}",
+                                                "{\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"filename\": \"test_ifclass3.zip\", \"status\": \"verified\", \"contentType\": \"application/zip\", \"size\": 5662, \"message\": \"All 9 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk).\"}",
+                                                "{\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"filename\": \"test_ifgroup2023.zip\", \"status\": \"verified\", \"contentType\": \"application/zip\", \"size\": 4467, \"message\": \"All 6 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk).\"}"
+                                            ]
+                                            }}}}}},
+                                        }},
+                    "/status/{aid}/events":{"get":{"tags":["default"],
+                                        "summary":"Given an AID streams its login and upload results as server-sent events",
+                                        "parameters":[
+                                            {"in":"header","name":"Signature","required":"true",
+                                             "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BAbJnlOwYCgQ-1SExPKoPR8AyF2luTrP207oFRSOqKNwpYIviOgA-Fp4Z11At2f3NWBwUbQRWEB8Tu3es1l_QUI\""},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signature-Input","required":"true",
+                                             "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690386592;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signify-Resource","required":"true",
+                                             "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                             "description":"The aid that siged the data"},
+                                            {"in":"header","name":"signify-timestamp","required":"true",
+                                             "schema":{"type":"string","example":"2023-07-26T15:49:52.571000+00:00"},
+                                             "description":"The timestamp of the data"},
+                                            {"in":"header","name":"Last-Event-ID","required":"false",
+                                             "schema":{"type":"integer"},
+                                             "description":"The id of the last upload event received, the upload entries changed after it are sent first"},
+                                            {"in":"path","name":"aid","required":"true",
+                                             "schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                             "description":"The AID"}
+                                        ],
+                                        "responses":{"200":{"description":"OK","content":{"text/event-stream":{"schema":{"type":"string","example":
+                                            "id: 1697640000001\nevent: upload\ndata: {\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"status\": \"verified\", \"dig\": \"EAPHGLJL1s6N4w1Hje5po6JPHu47R9-UoJqLweAci2LV\", \"seq\": 1697640000001}\n\n"
+                                            }}}}},
+                                        }},
+                    "/verify/header":{"get":{"tags":["default"],
+                                        "summary":"returns if the headers are properly signed",
+                                        "parameters":[
+                                            {"in":"header","name":"Signature","required":"true",
+                                             "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BB86jS2w9PKL1t-5hZIxgF9-vMNz4DsoASJR_f-u8FvnywdvosPOqbXUo97LuS-pYH_K_BPpfA2Y0XsGb2pSBoL\""},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signature-Input","required":"true",
+                                             "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690922901;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signify-Resource","required":"true",
+                                             "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
+                                             "description":"The signature of the data"},
+                                            {"in":"header","name":"Signify-Timestamp","required":"true",
+                                             "schema":{"type":"string","example":"2023-08-01T20:48:21.885000+00:00"},
+                                             "description":"The signature of the data"}
+                                        ],
+                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{}}}}}},
+                                        }},
+                    }}
+
+    return config
+
+class OpenApi(object):
+    """ The OpenAPI document, built and serialized on its first request and then served from memory
+
+    Responses carry an ETag, so browsers revalidate with If-None-Match and get a 304.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.body = None
+        self.etag = None
+
+    def serialized(self):
+        if self.body is None:
+            with self.lock:
+                if self.body is None:
+                    body = json.dumps(document()).encode("utf-8")
+                    self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+                    self.body = body
+                    logger.info("Built the API document, %s bytes", len(body))
+        return self.body, self.etag
+
+    def respond(self, req, resp):
+        body, etag = self.serialized()
+        resp.etag = etag
+        resp.cache_control = ["no-cache"]
+        if etag in (req.get_header("If-None-Match") or ""):
+            resp.status = falcon.HTTP_304
+            return
+        resp.data = body
+        resp.content_type = falcon.MEDIA_JSON
+
+    def on_get(self, req, resp):
+        self.respond(req, resp)
+
+class AsyncOpenApi(OpenApi):
+
+    async def on_get(self, req, resp):
+        self.respond(req, resp)
@@ -0,0 +1,8 @@
+from app.aioservice import falcon_app, swagger_ui
+import logging
+
+logger = logging.getLogger(__name__)
+
+logger.info("Starting RegPS (ASGI)...")
+app = falcon_app()
+api_doc=swagger_ui(app)
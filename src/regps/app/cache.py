@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import threading
+import time
+
+class TTLCache(object):
+    """ Thread safe LRU cache whose entries expire after a time to live
+
+    Holds at most size entries, evicting the least recently used first. Each entry lives ttl
+    seconds unless set() is given its own ttl.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def _get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return item
+
+    def _set(self, key, value, ttl):
+        self.entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self._get(key)
+            return default if item is None else item[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None) -> bool:
+        """ Set key only if it is not cached yet, returns whether it was set """
+        with self.lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            return default if item is None or item[1] <= time.monotonic() else item[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._get(key) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
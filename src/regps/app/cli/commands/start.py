@@ -6,11 +6,10 @@ regps.cli.regps.commands module
 regulation portal servicecommand line interface
 """
 import argparse
-
-# from regps.app import service
+import os
 
 d = "Runs regulation portal service\n"
-d += "\tExample:\nregps\n"
+d += "\tExample:\nregps start --port 8000 --preload\n"
 parser = argparse.ArgumentParser(description=d)
 parser.set_defaults(handler=lambda args: launch(args))
 parser.add_argument('-V', '--version',
@@ -20,4 +19,76 @@ parser.add_argument('-V', '--version',
 parser.add_argument('-p', '--port',
                     action='store',
                     default=4902,
-                    help="Local port number the HTTP server listens on. Default is 4902.")    
+                    help="Local port number the HTTP server listens on. Default is 4902.")
+parser.add_argument('--host',
+                    action='store',
+                    default="0.0.0.0",
+                    help="Address the HTTP server listens on. Default is 0.0.0.0.")
+parser.add_argument('-w', '--workers',
+                    action='store',
+                    type=int,
+                    default=os.cpu_count() or 1,
+                    help="Worker processes. Default is the number of cores.")
+parser.add_argument('-k', '--worker-class',
+                    action='store',
+                    choices=["sync", "threaded", "gevent", "asgi"],
+                    default="sync",
+                    help="sync, threaded, gevent or asgi (the ASGI app on uvicorn workers). Default is sync.")
+parser.add_argument('-t', '--threads',
+                    action='store',
+                    type=int,
+                    default=1,
+                    help="Threads per worker with the threaded worker class. Default is 1.")
+parser.add_argument('--preload',
+                    action='store_true',
+                    help="Import the app once before forking the workers so they share its memory. "
+                         "A HUP then restarts the workers without reloading the code.")
+parser.add_argument('--keepalive',
+                    action='store',
+                    type=int,
+                    default=5,
+                    help="Seconds an idle keep-alive connection stays open. Default is 5.")
+parser.add_argument('--timeout',
+                    action='store',
+                    type=int,
+                    default=30,
+                    help="Seconds a silent worker is given before it is killed and restarted. Default is 30.")
+parser.add_argument('--graceful-timeout',
+                    action='store',
+                    type=int,
+                    default=30,
+                    help="Seconds workers are given to finish their requests on a restart or stop. Default is 30.")
+parser.add_argument('--max-requests',
+                    action='store',
+                    type=int,
+                    default=0,
+                    help="Requests a worker serves before it is replaced, 0 never replaces it. Default is 0.")
+parser.add_argument('--max-requests-jitter',
+                    action='store',
+                    type=int,
+                    default=0,
+                    help="Random extra requests added to --max-requests per worker. Default is 0.")
+parser.add_argument('--pid',
+                    action='store',
+                    default=None,
+                    help="File to write the master's pid to, send it a HUP to restart the workers gracefully.")
+
+
+def launch(args):
+    import app
+    from app.server import Server
+
+    # the app reads its data files relative to the directory holding the app package
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(app.__file__))))
+    Server({
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads,
+        "preload_app": args.preload,
+        "keepalive": args.keepalive,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests_jitter,
+        "pidfile": args.pid,
+    }, args.worker_class).run()
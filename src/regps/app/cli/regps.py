@@ -6,8 +6,13 @@ regps.app.cli.commands module
 """
 import logging
 import multicommand
-import regps.app.service as service
-import commands
+import os
+import sys
+
+# the app modules import each other as app, from the directory holding the app package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from app.cli import commands
 
 def main():
     parser = multicommand.create_parser(commands)
@@ -18,13 +23,13 @@ def main():
         return
 
     try:
-        logging.info("******* Starting regulation portal service for %s listening: http/%s "
-                    ".******", args.http)
+        logging.info("******* Starting regulation portal service listening: http/%s "
+                    ".******", getattr(args, 'port', None))
 
-        service.main(http=int(args.http))
+        args.handler(args)
 
-        logging.info("******* Ended reg portal service %s listening: http/%s"
-                    ".******", args.http)
+        logging.info("******* Ended reg portal service listening: http/%s"
+                    ".******", getattr(args, 'port', None))
 
 
     except Exception as ex:
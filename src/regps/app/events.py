@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from app.results import dumps, loads
+from app.store import store
+from app.verifier import setting
+from falcon.asgi import SSEvent
+
+logger = logging.getLogger(__name__)
+
+# optional redis url fanning events out to the subscribers of every worker, without it an
+# event only reaches the subscribers of the process that published it
+events_redis = setting('EVENTS_REDIS', None)
+# seconds an event stream stays open before the client is asked to reconnect, keep it under
+# the gunicorn worker timeout with sync workers
+events_timeout = setting('EVENTS_TIMEOUT', 25, int)
+# seconds between keep-alive comments on an idle stream
+events_heartbeat = setting('EVENTS_HEARTBEAT', 10, int)
+# events buffered per subscriber, a subscriber that falls further behind misses events
+events_buffer = setting('EVENTS_BUFFER', 64, int)
+# milliseconds a client waits before reconnecting
+events_retry = setting('EVENTS_RETRY', 1000, int)
+# serve event streams from the WSGI app, where each open stream holds a worker or thread, regps
+# start turns it on for threaded and gevent workers and sync workers answer 501
+events_wsgi = setting('EVENTS_WSGI', "false").lower() in ("true", "1")
+
+class Subscription(object):
+    """ Events of one AID for one client, buffered until the stream sends them """
+
+    def __init__(self, aid: str, size=None):
+        self.aid = aid
+        self.queue = queue.Queue(events_buffer if size is None else size)
+
+    def put(self, message: dict):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            logger.warning("Subscription.put: dropped %s event for %s", message["event"], self.aid)
+
+    def get(self, timeout: float):
+        """ Next event, or None if there was none for timeout seconds """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncSubscription(Subscription):
+    """ Subscription read from the event loop it was created in, events may be put from any thread """
+
+    def __init__(self, aid: str, size=None):
+        self.aid = aid
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(events_buffer if size is None else size)
+
+    def put(self, message: dict):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("AsyncSubscription.put: dropped %s event for %s", message["event"], self.aid)
+
+    async def get(self, timeout: float):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class EventHub(object):
+    """ Subscriptions per AID and the events published to them
+
+    With a redis url events are published to a channel per AID, and every process listens to
+    all of them on a thread started by its first subscription, so a login or upload finished
+    by any worker, or by a celery worker, reaches every subscriber of its AID.
+    """
+
+    def __init__(self, url=None, prefix="regps:events"):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        url = events_redis if url is None else url
+        self.redis = None
+        if url:
+            import redis
+            self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.listener = None
+
+    def after_fork(self):
+        """ Forget the subscriptions and listener of the master a worker was forked from """
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.listener = None
+
+    def subscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscriptions.setdefault(subscription.aid, set()).add(subscription)
+            self._listen()
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.aid)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.aid]
+
+    def publish(self, aid: str, event: str, data: dict, id=None):
+        message = {"aid": aid, "event": event, "data": data, "id": id}
+        if self.redis is not None:
+            try:
+                self.redis.publish(f"{self.prefix}:{aid}", dumps(message))
+                return
+            except Exception as e:
+                logger.warning("EventHub.publish: redis unavailable %s", e)
+        self.deliver(message)
+
+    def deliver(self, message: dict):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(message["aid"], ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def _listen(self):
+        # started in the worker serving the subscription, a thread does not survive a fork
+        if self.redis is None or (self.listener is not None and self.listener.is_alive()):
+            return
+        self.listener = threading.Thread(target=self._run, name="regps-events", daemon=True)
+        self.listener.start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{self.prefix}:*")
+                for item in pubsub.listen():
+                    self.deliver(loads(item["data"]))
+            except Exception as e:
+                logger.warning("EventHub.listen: redis unavailable %s", e)
+                time.sleep(1)
+
+hub = EventHub()
+os.register_at_fork(after_in_child=hub.after_fork)
+
+def record(aid: str, dig: str, entry: dict):
+    """ Write an upload status entry to the store and push it, with its sequence number, to the AID's subscribers """
+    store.update(aid, dig, entry)
+    stored = store.find(aid, dig)
+    if stored is not None:
+        hub.publish(aid, "upload", stored, stored.get("seq"))
+
+def replay(aid: str, last_event_id) -> list:
+    """ Upload events a client reconnecting with Last-Event-ID missed """
+    try:
+        since = int(last_event_id)
+    except (TypeError, ValueError):
+        return []
+    entries, _ = store.page(aid, since=since)
+    return [{"aid": aid, "event": "upload", "data": entry, "id": entry.get("seq")} for entry in entries]
+
+def sse(message: dict) -> bytes:
+    lines = [] if message.get("id") is None else [f"id: {message['id']}"]
+    lines.append(f"event: {message['event']}")
+    return ("\n".join(lines) + "\ndata: ").encode("utf-8") + dumps(message["data"]) + b"\n\n"
+
+def stream(subscription: Subscription, missed: list):
+    """ Server-sent events of a subscription for events_timeout seconds, with keep-alive comments while idle """
+    deadline = time.monotonic() + events_timeout
+    try:
+        yield f"retry: {events_retry}\n\n".encode("utf-8")
+        for message in missed:
+            yield sse(message)
+        while (left := deadline - time.monotonic()) > 0:
+            message = subscription.get(min(events_heartbeat, left))
+            yield b": keep-alive\n\n" if message is None else sse(message)
+    finally:
+        hub.unsubscribe(subscription)
+
+async def astream(subscription: AsyncSubscription, missed: list):
+    """ stream() as falcon.asgi events, None sends a keep-alive comment """
+
+    def event(message):
+        return SSEvent(data=dumps(message["data"]), event=message["event"],
+                       event_id=None if message.get("id") is None else str(message["id"]))
+
+    deadline = time.monotonic() + events_timeout
+    try:
+        yield SSEvent(retry=events_retry)
+        for message in missed:
+            yield event(message)
+        while (left := deadline - time.monotonic()) > 0:
+            message = await subscription.get(min(events_heartbeat, left))
+            yield None if message is None else event(message)
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from app.results import dumps, loads, portable
+from app.tracing import span
+from app.verifier import setting
+
+logger = logging.getLogger(__name__)
+
+# optional redis url sharing the verifier calls in flight between workers and nodes
+flight_redis = setting('FLIGHT_REDIS', None)
+# seconds a claim on a call outlives a worker that never finishes it, and a shared result is kept
+flight_claim_ttl = setting('FLIGHT_CLAIM_TTL', 120.0, float)
+flight_result_ttl = setting('FLIGHT_RESULT_TTL', 10.0, float)
+
+# deletes the claim KEYS[1] if it is still ARGV[1]
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class Flight(object):
+    """ A call in flight, the callers joining it wait for done and share result """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+class SingleFlight(object):
+    """ Makes one verifier call per key at a time, concurrent callers with the key share its result
+
+    In a worker the first caller makes the call and the others wait for it. With a redis url
+    the first caller of each worker also claims the key in redis, and a worker finding the key
+    claimed polls for the result the claimant leaves there instead of calling. Callers whose
+    call failed without a result make it again, and callers waiting more than timeout seconds
+    get None.
+    """
+
+    def __init__(self, url=None, prefix="regps:flight"):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.aflights = {}
+        url = flight_redis if url is None else url
+        self.redis = None
+        if url:
+            import redis
+            self.redis = redis.Redis.from_url(url)
+            self.script = self.redis.register_script(RELEASE)
+        self.prefix = prefix
+
+    def _claim(self, key):
+        """ Token of this worker's claim on key, or None and the token of the worker holding it """
+        if self.redis is None:
+            return None, None
+        token = uuid.uuid4().hex
+        try:
+            if self.redis.set(f"{self.prefix}:{key}", token, nx=True, px=int(flight_claim_ttl * 1000)):
+                return token, None
+            return None, self.redis.get(f"{self.prefix}:{key}")
+        except Exception as e:
+            logger.warning("SingleFlight.claim: redis unavailable %s", e)
+            return None, None
+
+    def _release(self, key, token, result=None):
+        """ Leave result for the other workers and drop the claim """
+        try:
+            if result is not None:
+                self.redis.set(f"{self.prefix}:{key}:{token}", dumps(portable(result)), px=int(flight_result_ttl * 1000))
+            self.script(keys=[f"{self.prefix}:{key}"], args=[token])
+        except Exception as e:
+            logger.warning("SingleFlight.release: redis unavailable %s", e)
+
+    def _peek(self, key, claimant):
+        """ Result the claimant left, or None and whether it still holds the claim """
+        try:
+            value, token = self.redis.pipeline().get(f"{self.prefix}:{key}:{claimant.decode()}").get(f"{self.prefix}:{key}").execute()
+        except Exception as e:
+            logger.warning("SingleFlight.peek: redis unavailable %s", e)
+            return None, False
+        if value is not None:
+            return loads(value), False
+        return None, token == claimant
+
+    def _call(self, key, call, token):
+        try:
+            result = call()
+        except Exception:
+            if token is not None:
+                self._release(key, token)
+            raise
+        if token is not None:
+            self._release(key, token, result)
+        return result
+
+    def _lead(self, key, call, deadline):
+        token, claimant = self._claim(key)
+        delay = 0.05
+        while claimant is not None:
+            result, claimed = self._peek(key, claimant)
+            if result is not None:
+                logger.debug("SingleFlight.lead: shared %s", key)
+                return result
+            if not claimed:
+                # the claimant failed or its result expired, claim the call again
+                token, claimant = self._claim(key)
+                continue
+            if time.monotonic() + delay > deadline:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        return self._call(key, call, token)
+
+    def do(self, key: tuple, call, timeout: float):
+        """ call() once for the concurrent callers with key, its result, or None after timeout seconds """
+        joined = ":".join(key)
+        with self.lock:
+            flight = self.flights.get(joined)
+            leader = flight is None
+            if leader:
+                flight = self.flights[joined] = Flight()
+        if not leader:
+            logger.debug("SingleFlight.do: joining %s", joined)
+            with span("join", key=joined):
+                if not flight.done.wait(timeout):
+                    return None
+            if flight.failed:
+                # the call in flight failed without a result, make this one
+                return self.do(key, call, timeout)
+            return flight.result
+        try:
+            flight.result = self._lead(joined, call, time.monotonic() + timeout)
+            return flight.result
+        except Exception:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.flights[joined]
+            flight.done.set()
+
+    async def _acall(self, key, call, token):
+        try:
+            result = await call()
+        except Exception:
+            if token is not None:
+                await asyncio.to_thread(self._release, key, token)
+            raise
+        if token is not None:
+            await asyncio.to_thread(self._release, key, token, result)
+        return result
+
+    async def _alead(self, key, call, deadline):
+        # the redis calls block, they run in threads so the event loop keeps serving meanwhile
+        if self.redis is None:
+            return await self._acall(key, call, None)
+        token, claimant = await asyncio.to_thread(self._claim, key)
+        delay = 0.05
+        while claimant is not None:
+            result, claimed = await asyncio.to_thread(self._peek, key, claimant)
+            if result is not None:
+                logger.debug("SingleFlight.lead: shared %s", key)
+                return result
+            if not claimed:
+                token, claimant = await asyncio.to_thread(self._claim, key)
+                continue
+            if time.monotonic() + delay > deadline:
+                return None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        return await self._acall(key, call, token)
+
+    async def ado(self, key: tuple, call, timeout: float):
+        """ do() for an async call, the callers of an event loop share its future """
+        joined = ":".join(key)
+        flight = self.aflights.get(joined)
+        if flight is not None:
+            logger.debug("SingleFlight.ado: joining %s", joined)
+            try:
+                with span("join", key=joined):
+                    result, failed = await asyncio.wait_for(asyncio.shield(flight), timeout)
+            except asyncio.TimeoutError:
+                return None
+            if failed:
+                return await self.ado(key, call, timeout)
+            return result
+        flight = self.aflights[joined] = asyncio.get_running_loop().create_future()
+        outcome = (None, True)
+        try:
+            outcome = (await self._alead(joined, call, time.monotonic() + timeout), False)
+            return outcome[0]
+        finally:
+            del self.aflights[joined]
+            flight.set_result(outcome)
+
+flights = SingleFlight()
@@ -0,0 +1,144 @@
+import falcon
+import json
+import logging
+import requests
+import time
+from keri.core import coring, eventing, parsing
+from keri.db import basing
+from app.cache import TTLCache
+from app.signatures import unauthorized
+from app.tracing import CLIENT, span
+from app.verifier import Endpoint, connect_timeout, read_timeout, setting
+
+logger = logging.getLogger(__name__)
+
+# remote sends every signed header to the verifier, local checks it here against the
+# signer's current keys and only falls back to the verifier when they cannot be resolved
+verify_mode = setting('VERIFY_MODE', "remote").lower()
+# json key state per AID, GET {KEY_STATE_URL}{aid} answering {"i": aid, "s": sn, "k": [keys]}
+key_state_url = setting('KEY_STATE_URL', None)
+# OOBI serving an AID's KEL, {aid} is replaced, e.g. http://127.0.0.1:5642/oobi/{aid}/witness
+key_state_oobi = setting('KEY_STATE_OOBI', None)
+# seconds a resolved key state is trusted, and the least seconds between refreshes of one AID
+key_state_ttl = setting('KEY_STATE_TTL', 300, int)
+key_state_refresh = setting('KEY_STATE_REFRESH', 5, int)
+# seconds after which a cached key state is resolved again before it verifies a signature, which
+# bounds how long a rotated out key keeps verifying, the verifier decides while it cannot be
+key_state_max_age = setting('KEY_STATE_MAX_AGE', 30, int)
+
+class KeyStates(object):
+    """ Current signing keys of AIDs, resolved from a key state endpoint or the AID's OOBI
+
+    A key id that is not among the cached keys may mean the AID rotated, so the AID is
+    resolved again, at most once every key_state_refresh seconds. A rotation that drops a key
+    is only seen on the next resolution, so a state older than max_age is resolved again before
+    it is used, and signatures of the AID go to the verifier while that fails.
+    """
+
+    def __init__(self, url=None, oobi=None, ttl=None, refresh=None, max_age=None, size=10000):
+        url = key_state_url if url is None else url
+        self.states = Endpoint("keystate", url) if url else None
+        self.oobi = key_state_oobi if oobi is None else oobi
+        # an OOBI is a full url on the AID's witnesses or agent, not a path on a verifier instance
+        self.oobis = requests.Session() if self.oobi else None
+        self.cache = TTLCache(size, key_state_ttl if ttl is None else ttl)
+        self.refreshed = TTLCache(size, key_state_refresh if refresh is None else refresh)
+        self.max_age = key_state_max_age if max_age is None else max_age
+
+    @property
+    def enabled(self) -> bool:
+        return self.states is not None or self.oobi is not None
+
+    def cached(self, aid: str, keyid: str) -> bool:
+        """ Whether keyid is a cached current key of aid, so keys() will not block on resolving """
+        state = self.cache.get(aid)
+        return self.fresh(state) and keyid in state["k"]
+
+    def fresh(self, state) -> bool:
+        return state is not None and time.monotonic() - state["at"] < self.max_age
+
+    def keys(self, aid: str, keyid: str):
+        """ Current key state of aid as {"s": sn, "k": [keys]}, or None if it cannot be resolved """
+        state = self.cache.get(aid)
+        if self.fresh(state) and keyid in state["k"]:
+            return state
+        if state is None or self.refreshed.add(aid, True):
+            try:
+                resolved = self.resolve(aid)
+            except Exception as e:
+                logger.warning("KeyStates.keys: resolving %s failed %s", aid, e)
+                resolved = None
+            if resolved is not None and (state is None or resolved["s"] >= state["s"]):
+                if state is not None and resolved["s"] > state["s"]:
+                    logger.info("KeyStates.keys: %s rotated to sn %s", aid, resolved['s'])
+                state = dict(resolved, at=time.monotonic())
+                self.cache.set(aid, state)
+        return state if self.fresh(state) else None
+
+    def resolve(self, aid: str):
+        if self.states is not None:
+            response = self.states.get(aid)
+            if response.status_code != falcon.http_status_to_code(falcon.HTTP_200):
+                return None
+            return self.parse_state(response.json())
+        if self.oobi is not None:
+            with span("oobi", CLIENT) as traced:
+                response = self.oobis.get(self.oobi.format(aid=aid), timeout=(connect_timeout, read_timeout))
+                traced.set(status=response.status_code)
+            if response.status_code != falcon.http_status_to_code(falcon.HTTP_200):
+                return None
+            return self.parse_kel(aid, response.content)
+        return None
+
+    @staticmethod
+    def parse_state(state):
+        # accepts a key state notice, KERIA's {"state": ...} wrapper or a list of states
+        if isinstance(state, list):
+            state = state[0] if state else None
+        if state is not None and "state" in state:
+            state = state["state"]
+        if not state or "k" not in state:
+            return None
+        sn = state.get("s", "0")
+        return {"s": int(sn, 16) if isinstance(sn, str) else int(sn), "k": list(state["k"])}
+
+    @staticmethod
+    def parse_kel(aid: str, kel: bytes):
+        """ Validate a KEL with a throw away keri database and return the AID's current keys """
+        db = basing.Baser(name="regps-keystate", temp=True, reopen=True)
+        try:
+            kevery = eventing.Kevery(db=db, lax=True, local=False)
+            parsing.Parser(kvy=kevery).parse(ims=bytearray(kel))
+            kever = kevery.kevers.get(aid)
+            if kever is None:
+                return None
+            return {"s": kever.sn, "k": [verfer.qb64 for verfer in kever.verfers]}
+        finally:
+            db.close(clear=True)
+
+    def verify(self, aid: str, cig: str, ser: str, keyid: str):
+        """ Verify a signify header signature in process
+
+        Returns the result, or None when the AID's key state is unknown and the verifier has
+        to decide.
+        """
+        state = self.keys(aid, keyid)
+        if state is None:
+            return None
+        if keyid not in state["k"]:
+            return unauthorized(f"{keyid} is not a current signing key of {aid}")
+        try:
+            verified = coring.Verfer(qb64=keyid).verify(coring.Cigar(qb64=cig).raw, ser.encode("utf-8"))
+        except Exception as e:
+            logger.warning("KeyStates.verify: invalid signature material %s", e)
+            verified = False
+        if not verified:
+            return unauthorized(f"Signature of {aid} does not verify")
+        return {"status_code": falcon.http_status_to_code(falcon.HTTP_200),
+                "text": json.dumps({"aid": aid, "keyid": keyid, "sn": state["s"]}),
+                "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+keystates = KeyStates()
+
+def local_verification() -> bool:
+    return verify_mode == "local" and keystates.enabled
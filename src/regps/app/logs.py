@@ -0,0 +1,116 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+# settings are read here and not with app.verifier.setting, which logs through this module
+log_level = os.environ.get('LOG_LEVEL', "INFO").upper()
+# json writes one object per line, text a plain line for reading in a terminal
+log_format = os.environ.get('LOG_FORMAT', "json").lower()
+# fraction of DEBUG records that are written, the others are dropped before formatting
+log_debug_sample = float(os.environ.get('LOG_DEBUG_SAMPLE', "1.0"))
+# characters of a request or response payload written to the log
+log_payload_prefix = int(os.environ.get('LOG_PAYLOAD_PREFIX', "64"))
+
+# fields of the request being handled, added to every record logged while handling it
+context = contextvars.ContextVar("regps_log_context", default={})
+fields = ("request_id", "trace_id", "aid", "dig")
+
+def bind(**values):
+    """ Add fields to the log context of the current request """
+    context.set({**context.get(), **{k: v for k, v in values.items() if v is not None}})
+
+def begin(request_id=None) -> str:
+    """ Start the log context of a request, returns its request id """
+    request_id = request_id or uuid.uuid4().hex
+    context.set({"request_id": request_id})
+    return request_id
+
+class Payload(object):
+    """ Lazily truncated payload, only formatted when the record is written """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (bytes, bytearray)):
+            return f"<{len(value)} bytes>"
+        value = str(value)
+        if len(value) <= log_payload_prefix:
+            return value
+        return f"{value[:log_payload_prefix]}...<{len(value)} chars>"
+
+    __repr__ = __str__
+
+def payload(value) -> Payload:
+    return Payload(value)
+
+class ContextFilter(logging.Filter):
+    """ Adds the request context to records and samples DEBUG records """
+
+    def __init__(self, sample=None):
+        super().__init__()
+        self.sample = log_debug_sample if sample is None else sample
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        for name, value in context.get().items():
+            setattr(record, name, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+                "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        for name in fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                line[name] = value
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+def configure(level=None, fmt=None):
+    """ Send the app loggers through a queue to a listener thread writing stdout
+
+    Request threads and the event loop only put records on the queue, the formatting and the
+    write happen on the listener thread.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if (fmt or log_format) == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s", defaults={"request_id": "-"}))
+    records = queue.SimpleQueue()
+    queued = logging.handlers.QueueHandler(records)
+    queued.addFilter(ContextFilter())
+    logger = logging.getLogger("app")
+    logger.handlers = [queued]
+    logger.setLevel(level or log_level)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+listener = configure()
+
+def _restart():
+    # the listener thread does not survive a fork, e.g. into gunicorn or celery pool workers
+    global listener
+    listener = configure()
+
+os.register_at_fork(after_in_child=_restart)
@@ -0,0 +1,70 @@
+import io
+import json
+import os
+import posixpath
+import threading
+import time
+import zipfile
+
+# runs in the package check processes, keep its imports to the standard library
+
+MANIFEST = "META-INF/reports.json"
+
+def watch(parent: int):
+    """ Exit once the worker that started this process is gone, a worker killed by a signal never stops its pool """
+    def run():
+        while True:
+            time.sleep(1.0)
+            try:
+                os.kill(parent, 0)
+            except ProcessLookupError:
+                os._exit(0)
+
+    threading.Thread(target=run, name="parent-watch", daemon=True).start()
+
+def signatures(document) -> list:
+    """ Signatures listed in a parsed manifest, each with the file, aid and sigs it signs """
+    info = document.get("documentInfo") if isinstance(document, dict) else None
+    listed = info.get("signatures") if isinstance(info, dict) else None
+    return listed if isinstance(listed, list) else []
+
+def inspect(data: bytes):
+    """ Why a report package can not be verified, or None if it looks well formed
+
+    A package is a zip with a directory holding META-INF/reports.json and the reports it
+    signs, each signature naming its file relative to META-INF. Every report must be signed
+    and every member must pass its CRC check.
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = {info.filename for info in archive.infolist() if not info.is_dir()}
+            manifests = sorted(name for name in names if name == MANIFEST or name.endswith("/" + MANIFEST))
+            if not manifests:
+                return "No manifest file found in report package"
+            manifest = manifests[0]
+            try:
+                listed = signatures(json.loads(archive.read(manifest)))
+            except ValueError:
+                return "Manifest file is not valid JSON"
+            if not listed:
+                return "No signatures found in manifest file"
+            signed = set()
+            for signature in listed:
+                if not isinstance(signature, dict) or not signature.get("file") or not signature.get("sigs"):
+                    return "Manifest file lists a signature without its file or sigs"
+                name = posixpath.normpath(posixpath.join(posixpath.dirname(manifest), signature["file"]))
+                if name not in names:
+                    return f"Signed file {signature['file']} not found in report package"
+                signed.add(name)
+            reports = {name for name in names if "/META-INF/" not in "/" + name}
+            if len(reports) != len(signed):
+                return f"{len(reports)} files in report package but {len(signed)} signed in manifest file"
+            unsigned = sorted(reports - signed)
+            if unsigned:
+                return f"File {unsigned[0]} in report package is not signed"
+            corrupt = archive.testzip()
+            if corrupt is not None:
+                return f"Report package is corrupt at {corrupt}"
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, OSError, NotImplementedError, RuntimeError):
+        return "Report is not a valid zip file"
+    return None
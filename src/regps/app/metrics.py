@@ -0,0 +1,98 @@
+import falcon
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY
+from prometheus_client import generate_latest, multiprocess
+
+# settings are read here and not with app.verifier.setting, which times its calls with this module
+# directory shared by the worker processes, set it to aggregate the metrics of every gunicorn worker
+multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+requests_total = Counter("regps_requests_total", "HTTP requests handled",
+                         ["route", "method", "status"])
+request_seconds = Histogram("regps_request_seconds", "Time spent handling HTTP requests",
+                            ["route", "method", "status"], buckets=latency_buckets)
+requests_in_flight = Gauge("regps_requests_in_flight", "HTTP requests being handled",
+                           multiprocess_mode="livesum")
+upstream_seconds = Histogram("regps_upstream_seconds", "Time spent in calls to the verifier",
+                             ["endpoint", "method", "status"], buckets=latency_buckets)
+upstream_rejected_total = Counter("regps_upstream_rejected_total",
+                                  "Calls to the verifier turned away by an open circuit or the call limit",
+                                  ["endpoint", "reason"])
+circuit_state = Gauge("regps_circuit_state", "Circuit of each verifier endpoint, 0 closed, 1 half-open, 2 open",
+                      ["endpoint"], multiprocess_mode="livemax")
+verifier_up = Gauge("regps_verifier_up", "Verifier instances passing their health checks, 1 up and 0 down",
+                    ["host"], multiprocess_mode="livemin")
+quota_rejected_total = Counter("regps_quota_rejected_total",
+                               "Logins and uploads answered 429, over an AID's rate or with too many waiting",
+                               ["reason"])
+scheduler_waiting = Gauge("regps_scheduler_waiting", "Logins and uploads waiting for a verifier slot",
+                          multiprocess_mode="livesum")
+header_verification_seconds = Histogram("regps_header_verification_seconds",
+                                        "Time spent verifying signed request headers",
+                                        buckets=latency_buckets)
+header_verifications_total = Counter("regps_header_verifications_total",
+                                     "Signed header verifications by where they were decided",
+                                     ["source"])
+poll_iterations = Histogram("regps_poll_iterations", "Verifier calls made polling a login or upload",
+                            ["kind", "final"], buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64))
+package_checks_total = Counter("regps_package_checks_total",
+                               "Report packages checked before posting them, by passed, failed or skipped",
+                               ["outcome"])
+upload_bytes = Histogram("regps_upload_bytes", "Size of uploaded reports",
+                         buckets=tuple(1024 * 4 ** i for i in range(12)))
+
+def registry():
+    if multiproc_dir:
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    return REGISTRY
+
+def mark_process_dead(pid: int):
+    """ Drop the live gauges of an exited worker from the multiprocess metrics """
+    if multiproc_dir:
+        multiprocess.mark_process_dead(pid)
+
+def route(req) -> str:
+    # the route template keeps the label count bounded, unlike the path with its AIDs and digests,
+    # falcon sets it on the request from 4.0
+    return req.uri_template or "unmatched"
+
+class Metrics(object):
+    """ Counts and times every request by route, method and status """
+
+    def process_request(self, req, resp):
+        req.context.started = time.perf_counter()
+        requests_in_flight.inc()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        started = getattr(req.context, "started", None)
+        if started is None:
+            return
+        requests_in_flight.dec()
+        labels = (route(req), req.method, str(falcon.http_status_to_code(resp.status)))
+        requests_total.labels(*labels).inc()
+        request_seconds.labels(*labels).observe(time.perf_counter() - started)
+
+class AsyncMetrics(Metrics):
+
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super().process_response(req, resp, resource, req_succeeded)
+
+class MetricsResource(object):
+
+    def on_get(self, req, resp):
+        resp.data = generate_latest(registry())
+        resp.content_type = CONTENT_TYPE_LATEST
+
+class AsyncMetricsResource(object):
+
+    async def on_get(self, req, resp):
+        resp.data = generate_latest(registry())
+        resp.content_type = CONTENT_TYPE_LATEST
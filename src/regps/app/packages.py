@@ -0,0 +1,176 @@
+import asyncio
+import atexit
+import concurrent.futures
+import falcon
+import io
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from app import manifest
+from app.metrics import package_checks_total
+from app.spool import ReportSpool, upload_part
+from app.tracing import span
+from app.verifier import setting
+
+logger = logging.getLogger(__name__)
+
+# check the structure and manifest of report packages before they are posted to the verifier
+package_check = setting('PACKAGE_CHECK', "true").lower() in ("true", "1")
+# processes checking packages for each worker
+package_workers = setting('PACKAGE_WORKERS', 2, int)
+# checks a worker has waiting or running, the packages past it are posted without one
+package_pending = setting('PACKAGE_PENDING', 8, int)
+# seconds a check may take before the package is posted without it
+package_timeout = setting('PACKAGE_TIMEOUT', 10.0, float)
+# packages larger than this many bytes are posted without a check, a checked package is read into
+# memory and copied to the pool, so a worker holds up to pending times this many bytes for checks
+package_max_size = setting('PACKAGE_MAX_SIZE', 8 * 1024 * 1024, int)
+
+def package(contype: str, report):
+    """ The zip of a report with its file name and content type, its body or the "upload" part of a form
+
+    report is bytes or a ReportSpool. Returns None when there is no zip to check.
+    """
+    contype = contype or ""
+    size = report.size if isinstance(report, ReportSpool) else len(report)
+    if size > package_max_size:
+        return None
+    if isinstance(report, ReportSpool):
+        if not report.multipart:
+            return report.read(), None, contype
+        part = report.upload_part()
+    elif contype.startswith(falcon.MEDIA_MULTIPART):
+        part = upload_part(io.BytesIO(report), contype, len(report))
+    else:
+        return report, None, contype
+    if part is None:
+        return None
+    return part.stream.read(), part.filename, part.content_type
+
+def failed(aid: str, dig: str, filename, contype: str, size: int, message: str) -> dict:
+    """ Result of a package that failed its check, answered like the verifier answers a failed report """
+    return {"status_code": falcon.http_status_to_code(falcon.HTTP_200),
+            "text": json.dumps({"submitter": aid, "filename": filename or dig, "status": "failed",
+                                "contentType": contype, "size": size, "message": message}),
+            "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+class PackageChecker(object):
+    """ Checks report packages in a pool of processes, so zip work does not hold up the requests
+
+    check() and acheck() return the failed result of a package that can not be verified, or None
+    if it may be posted to the verifier. At most pending checks are queued for the pool, and a
+    package is posted unchecked when there are more or its check takes longer than timeout.
+    The pool is started with the first check of a process, a forked pool does not work.
+    """
+
+    def __init__(self, enabled=None, workers=None, pending=None, timeout=None):
+        self.enabled = package_check if enabled is None else enabled
+        self.workers = package_workers if workers is None else workers
+        self.limit = package_pending if pending is None else pending
+        self.timeout = package_timeout if timeout is None else timeout
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pending = threading.BoundedSemaphore(self.limit)
+
+    def _submit(self, data: bytes):
+        """ Future of the check of data, or None when the pool has no room for it """
+        if not self.pending.acquire(blocking=False):
+            return None
+        try:
+            with self.lock:
+                if self.pool is None:
+                    # forking a worker running request threads can copy locks they hold
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                    self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context,
+                                                                       initializer=manifest.watch,
+                                                                       initargs=(os.getpid(),))
+                future = self.pool.submit(manifest.inspect, data)
+        except Exception:
+            self.pending.release()
+            raise
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def close(self):
+        # the pool processes outlive a worker exiting without a shutdown
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _broken(self, e: Exception):
+        logger.warning("PackageChecker.check: pool failed, restarting it %s", e)
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _outcome(self, aid: str, dig: str, found, size: int, message) -> dict:
+        if message is None:
+            package_checks_total.labels("passed").inc()
+            return None
+        _, filename, contype = found
+        logger.warning("PackageChecker.check: %s %s failed %s", aid, dig, message)
+        package_checks_total.labels("failed").inc()
+        return failed(aid, dig, filename, contype, size, message)
+
+    def _skip(self, aid: str, dig: str, reason: str):
+        logger.info("PackageChecker.check: posting %s %s unchecked, %s", aid, dig, reason)
+        package_checks_total.labels("skipped").inc()
+        return None
+
+    def check(self, aid: str, dig: str, contype: str, report) -> dict:
+        if not self.enabled:
+            return None
+        with span("precheck"):
+            try:
+                found = package(contype, report)
+                if found is None:
+                    return self._skip(aid, dig, "no package to check")
+                future = self._submit(found[0])
+                if future is None:
+                    return self._skip(aid, dig, "checks at capacity")
+                message = future.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                return self._skip(aid, dig, "check timed out")
+            except concurrent.futures.BrokenExecutor as e:
+                self._broken(e)
+                return self._skip(aid, dig, "check failed")
+            except Exception as e:
+                # a check that cannot be made never fails the upload, the verifier has the last word
+                logger.warning("PackageChecker.check: %s %s check failed %s", aid, dig, e)
+                return self._skip(aid, dig, "check failed")
+            return self._outcome(aid, dig, found, len(found[0]), message)
+
+    async def acheck(self, aid: str, dig: str, contype: str, report) -> dict:
+        if not self.enabled:
+            return None
+        with span("precheck"):
+            try:
+                # a large spool is read back from disk, keep that off the event loop
+                found = await asyncio.to_thread(package, contype, report)
+                if found is None:
+                    return self._skip(aid, dig, "no package to check")
+                future = self._submit(found[0])
+                if future is None:
+                    return self._skip(aid, dig, "checks at capacity")
+                message = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                return self._skip(aid, dig, "check timed out")
+            except concurrent.futures.BrokenExecutor as e:
+                self._broken(e)
+                return self._skip(aid, dig, "check failed")
+            except Exception as e:
+                logger.warning("PackageChecker.check: %s %s check failed %s", aid, dig, e)
+                return self._skip(aid, dig, "check failed")
+            return self._outcome(aid, dig, found, len(found[0]), message)
+
+packages = PackageChecker()
+atexit.register(packages.close)
+os.register_at_fork(after_in_child=packages.reset)
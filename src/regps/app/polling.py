@@ -0,0 +1,123 @@
+import asyncio
+import falcon
+import json
+import logging
+import random
+import time
+from app.metrics import poll_iterations
+from app.verifier import Unavailable, setting
+
+logger = logging.getLogger(__name__)
+
+# seconds before the first retry, grows by the backoff factor up to the max delay
+poll_first_delay = setting('POLL_FIRST_DELAY', 0.05, float)
+poll_backoff = setting('POLL_BACKOFF', 2.0, float)
+poll_max_delay = setting('POLL_MAX_DELAY', 2.0, float)
+# fraction of each delay that is randomised so pollers do not synchronise
+poll_jitter = setting('POLL_JITTER', 0.2, float)
+# overall seconds and attempts a login or upload is polled before giving up
+poll_deadline = setting('POLL_DEADLINE', 30.0, float)
+poll_max_attempts = setting('POLL_MAX_ATTEMPTS', 60, int)
+
+class Poller(object):
+    """ Polls a verifier call with exponential backoff until it is final or the deadline passes
+
+    call is a function returning the upstream response and pending a predicate telling
+    whether that response is still in progress. poll() and apoll() return a tuple of the
+    last response (None if every attempt failed) and whether it is final. The number of calls
+    made is recorded under kind. Polling stops with Unavailable once the verifier is not called.
+    """
+
+    def __init__(self, first_delay=None, backoff=None, max_delay=None, jitter=None, deadline=None,
+                 max_attempts=None):
+        self.first_delay = poll_first_delay if first_delay is None else first_delay
+        self.backoff = poll_backoff if backoff is None else backoff
+        self.max_delay = poll_max_delay if max_delay is None else max_delay
+        self.jitter = poll_jitter if jitter is None else jitter
+        self.deadline = poll_deadline if deadline is None else deadline
+        self.max_attempts = poll_max_attempts if max_attempts is None else max_attempts
+
+    def delays(self):
+        """ Yields the seconds to wait before each retry, stops at the deadline or max attempts """
+        end = time.monotonic() + self.deadline
+        delay = self.first_delay
+        for _ in range(self.max_attempts - 1):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            jittered = delay * (1 + random.uniform(-self.jitter, self.jitter))
+            yield max(0.0, min(jittered, remaining))
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def poll(self, call, pending, kind="other"):
+        attempts = 1
+        response = self._attempt(call)
+        if response is not None and not pending(response):
+            return self._done(kind, attempts, response, True)
+        for delay in self.delays():
+            time.sleep(delay)
+            attempts += 1
+            attempt = self._attempt(call)
+            response = response if attempt is None else attempt
+            if response is not None and not pending(response):
+                return self._done(kind, attempts, response, True)
+        return self._done(kind, attempts, response, False)
+
+    async def apoll(self, call, pending, kind="other"):
+        attempts = 1
+        response = await self._aattempt(call)
+        if response is not None and not pending(response):
+            return self._done(kind, attempts, response, True)
+        for delay in self.delays():
+            await asyncio.sleep(delay)
+            attempts += 1
+            attempt = await self._aattempt(call)
+            response = response if attempt is None else attempt
+            if response is not None and not pending(response):
+                return self._done(kind, attempts, response, True)
+        return self._done(kind, attempts, response, False)
+
+    @staticmethod
+    def _done(kind, attempts, response, final):
+        poll_iterations.labels(kind, str(final).lower()).observe(attempts)
+        return response, final
+
+    @staticmethod
+    def _attempt(call):
+        try:
+            return call()
+        except Unavailable:
+            raise
+        except Exception as e:
+            logger.warning("polling attempt failed: %s", e)
+            return None
+
+    @staticmethod
+    async def _aattempt(call):
+        try:
+            return await call()
+        except Unavailable:
+            raise
+        except Exception as e:
+            logger.warning("polling attempt failed: %s", e)
+            return None
+
+def not_found(response) -> bool:
+    """ The verifier answers 404 until a submitted presentation or report has been processed """
+    return response.status_code == falcon.http_status_to_code(falcon.HTTP_404)
+
+def expired(last, description: str, **fields) -> dict:
+    """ Result returned when polling hits its deadline
+
+    202 if the verifier was reachable and is still working on it, so the caller can check back
+    later, 504 if it never answered. Extra fields are added to the JSON body.
+    """
+    if last is None:
+        status = falcon.HTTP_504
+    else:
+        status = falcon.HTTP_202
+    body = {"title": status, "description": description, **fields}
+    return {"status_code": falcon.http_status_to_code(status), "text": json.dumps(body),
+            "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+poller = Poller()
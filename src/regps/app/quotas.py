@@ -0,0 +1,240 @@
+import asyncio
+import contextlib
+import falcon
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from app.cache import TTLCache
+from app.metrics import quota_rejected_total, scheduler_waiting
+from app.tracing import span
+from app.verifier import Unavailable, setting, verifier_retry_after
+
+logger = logging.getLogger(__name__)
+
+# reports each AID and logins each client address may submit per second on average, and in a burst; 0 turns quotas off
+quota_rate = setting('QUOTA_RATE', 1.0, float)
+quota_burst = setting('QUOTA_BURST', 30, int)
+# optional redis url sharing the quotas between workers and nodes
+quota_redis = setting('QUOTA_REDIS', None)
+# logins and uploads verified at the same time per worker process, the rest wait their turn
+scheduler_slots = setting('SCHEDULER_SLOTS', 16, int)
+# requests of one AID allowed to wait for a slot, and seconds a request waits for one
+scheduler_queue = setting('SCHEDULER_QUEUE', 32, int)
+scheduler_wait = setting('SCHEDULER_WAIT', 30.0, float)
+
+class OverQuota(falcon.HTTPTooManyRequests):
+    """ An AID submitted more than its quota """
+
+    def __init__(self, description: str, retry_after: int):
+        super().__init__(description=description, retry_after=retry_after)
+
+# refills the bucket of KEYS[1] and takes ARGV[3] tokens from it, returns the seconds to wait
+# before they can be taken, 0 if they were
+TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= math.min(cost, burst) then
+    tokens = tokens - cost
+else
+    wait = (math.min(cost, burst) - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+class Quotas(object):
+    """ A token bucket per AID, in redis when shared and in process otherwise
+
+    Each bucket holds up to burst tokens and refills at rate tokens a second. A request costing
+    more than burst tokens is let through once the bucket is full and leaves it in debt, so a
+    large batch delays the AID's next submissions instead of being refused forever.
+    """
+
+    def __init__(self, rate=None, burst=None, url=None, size=100000, prefix="regps:quota"):
+        self.rate = quota_rate if rate is None else rate
+        self.burst = quota_burst if burst is None else burst
+        self.buckets = TTLCache(size, self.burst / self.rate + 1 if self.rate > 0 else 1)
+        self.lock = threading.Lock()
+        url = quota_redis if url is None else url
+        self.redis = None
+        if url:
+            import redis
+            self.redis = redis.Redis.from_url(url)
+            self.script = self.redis.register_script(TAKE)
+        self.prefix = prefix
+
+    def _take_local(self, aid, cost) -> float:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(aid, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= min(cost, self.burst):
+                tokens -= cost
+            else:
+                wait = (min(cost, self.burst) - tokens) / self.rate
+            self.buckets.set(aid, (tokens, now), (self.burst - tokens) / self.rate + 1)
+            return wait
+
+    def take(self, aid: str, cost=1):
+        """ Take cost tokens from the bucket of aid, raises OverQuota if it does not have them """
+        if self.rate <= 0:
+            return
+        wait = None
+        if self.redis is not None:
+            try:
+                wait = float(self.script(keys=[f"{self.prefix}:{aid}"], args=[self.rate, self.burst, cost]))
+            except Exception as e:
+                logger.warning("Quotas.take: redis unavailable %s", e)
+        if wait is None:
+            wait = self._take_local(aid, cost)
+        if wait > 0:
+            logger.warning("Quotas.take: %s is over its quota for %.1f seconds", aid, wait)
+            quota_rejected_total.labels("rate").inc()
+            raise OverQuota(f"Too many submissions from {aid}", math.ceil(wait))
+
+    def take_login(self, addr: str):
+        """ Take a login from the bucket of the client address
+
+        Anyone can post a login naming any AID, so logins are not charged to the AID's bucket,
+        which would let them use up the uploads of someone else's AID.
+        """
+        self.take(f"login:{addr}")
+
+quotas = Quotas()
+
+class Waiter(object):
+    """ A request waiting for a slot, granted by another thread """
+
+    def __init__(self):
+        self.granted = False
+        self.event = threading.Event()
+
+    def grant(self):
+        self.event.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self.event.wait(timeout)
+
+class AsyncWaiter(Waiter):
+
+    def __init__(self):
+        self.granted = False
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def grant(self):
+        self.loop.call_soon_threadsafe(self._grant)
+
+    def _grant(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class FairScheduler(object):
+    """ Runs the verifier bound work of a worker slots at a time, taking turns between AIDs
+
+    Requests that find every slot taken wait in a queue per AID, and a freed slot goes to the
+    first request of the next AID in turn, so an AID with many requests waiting gets one slot
+    for every one each other waiting AID gets. An AID with queue_limit requests waiting is
+    answered 429 and a request that waits wait seconds is answered 503.
+    """
+
+    def __init__(self, slots=None, queue_limit=None, wait=None):
+        self.free = scheduler_slots if slots is None else slots
+        self.queue_limit = scheduler_queue if queue_limit is None else queue_limit
+        self.wait = scheduler_wait if wait is None else wait
+        self.lock = threading.Lock()
+        self.waiting = OrderedDict()
+
+    def _enqueue(self, aid, waiter) -> bool:
+        """ True if a slot was free, otherwise waiter is queued """
+        with self.lock:
+            if self.free > 0 and not self.waiting:
+                self.free -= 1
+                return True
+            queue = self.waiting.get(aid)
+            if queue is not None and len(queue) >= self.queue_limit:
+                quota_rejected_total.labels("queue").inc()
+                raise OverQuota(f"Too many requests from {aid} waiting for the verifier", verifier_retry_after)
+            self.waiting.setdefault(aid, deque()).append(waiter)
+            scheduler_waiting.inc()
+            return False
+
+    def _abandon(self, aid, waiter) -> bool:
+        """ Take a waiter that timed out off its queue, True if it was granted a slot meanwhile """
+        with self.lock:
+            if waiter.granted:
+                return True
+            queue = self.waiting[aid]
+            queue.remove(waiter)
+            if not queue:
+                del self.waiting[aid]
+            scheduler_waiting.dec()
+            return False
+
+    def release(self):
+        with self.lock:
+            if not self.waiting:
+                self.free += 1
+                return
+            aid, queue = next(iter(self.waiting.items()))
+            waiter = queue.popleft()
+            if queue:
+                # the AID takes its next turn after every other waiting AID
+                self.waiting.move_to_end(aid)
+            else:
+                del self.waiting[aid]
+            scheduler_waiting.dec()
+            waiter.granted = True
+        waiter.grant()
+
+    @contextlib.contextmanager
+    def slot(self, aid: str):
+        waiter = Waiter()
+        with span("queue"):
+            if not self._enqueue(aid, waiter) and not waiter.wait(self.wait) and not self._abandon(aid, waiter):
+                raise Unavailable("The verifier is busy", verifier_retry_after)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, aid: str):
+        waiter = AsyncWaiter()
+        with span("queue"):
+            if not self._enqueue(aid, waiter):
+                try:
+                    granted = await waiter.wait(self.wait)
+                except BaseException:
+                    # a request cancelled while it waits, by its client going away, leaves the queue
+                    # and hands on a slot it was granted meanwhile
+                    if self._abandon(aid, waiter):
+                        self.release()
+                    raise
+                if not granted and not self._abandon(aid, waiter):
+                    raise Unavailable("The verifier is busy", verifier_retry_after)
+        try:
+            yield
+        finally:
+            self.release()
+
+scheduler = FairScheduler()
@@ -0,0 +1,55 @@
+import falcon
+import json
+
+# orjson parses and serializes several times faster than json, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data):
+    """ Parse JSON from str or bytes """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj) -> bytes:
+    """ Serialize obj to JSON as utf-8 bytes """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def serialize(response) -> dict:
+    """ Result of a verifier response, keeping the body as the bytes it was received as """
+    return {"status_code": response.status_code, "data": response.content,
+            "headers": {"Content-Type": response.headers['Content-Type']}}
+
+def body(result: dict) -> bytes:
+    data = result.get("data")
+    if data is None:
+        data = result["text"].encode("utf-8")
+    return data
+
+def text(result: dict) -> str:
+    if "text" in result:
+        return result["text"]
+    return result["data"].decode("utf-8", errors="replace")
+
+def parsed(result: dict):
+    """ JSON body of a result, parsed the first time it is asked for and kept in the result
+
+    Raises ValueError if the body is not JSON.
+    """
+    if "json" not in result:
+        result["json"] = loads(body(result))
+    return result["json"]
+
+def portable(result: dict) -> dict:
+    """ result with a text body, for celery and redis which only carry JSON """
+    return {"status_code": result["status_code"], "text": text(result), "headers": result["headers"]}
+
+def respond(resp, result: dict):
+    """ Answer with result, passing its body through as is with its own content type """
+    resp.status = falcon.code_to_http_status(result["status_code"])
+    resp.data = body(result)
+    resp.content_type = result["headers"]['Content-Type']
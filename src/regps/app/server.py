@@ -0,0 +1,44 @@
+from gunicorn.app.base import BaseApplication
+import importlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# worker classes of regps start, threaded serves each worker's requests on --threads threads,
+# gevent on greenlets and asgi runs the ASGI app on an event loop per worker
+worker_classes = {
+    "sync": "sync",
+    "threaded": "gthread",
+    "gevent": "gevent",
+    "asgi": "uvicorn.workers.UvicornWorker",
+}
+
+def child_exit(server, worker):
+    from app.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+class Server(BaseApplication):
+    """ gunicorn running the WSGI app, or the ASGI app with the asgi worker class
+
+    options are gunicorn settings. With preload_app the app is imported once in the master and
+    the workers are forked with it, sharing the memory of keri and the app modules. Stores and
+    threads that do not survive a fork are reopened in each worker by the modules owning them.
+    """
+
+    def __init__(self, options: dict, worker_class="sync"):
+        self.options = dict(options, worker_class=worker_classes[worker_class], child_exit=child_exit)
+        self.target = "app.asgi" if worker_class == "asgi" else "app"
+        if worker_class in ("threaded", "gevent"):
+            # an open event stream holds a thread or greenlet of these workers, not the whole worker
+            os.environ.setdefault("EVENTS_WSGI", "true")
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        logger.info("Server.load: %s:app", self.target)
+        return importlib.import_module(self.target).app
@@ -1,14 +1,31 @@
 from app.tasks import check_login, check_upload, upload, verify_vlei, verify_req
+from app.apidoc import AsyncOpenApi, OpenApi, api_doc_enabled
+from app.events import Subscription, events_wsgi, hub, record, replay, stream
+from app.keystate import keystates, local_verification
+from app.logs import begin, bind, payload
+from app.metrics import Metrics, MetricsResource, header_verification_seconds, header_verifications_total
+from app.quotas import quotas
+from app.results import dumps, loads, parsed, respond
+from app.signatures import signature_cache, unauthorized
+from app.spool import parts, spool, spool_part
+from app.store import status_page_limit, status_pages, store
+from app.tracing import Tracing, span
+from app.tasks import async_logins, async_uploads, enqueue_login, enqueue_upload, job_pending, job_progress
+from app.tasks import batch_id, batch_max_reports, batch_status, status_entry, upload_batch, upload_index
+from app.verifier import degraded
+import contextlib
 import falcon
+import falcon.asgi
 from falcon import media
 from falcon.http_status import HTTPStatus
-import json
+import logging
 from keri import kering
 from keri.end import ending
 import os
 from swagger_ui import api_doc
 
-uploadStatus = {}
+logger = logging.getLogger(__name__)
+
 
 class AuthSigs(object):
 
@@ -18,24 +35,61 @@ class AuthSigs(object):
                      "Signify-Timestamp"]
 
     def process_request(self, req, resp):
-        print(f"Processing header verification request {req}")
-        result = self.verify(req)
+        logger.debug("Processing header verification request %s", req)
+        with header_verification_seconds.time(), span("auth"):
+            result = self.verify(req)
         if result['status_code'] >= 400:
-            resp.status = falcon.code_to_http_status(result["status_code"])
-            resp.text = result["text"]
-            resp.content_type = result["headers"]['Content-Type']
-            print(f"Header verification failed request {resp}")
+            respond(resp, result)
+            logger.warning("Header verification failed request %s", resp)
             return resp
         else :
-            print(f"Header verification succeeded {resp}")
+            logger.debug("Header verification succeeded %s", resp)
 
     def on_get(self, req, resp):
         return self.process_request(req, resp)
 
     def verify(self, req):
-        print(f"verifying req {req}")
+        logger.debug("verifying req %s", req)
+
+        signatures = self.signatures(req)
+        if not signatures:
+            return unauthorized("Request headers are not signed")
+
+        result="{'status_code': 404, 'text': '{\"title\": \"404 Not Found\", \"description\": \"No result\"}', 'headers': {'Content-Type': 'application/json'}}"
+        for aid, cig, ser, inputage in signatures:
+            rejected = signature_cache.screen(aid, inputage, cig)
+            if rejected:
+                logger.warning("AuthSigs.verify: rejected %s %s", aid, payload(rejected['text']))
+                header_verifications_total.labels("rejected").inc()
+                return rejected
+            result = signature_cache.lookup(aid, inputage, cig, ser)
+            if result is not None:
+                header_verifications_total.labels("cache").inc()
+            else:
+                logger.debug("verifying %s %s %s", aid, ser, cig)
+                source = "local"
+                if local_verification():
+                    result = keystates.verify(aid, cig, ser, inputage.keyid)
+                if result is None:
+                    source = "remote"
+                    result = verify_req(aid,cig,ser)
+                header_verifications_total.labels(source).inc()
+                logger.debug("AuthSigs.on_post: result %s", payload(result))
+                if result['status_code'] >= 400:
+                    return result
+                signature_cache.remember(aid, inputage, cig, ser, result)
 
-        headers = req.headers
+        return result
+
+    def signatures(self, req):
+        """ Build the signature base for each signify input on the request
+
+        Returns a list of (aid, signature qb64, signature base, inputage) tuples, or False if the
+        request does not carry signed headers. Only touches req.headers, req.method and
+        req.path so it serves both the WSGI and the ASGI request types.
+        """
+        # WSGI requests upper case the header names, ASGI requests lower case them
+        headers = {key.upper(): value for key, value in req.headers.items()}
         if "SIGNATURE-INPUT" not in headers or "SIGNATURE" not in headers:
             return False
 
@@ -52,7 +106,7 @@ class AuthSigs(object):
         if not inputs:
             return False
 
-        result="{'status_code': 404, 'text': '{\"title\": \"404 Not Found\", \"description\": \"No result\"}', 'headers': {'Content-Type': 'application/json'}}"
+        signatures = []
         for inputage in inputs:
             items = []
             for field in inputage.fields:
@@ -91,129 +145,322 @@ class AuthSigs(object):
             signages = ending.designature(signature)
             cig = signages[0].markers[inputage.name]
 
-            aid = req.headers['SIGNIFY-RESOURCE']
-            print(f"verifying {aid} {ser} {cig}")
-            result = verify_req(aid,cig.qb64,ser)
-            print(f"AuthSigs.on_post: result {result}")
-            if result['status_code'] >= 400:
-                return result
+            aid = headers['SIGNIFY-RESOURCE']
+            signatures.append((aid, cig.qb64, ser, inputage))
 
-        return result
+        return signatures
 
 verSig = AuthSigs()
 
 class LoginTask(object):
 
     def on_post(self, req, resp):
-        print("LoginTask.on_post")
+        logger.debug("LoginTask.on_post")
         try:
-            raw_json = req.stream.read()
-            data = json.loads(raw_json)
-            print(f"LoginTask.on_post: sending data {str(data)[:50]}...")
+            with span("body"):
+                raw_json = req.bounded_stream.read()
+            data = loads(raw_json)
+            bind(aid=data.get('aid'))
+            quotas.take_login(req.remote_addr)
+            logger.debug("LoginTask.on_post: sending data %s", payload(data))
+            if async_logins:
+                entry = enqueue_login(data['aid'], data['said'], data['vlei'])
+                logger.info("LoginTask.on_post: queued login job %s", entry['job'])
+                resp.status = falcon.HTTP_202
+                resp.data = dumps(entry)
+                resp.content_type = falcon.MEDIA_JSON
+                return
             result = verify_vlei(data['aid'], data['said'], data['vlei'])
 
-            print(f"LoginTask.on_post: received data {result['status_code']}")
-            if(result["status_code"] < 400):
-                print("Logged in user, checking status...")
-                if(data['aid'] not in uploadStatus):
-                    print("Added empty status for {}".format(data['aid']))
-                    uploadStatus[data['aid']] = []
-            resp.status = falcon.code_to_http_status(result["status_code"])
-            resp.text = result["text"]
-            resp.content_type = result["headers"]['Content-Type']
+            logger.debug("LoginTask.on_post: received data %s", result['status_code'])
+            # 202 means the verifier is still working on the presentation, the user is not logged in yet
+            if(result["status_code"] < 400 and result["status_code"] != falcon.http_status_to_code(falcon.HTTP_202)):
+                logger.debug("Logged in user, checking status...")
+                store.login(data['aid'])
+            respond(resp, result)
+        except falcon.HTTPError:
+            raise
         except Exception as e:
-            print(f"LoginTask.on_post: Exception: {e}")
+            logger.exception("LoginTask.on_post: Exception: %s", e)
             resp.text = f"Exception: {e}"
             resp.status = falcon.HTTP_500
             
     def on_get(self, req, resp, aid):
-        print("LoginTask.on_get")
+        logger.debug("LoginTask.on_get")
         try:
-            print(f"LoginTask.on_get: sending aid {aid}")
+            logger.debug("LoginTask.on_get: sending aid %s", aid)
             result = check_login(aid)
-            print(f"LoginTask.on_get: received data {result}")
-            resp.status = falcon.code_to_http_status(result["status_code"])
-            resp.text = result["text"]
-            resp.content_type = result["headers"]['Content-Type']
+            logger.debug("LoginTask.on_get: received data %s", payload(result))
+            # logins finished by a celery worker are only seen here
+            if(result["status_code"] == falcon.http_status_to_code(falcon.HTTP_200)):
+                store.login(aid)
+            respond(resp, result)
+        except falcon.HTTPError:
+            raise
         except Exception as e:
-            print(f"LoginTask.on_get: Exception: {e}")
+            logger.exception("LoginTask.on_get: Exception: %s", e)
             resp.text = f"Exception: {e}"
             resp.status = falcon.HTTP_500
             
 class UploadTask(object):
         
     def on_post(self, req, resp, aid, dig):
-        print("UploadTask.on_post {}".format(req))
+        logger.debug("UploadTask.on_post %s", req)
         sig_check = verSig.process_request(req, resp)
         if sig_check:
-            print(f"UploadTask.on_post: Invalid signature on headers")
+            logger.warning("UploadTask.on_post: Invalid signature on headers")
             return sig_check
         try:
-            raw = req.bounded_stream.read()
-            print(f"UploadTask.on_post: request for {aid} {dig} {raw} {req.content_type}")
-            result = upload(aid, dig, req.content_type, raw)
-            print(f"UploadTask.on_post: received data {result}")
-
-            resp.status = falcon.code_to_http_status(result["status_code"])
-            resp.text = result["text"]
-            resp.content_type = result["headers"]['Content-Type']
-            # add to status dict
-            if(aid not in uploadStatus):
-                print(f"UploadTask.on_post: Error aid not logged in {aid}")
-                resp.text = f"AID not logged in: {aid}"
-                resp.status = falcon.HTTP_401    
-            else:    
-                print(f"UploadTask.on_post added uploadStatus for {aid}: {dig}")
-                uploadStatus[f"{aid}"].append(json.loads(resp.text))
+            quotas.take(aid)
+            # the body is spooled and its digest checked before anything is sent to the verifier
+            with span("body"):
+                report, rejected = spool(req.bounded_stream, dig, req.content_type, req.content_length)
+            with report:
+                logger.debug("UploadTask.on_post: request for %s %s %s bytes %s", aid, dig, report.size, req.content_type)
+                if rejected:
+                    logger.warning("UploadTask.on_post: rejected %s %s %s", aid, dig, payload(rejected['text']))
+                    respond(resp, rejected)
+                    return
+                # digests the verifier already decided are answered by upload() straight away
+                if async_uploads and upload_index.result(aid, dig) is None:
+                    if(not store.logged_in(aid)):
+                        logger.warning("UploadTask.on_post: Error aid not logged in %s", aid)
+                        resp.text = f"AID not logged in: {aid}"
+                        resp.status = falcon.HTTP_401
+                        return
+                    entry = enqueue_upload(aid, dig, req.content_type, report.read())
+                    logger.info("UploadTask.on_post: queued upload job %s for %s: %s", entry['job'], aid, dig)
+                    record(aid, dig, entry)
+                    resp.status = falcon.HTTP_202
+                    resp.data = dumps(entry)
+                    resp.content_type = falcon.MEDIA_JSON
+                    return
+                result = upload(aid, dig, req.content_type, report)
+                logger.debug("UploadTask.on_post: received data %s", payload(result))
+
+                respond(resp, result)
+                # add to status dict
+                if(not store.logged_in(aid)):
+                    logger.warning("UploadTask.on_post: Error aid not logged in %s", aid)
+                    resp.text = f"AID not logged in: {aid}"
+                    resp.status = falcon.HTTP_401    
+                else:    
+                    logger.debug("UploadTask.on_post added uploadStatus for %s: %s", aid, dig)
+                    # replaces the entry of an earlier upload of the digest
+                    record(aid, dig, parsed(result))
+        except falcon.HTTPError:
+            raise
         except Exception as e:
-            print(f"UploadTask.on_post: Exception: {e}")
+            logger.exception("UploadTask.on_post: Exception: %s", e)
             resp.text = f"Exception: {e}"
             resp.status = falcon.HTTP_500
             
     def on_get(self, req, resp, aid, dig):
-        print("UploadTask.on_get")
+        logger.debug("UploadTask.on_get")
         sig_check = verSig.process_request(req, resp)
         if sig_check:
-            print(f"UploadTask.on_post: Invalid signature on headers")
+            logger.warning("UploadTask.on_post: Invalid signature on headers")
             return sig_check
         try:
-            print(f"UploadTask.on_get: sending aid {aid} for dig {dig}")
+            entry = store.find(aid, dig)
+            if entry is not None and job_pending(entry):
+                entry = job_progress(entry)
+                record(aid, dig, entry)
+                if job_pending(entry):
+                    logger.debug("UploadTask.on_get: upload job %s is %s", entry['job'], entry['status'])
+                    resp.status = falcon.HTTP_202
+                    resp.data = dumps(entry)
+                    resp.content_type = falcon.MEDIA_JSON
+                    return
+            logger.debug("UploadTask.on_get: sending aid %s for dig %s", aid, dig)
             result = check_upload(aid, dig)
-            print(f"UploadTask.on_get: received data {result}")
-            resp.status = falcon.code_to_http_status(result["status_code"])
-            resp.text = result["text"]
-            resp.content_type = result["headers"]['Content-Type']
+            logger.debug("UploadTask.on_get: received data %s", payload(result))
+            respond(resp, result)
+        except falcon.HTTPError:
+            raise
         except Exception as e:
-            print(f"UploadTask.on_get: Exception: {e}")
+            logger.exception("UploadTask.on_get: Exception: %s", e)
             resp.text = f"Exception: {e}"
             resp.status = falcon.HTTP_500
 
 class StatusTask(object):   
              
     def on_get(self, req, resp, aid):
-        print(f"StatusTask.on_get request {req}")
+        logger.debug("StatusTask.on_get request %s", req)
         sig_check = verSig.process_request(req, resp)
         if sig_check:
-            print(f"UploadTask.on_post: Invalid signature on headers")
+            logger.warning("UploadTask.on_post: Invalid signature on headers")
             return sig_check
+        cursor, limit, since = page_params(req)
         try:
-            print(f"StatusTask.on_get: aid {aid}")
-            if(aid not in uploadStatus):
-                print(f"UploadTask.on_post: Cannot find status for {aid}")
+            logger.debug("StatusTask.on_get: aid %s", aid)
+            if async_uploads:
+                refresh_jobs(aid)
+            version = store.version(aid)
+            if version is None:
+                logger.warning("StatusTask.on_get: Cannot find status for %s", aid)
                 resp.text = f"AID not logged in: {aid}"
                 resp.status = falcon.HTTP_401
             else:
-                result = uploadStatus[f"{aid}"]
-                print(f"StatusTask.on_get: received data {result}")
-                resp.status = falcon.HTTP_200
-                resp.text = json.dumps({f"{aid}":result})
-                if not result:
-                    print(f"Empty upload status list for aid {aid}")
+                status_page(req, resp, aid, version, cursor, limit, since)
         except Exception as e:
-            print(f"StatusTask.on_get: Exception: {e}")
+            logger.exception("StatusTask.on_get: Exception: %s", e)
             resp.text = f"Exception: {e}"
             resp.status = falcon.HTTP_500
 
+def refresh_jobs(aid):
+    """ Update the entries of aid whose celery jobs moved on since they were stored """
+    for entry in store.entries(aid):
+        if job_pending(entry):
+            progress = job_progress(entry)
+            if progress != entry:
+                record(aid, entry["dig"], progress)
+
+class BatchTask(object):
+    """ Several reports of an AID under one signed request, as multipart parts named by their digests
+
+    The headers are verified once and the reports posted to the verifier batch_concurrency at a
+    time. The answer aggregates the results, and the batch id in it can be checked later.
+    """
+
+    def on_post(self, req, resp, aid):
+        logger.debug("BatchTask.on_post %s", req)
+        sig_check = verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("BatchTask.on_post: Invalid signature on headers")
+            return sig_check
+        try:
+            if(not store.logged_in(aid)):
+                logger.warning("BatchTask.on_post: Error aid not logged in %s", aid)
+                resp.text = f"AID not logged in: {aid}"
+                resp.status = falcon.HTTP_401
+                return
+            with contextlib.ExitStack() as spools:
+                digs, reports, rejected = [], [], []
+                for part in parts(req.bounded_stream, req.content_type, req.content_length):
+                    if not part.name:
+                        raise falcon.HTTPBadRequest(description="Every report must be named by its digest")
+                    if len(digs) == batch_max_reports:
+                        raise falcon.HTTPPayloadTooLarge(description=f"More than {batch_max_reports} reports in a batch")
+                    report, rejection = spool_part(part)
+                    spools.enter_context(report)
+                    digs.append(part.name)
+                    if rejection:
+                        logger.warning("BatchTask.on_post: rejected %s %s %s", aid, part.name, payload(rejection['text']))
+                        rejected.append(status_entry(rejection, submitter=aid, dig=part.name))
+                    else:
+                        reports.append((part.name, report.form, report))
+                if not digs:
+                    raise falcon.HTTPBadRequest(description="No reports in the batch")
+                quotas.take(aid, len(digs))
+                batch = batch_id(digs)
+                logger.info("BatchTask.on_post: batch %s of %s reports from %s", batch, len(digs), aid)
+                if async_uploads:
+                    for dig, contype, report in reports:
+                        record(aid, dig, enqueue_upload(aid, dig, contype, report.read(), batch))
+                    resp.status = falcon.HTTP_202
+                else:
+                    for (dig, _, _), result in zip(reports, upload_batch(aid, reports)):
+                        record(aid, dig, status_entry(result, submitter=aid, batch=batch))
+                    resp.status = falcon.HTTP_200
+            resp.data = dumps(batch_status(aid, batch, [dict(entry, batch=batch) for entry in rejected]))
+            resp.content_type = falcon.MEDIA_JSON
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            logger.exception("BatchTask.on_post: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+    def on_get(self, req, resp, aid, batch):
+        logger.debug("BatchTask.on_get")
+        sig_check = verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("BatchTask.on_get: Invalid signature on headers")
+            return sig_check
+        try:
+            if async_uploads:
+                refresh_jobs(aid)
+            result = batch_status(aid, batch)
+            if result is None:
+                resp.status = falcon.HTTP_404
+                resp.text = f"Unknown batch {batch} of {aid}"
+                return
+            resp.status = falcon.HTTP_200
+            resp.data = dumps(result)
+            resp.content_type = falcon.MEDIA_JSON
+        except Exception as e:
+            logger.exception("BatchTask.on_get: Exception: %s", e)
+            resp.text = f"Exception: {e}"
+            resp.status = falcon.HTTP_500
+
+class EventsTask(object):
+    """ Login and upload events of an AID as server-sent events
+
+    A client reconnecting with Last-Event-ID first gets the upload entries changed after it.
+    A stream would hold a sync worker for its whole life, so without events_wsgi they are
+    left to the ASGI app and clients poll /status with since instead.
+    """
+
+    def on_get(self, req, resp, aid):
+        logger.debug("EventsTask.on_get request %s", req)
+        if not events_wsgi:
+            raise falcon.HTTPNotImplemented(description="Event streams are served by the ASGI app, "
+                                                        f"poll /status/{aid}?since={{seq}} instead")
+        sig_check = verSig.process_request(req, resp)
+        if sig_check:
+            logger.warning("EventsTask.on_get: Invalid signature on headers")
+            return sig_check
+        subscription = Subscription(aid)
+        hub.subscribe(subscription)
+        logger.debug("EventsTask.on_get: subscribed to %s", aid)
+        resp.content_type = "text/event-stream"
+        resp.cache_control = ["no-cache"]
+        resp.set_header("X-Accel-Buffering", "no")
+        resp.stream = stream(subscription, replay(aid, req.get_header("Last-Event-ID")))
+
+def page_params(req):
+    """ cursor, limit and since of a /status request, falcon answers 400 to invalid ones """
+    return (req.get_param_as_int("cursor", min_value=0, default=0),
+            req.get_param_as_int("limit", min_value=1, max_value=status_page_limit, default=status_page_limit),
+            req.get_param_as_int("since", min_value=0))
+
+def status_page(req, resp, aid, version, cursor=0, limit=None, since=None):
+    """ Answer a /status page of aid at version, or 304 if the client has it """
+    if not not_modified(req, resp, aid, version, cursor, limit, since):
+        answer_page(resp, status_pages.page(aid, version, cursor, limit, since))
+
+def not_modified(req, resp, aid, version, cursor=0, limit=None, since=None) -> bool:
+    """ Set the ETag of a /status page, and answer 304 and return True if the client has it """
+    etag = status_pages.etag(aid, version, cursor, limit, since)
+    resp.etag = etag
+    resp.cache_control = ["no-cache"]
+    resp.set_header("X-Status-Seq", str(version))
+    if etag in (req.get_header("If-None-Match") or ""):
+        logger.debug("StatusTask.on_get: %s unchanged at %s", aid, version)
+        resp.status = falcon.HTTP_304
+        return True
+    return False
+
+def answer_page(resp, page):
+    """ Answer a serialized /status page and the cursor of the next one """
+    body, after = page
+    if after is not None:
+        resp.set_header("X-Next-Cursor", str(after))
+    logger.debug("StatusTask.on_get: page %s", payload(body))
+    resp.status = falcon.HTTP_200
+    resp.content_type = falcon.MEDIA_JSON
+    resp.data = body
+
+class RequestContext(object):
+    """ Starts the log context of each request, with its request id and the aid and dig in its path """
+
+    def process_request(self, req, resp):
+        resp.set_header('X-Request-ID', begin(req.get_header('X-Request-ID')))
+
+    def process_resource(self, req, resp, resource, params):
+        bind(aid=params.get("aid"), dig=params.get("dig"))
+
 class HandleCORS(object):
     def process_request(self, req, resp):
         resp.set_header('Access-Control-Allow-Origin', '*')
@@ -225,11 +472,12 @@ class HandleCORS(object):
 
 class PingResource:
    def on_get(self, req, resp):
-      """Handles GET requests"""
+      """Handles GET requests, answers 200 even when calls to the verifier are being turned away"""
       resp.status = falcon.HTTP_200
       resp.content_type = falcon.MEDIA_TEXT
+      reasons = degraded()
       resp.text = (
-         'Pong'
+         'Pong' if not reasons else f"Pong, degraded: {'; '.join(reasons)}"
       )
 
 def getRequiredParam(body, name):
@@ -240,155 +488,44 @@ def getRequiredParam(body, name):
     return param
 
 def swagger_ui(app):
-    vlei_contents = None
-    with open('app/data/credential.cesr', 'r') as cfile:
-        vlei_contents = cfile.read()
-
-    report_zip = None
-    with open('app/data/report.zip', 'rb') as rfile:        
-        report_zip = rfile
-
-    config = {"openapi":"3.0.1",
-            "info":{"title":"Regulator portal service api","description":"Regulator web portal service api","version":"1.0.0"},
-            "servers":[{"url":"http://127.0.0.1:8000","description":"local server"}],
-            "tags":[{"name":"default","description":"default tag"}],
-            "paths":{"/ping":{"get":{"tags":["default"],"summary":"output pong.","responses":{"200":{"description":"OK","content":{"application/text":{"schema":{"type":"object","example":"Pong"}}}}}}},
-                    "/login":{"post":{"tags":["default"],
-                                        "summary":"Given an AID and vLEI, returns information about the login",
-                                        "requestBody":{"required":"true","content":{"application/json":{"schema":{"type":"object","properties":{
-                                            "aid":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
-                                            "said":{"type":"string","example":"EAPHGLJL1s6N4w1Hje5po6JPHu47R9-UoJqLweAci2LV"},
-                                            "vlei":{"type":"string","example":f"{vlei_contents}"}
-                                            }}}}},
-                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
-                                            "aid": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
-                                            "said": "EBdaAMrpqfB0PlTgI3juS8UFgIPAXC1NZd1jSk6acenf"
-                                        }}}}}}
-                                        }},
-                    "/checklogin/{aid}":{"get":{"tags":["default"],
-                                        "summary":"Given an AID returns information about the login",
-                                        "parameters":[{"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"}],
-                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
-                                            "aid": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
-                                            "said": "EBdaAMrpqfB0PlTgI3juS8UFgIPAXC1NZd1jSk6acenf"
-                                        }}}}}}
-                                        }},
-                    "/upload/{aid}/{dig}":{"post":{"tags":["default"],
-                                        "summary":"Given an AID and DIG, returns information about the upload",
-                                        "parameters":[
-                                                    {"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"},
-                                                      {"in":"path","name":"dig","required":"true","schema":{"type":"string","minimum":1,"example":"EC7b6S50sY26HTj6AtQiWMDMucsBxMvThkmrKUBXVMf0"},"description":"The digest of the upload"},
-                                                    {"in":"header","name":"Signature","required":"true",
-                                                    "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BCLs_wv3X6YFoFhB7acH_BePXS7zjBJPvuChdr01cM60Igf_sxYsah9sLHP-pMSYFs1Y6zYUo58HVG8tRd4X1IC\""},
-                                                    "description":"The signature of the data"},
-                                                    {"in":"header","name":"Signature-Input","required":"true",
-                                                    "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690462814;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
-                                                    "description":"The signature of the data"},
-                                                    {"in":"header","name":"Signify-Resource","required":"true",
-                                                    "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
-                                                    "description":"The aid that siged the data"},
-                                                    {"in":"header","name":"signify-timestamp","required":"true",
-                                                    "schema":{"type":"string","example":"2023-07-27T13:00:14.802000+00:00"},
-                                                    "description":"The timestamp of the data"}  
-                                                      ],
-                                        "requestBody":{"required":"true","content":{"multipart/form-data":{"schema":{"type":"object","properties":{
-                                            "upload":{"type":"string","format":"binary","example":f"{report_zip}"}
-                                            }}}}},
-                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
-                                            "submitter": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
-                                            "filename": "test_ifgroup2023.zip",
-                                            "status": "verified",
-                                            "contentType": "application/zip",
-                                            "size": 4467,
-                                            "message": "All 6 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk)."
-                                        }}}}}},
-                                        }},
-                    # "/checkupload/{aid}/{dig}":{"get":{"tags":["default"],
-                    #                     "summary":"Given an AID and DIG returns information about the upload status",
-                    #                     "parameters":[{"in":"path","name":"aid","required":"true","schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},"description":"The AID"},
-                    #                                   {"in":"path","name":"dig","required":"true","schema":{"type":"string","minimum":1,"example":"EAPHGLJL1s6N4w1Hje5po6JPHu47R9-UoJqLweAci2LV"},"description":"The digest of the upload"}],
-                    #                     "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
-                    #                                             "submitter": "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk",
-                    #                                             "filename": "DUMMYLEI123456789012.IND_FR_IF010200_IFTM_2022-12-31_20220222134211000.zip",
-                    #                                             "status": "failed",
-                    #                                             "contentType": "application/zip",
-                    #                                             "size": 3390,
-                    #                                             "message": "No signatures found in manifest file"
-                    #                     }}}}}},
-                    #                     }},
-                    "/status/{aid}":{"get":{"tags":["default"],
-                                        "summary":"Given an AID returns information about the upload status",
-                                        "parameters":[
-                                            {"in":"header","name":"Signature","required":"true",
-                                             "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BAbJnlOwYCgQ-1SExPKoPR8AyF2luTrP207oFRSOqKNwpYIviOgA-Fp4Z11At2f3NWBwUbQRWEB8Tu3es1l_QUI\""},
-                                             "description":"The signature of the data"},
-                                            {"in":"header","name":"Signature-Input","required":"true",
-                                             "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690386592;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
-                                             "description":"The signature of the data"},
-                                            {"in":"header","name":"Signify-Resource","required":"true",
-                                             "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
-                                             "description":"The aid that siged the data"},
-                                            {"in":"header","name":"signify-timestamp","required":"true",
-                                             "schema":{"type":"string","example":"2023-07-26T15:49:52.571000+00:00"},
-                                             "description":"The timestamp of the data"},
-                                            {"in":"path","name":"aid","required":"true",
-                                             "schema":{"type":"string","minimum":1,"example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
-                                             "description":"The AID"}
-                                        ],
-                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{
-                                            "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk": [
-                                                "{\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"filename\": \"test_MetaInfReportJson_noSigs.zip\", \"status\": \"failed\", \"contentType\": \"application/zip\", \"size\": 3059, \"message\": \"5 files from report package not signed {'parameters.csv', 'FilingIndicators.csv', 'report.json', 'i_10.01.csv', 'i_10.02.csv'}, []\"}",
-                                                "{\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"filename\": \"test_ifclass3.zip\", \"status\": \"verified\", \"contentType\": \"application/zip\", \"size\": 5662, \"message\": \"All 9 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk).\"}",
-                                                "{\"submitter\": \"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk\", \"filename\": \"test_ifgroup2023.zip\", \"status\": \"verified\", \"contentType\": \"application/zip\", \"size\": 4467, \"message\": \"All 6 files in report package have been signed by submitter (EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk).\"}"
-                                            ]
-                                            }}}}}},
-                                        }},
-                    "/verify/header":{"get":{"tags":["default"],
-                                        "summary":"returns if the headers are properly signed",
-                                        "parameters":[
-                                            {"in":"header","name":"Signature","required":"true",
-                                             "schema":{"type":"string","example":"indexed=\"?0\";signify=\"0BB86jS2w9PKL1t-5hZIxgF9-vMNz4DsoASJR_f-u8FvnywdvosPOqbXUo97LuS-pYH_K_BPpfA2Y0XsGb2pSBoL\""},
-                                             "description":"The signature of the data"},
-                                            {"in":"header","name":"Signature-Input","required":"true",
-                                             "schema":{"type":"string","example":"signify=(\"@method\" \"@path\" \"signify-resource\" \"signify-timestamp\");created=1690922901;keyid=\"BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9\";alg=\"ed25519\""},
-                                             "description":"The signature of the data"},
-                                            {"in":"header","name":"Signify-Resource","required":"true",
-                                             "schema":{"type":"string","example":"EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"},
-                                             "description":"The signature of the data"},
-                                            {"in":"header","name":"Signify-Timestamp","required":"true",
-                                             "schema":{"type":"string","example":"2023-08-01T20:48:21.885000+00:00"},
-                                             "description":"The signature of the data"}
-                                        ],
-                                        "responses":{"200":{"description":"OK","content":{"application/json":{"schema":{"type":"object","example":{}}}}}},
-                                        }},
-                    }}
-
-    doc = api_doc(app, config=config, url_prefix='/api/doc', title='API doc', editor=True)
+    """ Serve swagger ui at /api/doc, the OpenAPI document itself is only built when it is first requested """
+    if not api_doc_enabled:
+        logger.info("API doc disabled")
+        return None
+    openapi = AsyncOpenApi() if isinstance(app, falcon.asgi.App) else OpenApi()
+    app.add_route('/api/doc/swagger.json', openapi)
+    doc = api_doc(app, config_rel_url='/swagger.json', url_prefix='/api/doc', title='API doc', editor=True)
     return doc
 
 def falcon_app():    
     app = falcon.App(middleware=falcon.CORSMiddleware(
     allow_origins='*', allow_credentials='*',
     expose_headers=['cesr-attachment', 'cesr-date', 'content-type', 'signature', 'signature-input',
-                    'signify-resource', 'signify-timestamp']))
+                    'signify-resource', 'signify-timestamp', 'x-request-id', 'etag', 'x-status-seq',
+                    'x-next-cursor', 'server-timing']))
+    app.add_middleware([RequestContext(), Tracing(), Metrics()])
     if os.getenv("ENABLE_CORS", "false").lower() in ("true", "1"):
-        print("CORS  enabled")
+        logger.info("CORS enabled")
         app.add_middleware(middleware=HandleCORS())
     app.req_options.media_handlers.update(media.Handlers())
     app.resp_options.media_handlers.update(media.Handlers())
 
     app.add_route('/ping', PingResource())
+    app.add_route('/metrics', MetricsResource())
     app.add_route('/login', LoginTask())
     app.add_route("/checklogin/{aid}", LoginTask())
     app.add_route('/upload/{aid}/{dig}', UploadTask())
     app.add_route("/checkupload/{aid}/{dig}", UploadTask())
+    app.add_route("/uploads/{aid}", BatchTask())
+    app.add_route("/uploads/{aid}/{batch}", BatchTask())
     app.add_route("/status/{aid}", StatusTask())
+    app.add_route("/status/{aid}/events", EventsTask())
     app.add_route("/verify/header", verSig)
     
     return app
     
 def main():
-    print("Starting RegPS...")
+    logger.info("Starting RegPS...")
     app = falcon_app()
     api_doc=swagger_ui(app)
 
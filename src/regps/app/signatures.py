@@ -0,0 +1,60 @@
+import falcon
+import json
+import time
+from app.cache import TTLCache
+from app.verifier import setting
+
+# seconds either side of now a Signature-Input created time is accepted, and how long a
+# successful verification is remembered
+auth_window = setting('AUTH_WINDOW', 300, int)
+auth_cache_size = setting('AUTH_CACHE_SIZE', 10000, int)
+# reject a signature that was already presented, false answers it from the cache instead
+auth_reject_replay = setting('AUTH_REJECT_REPLAY', "true").lower() in ("true", "1")
+
+def unauthorized(description: str) -> dict:
+    return {"status_code": falcon.http_status_to_code(falcon.HTTP_401),
+            "text": json.dumps({"title": falcon.HTTP_401, "description": description}),
+            "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+class SignatureCache(object):
+    """ Successful signed header verifications, and the nonces and signatures already accepted
+
+    screen() fails stale, expired and replayed requests before they reach the verifier. An AID's
+    signature is claimed the first time it is screened, so a replay of it is rejected even while
+    the first request is still being verified.
+    Verifications are cached under the AID, key id, created time, signature and signature
+    base, and only until their created time leaves the freshness window.
+    """
+
+    def __init__(self, window=None, size=None, reject_replay=None):
+        self.window = auth_window if window is None else window
+        self.reject_replay = auth_reject_replay if reject_replay is None else reject_replay
+        size = auth_cache_size if size is None else size
+        self.verified = TTLCache(size, self.window)
+        self.seen = TTLCache(size, self.window)
+
+    def screen(self, aid, inputage, cig):
+        """ Result rejecting the signature, or None if it may be verified """
+        now = time.time()
+        if abs(now - inputage.created) > self.window:
+            return unauthorized(f"Signature created {inputage.created} is outside the {self.window}s window")
+        if inputage.expires is not None and now > inputage.expires:
+            return unauthorized(f"Signature expired at {inputage.expires}")
+        if inputage.nonce is not None and ("nonce", aid, inputage.nonce) in self.seen:
+            return unauthorized(f"Signature nonce {inputage.nonce} was already used")
+        if self.reject_replay and not self.seen.add(("sig", aid, cig), True, inputage.created + self.window - now):
+            return unauthorized("Signature was already used")
+        return None
+
+    def lookup(self, aid, inputage, cig, ser):
+        return self.verified.get((aid, inputage.keyid, inputage.created, cig, ser))
+
+    def remember(self, aid, inputage, cig, ser, result):
+        ttl = inputage.created + self.window - time.time()
+        if ttl <= 0:
+            return
+        self.verified.set((aid, inputage.keyid, inputage.created, cig, ser), result, ttl)
+        if inputage.nonce is not None:
+            self.seen.set(("nonce", aid, inputage.nonce), True, ttl)
+
+signature_cache = SignatureCache()
@@ -0,0 +1,253 @@
+import asyncio
+import falcon
+import hashlib
+import json
+import logging
+import tempfile
+import uuid
+from falcon.asgi.multipart import MultipartForm as AsyncMultipartForm
+from falcon.media.multipart import MultipartForm, MultipartParseOptions
+from falcon.util.mediatypes import parse_header
+from keri.core import coring
+from app.metrics import upload_bytes
+from app.verifier import setting
+
+logger = logging.getLogger(__name__)
+
+# report bodies larger than this many bytes are spooled to a temporary file instead of memory
+upload_spool_threshold = setting('UPLOAD_SPOOL_THRESHOLD', 1024 * 1024, int)
+# largest accepted report body, larger ones are answered 413
+upload_max_size = setting('UPLOAD_MAX_SIZE', 512 * 1024 * 1024, int)
+upload_chunk_size = setting('UPLOAD_CHUNK_SIZE', 64 * 1024, int)
+upload_spool_dir = setting('UPLOAD_SPOOL_DIR', None)
+# reject reports whose digest does not match the {dig} path parameter before they are forwarded
+upload_verify_digest = setting('UPLOAD_VERIFY_DIGEST', "true").lower() in ("true", "1")
+
+def _blake3():
+    import blake3
+    return blake3.blake3()
+
+# incremental hash for each CESR digest code
+hashers = {
+    coring.DigDex.Blake3_256: _blake3,
+    coring.DigDex.Blake3_512: _blake3,
+    coring.DigDex.Blake2b_256: lambda: hashlib.blake2b(digest_size=32),
+    coring.DigDex.Blake2b_512: lambda: hashlib.blake2b(),
+    coring.DigDex.Blake2s_256: lambda: hashlib.blake2s(),
+    coring.DigDex.SHA3_256: hashlib.sha3_256,
+    coring.DigDex.SHA3_512: hashlib.sha3_512,
+    coring.DigDex.SHA2_256: hashlib.sha256,
+    coring.DigDex.SHA2_512: hashlib.sha512,
+}
+
+def too_large(size) -> dict:
+    return {"status_code": falcon.http_status_to_code(falcon.HTTP_413),
+            "text": json.dumps({"title": falcon.HTTP_413,
+                                "description": f"Report of {size} bytes is larger than {upload_max_size} bytes"}),
+            "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+def digest_mismatch(dig) -> dict:
+    return {"status_code": falcon.http_status_to_code(falcon.HTTP_400),
+            "text": json.dumps({"title": falcon.HTTP_400, "description": f"Report does not match digest {dig}"}),
+            "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+class ReportSpool(object):
+    """ Report body kept in memory up to threshold bytes and on disk past it
+
+    The digest of the body is computed as it is written. For a multipart/form-data body the
+    digest is the one of its "upload" part, read back from the spool by check().
+    """
+
+    def __init__(self, dig: str, contype: str, threshold=None, max_size=None, directory=None):
+        self.dig = dig
+        self.contype = contype or ""
+        self.max_size = upload_max_size if max_size is None else max_size
+        self.threshold = upload_spool_threshold if threshold is None else threshold
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.threshold,
+                                                  dir=upload_spool_dir if directory is None else directory)
+        self.size = 0
+        self.expected = None
+        self.hasher = None
+        try:
+            diger = coring.Diger(qb64=dig)
+            if diger.code in hashers:
+                self.expected = diger.raw
+                self.hasher = hashers[diger.code]()
+        except Exception as e:
+            logger.warning("ReportSpool: %s is not a known digest, not checking it %s", dig, e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def multipart(self) -> bool:
+        return self.contype.startswith(falcon.MEDIA_MULTIPART)
+
+    def write(self, chunk: bytes) -> bool:
+        """ Append chunk, returns False once the body is over max_size """
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            return False
+        self.file.write(chunk)
+        if self.hasher is not None and not self.multipart:
+            self.hasher.update(chunk)
+        return True
+
+    def check(self):
+        """ Result rejecting the report, or None if it may be forwarded """
+        if self.size > self.max_size:
+            return too_large(self.size)
+        if not upload_verify_digest or self.hasher is None:
+            return None
+        if self.multipart:
+            if not self._hash_upload_part():
+                return None
+        if self.digest() != self.expected:
+            logger.warning("ReportSpool.check: %s byte report does not match %s", self.size, self.dig)
+            return digest_mismatch(self.dig)
+        return None
+
+    def digest(self) -> bytes:
+        try:
+            # blake3 produces digests of any length, hashlib ones have a fixed size
+            return self.hasher.digest(length=len(self.expected))
+        except TypeError:
+            return self.hasher.digest()
+
+    def _hash_upload_part(self) -> bool:
+        # the part is streamed back from the spool, so it is never held in memory either
+        part = self.upload_part()
+        if part is None:
+            return False
+        while chunk := part.stream.read(upload_chunk_size):
+            self.hasher.update(chunk)
+        return True
+
+    def upload_part(self):
+        """ The "upload" part of a multipart/form-data body, read from the rewound spool, or None """
+        self.file.seek(0)
+        return upload_part(self.file, self.contype, self.size)
+
+    def body(self):
+        """ Body to post with requests, the bytes of a small report or the rewound spool file
+
+        requests streams a file in blocks with its Content-Length, so the verifier does not
+        need to accept chunked transfer encoding.
+        """
+        if self.size <= self.threshold:
+            return self.read()
+        self.file.seek(0)
+        return self.file
+
+    def abody(self):
+        """ Content to post with httpx, sent with the report's Content-Length """
+        if self.size <= self.threshold:
+            return self.read()
+        return self.achunks()
+
+    def chunks(self):
+        self.file.seek(0)
+        while chunk := self.file.read(upload_chunk_size):
+            yield chunk
+
+    async def achunks(self):
+        for chunk in self.chunks():
+            yield chunk
+
+    def read(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+class PartSpool(ReportSpool):
+    """ One report of a batch upload, spooled as a multipart/form-data body with a single "upload" part
+
+    That is the form single uploads reach the verifier in. Only the report is hashed as it is
+    written, so its digest is checked without reading the body back. Post it with the form
+    content type and call finish() once the report is written.
+    """
+
+    def __init__(self, dig: str, contype: str, filename=None, **kwargs):
+        super().__init__(dig, contype or "application/octet-stream", **kwargs)
+        boundary = uuid.uuid4().hex
+        self.form = f"{falcon.MEDIA_MULTIPART}; boundary={boundary}"
+        self.tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        filename = (filename or dig).replace('"', "")
+        self._frame(f'--{boundary}\r\nContent-Disposition: form-data; name="upload"; filename="{filename}"\r\n'
+                    f'Content-Type: {self.contype}\r\n\r\n'.encode("utf-8"))
+
+    def _frame(self, data: bytes):
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        self._frame(self.tail)
+
+def upload_part(stream, contype: str, length=None):
+    """ The "upload" part of a multipart/form-data body read from stream, or None """
+    _, params = parse_header(contype or "")
+    if "boundary" not in params:
+        return None
+    options = MultipartParseOptions()
+    options.max_body_part_count = 0
+    for part in MultipartForm(stream, params["boundary"].encode(), length, options):
+        if part.name == "upload":
+            return part
+    return None
+
+def parts(stream, contype: str, length=None, asgi=False):
+    """ Parts of a multipart/form-data request body, read from the stream one after the other """
+    _, params = parse_header(contype or "")
+    if "boundary" not in params:
+        raise falcon.HTTPBadRequest(description="Expected a multipart/form-data body")
+    options = MultipartParseOptions()
+    options.max_body_part_count = 0
+    form = AsyncMultipartForm if asgi else MultipartForm
+    return form(stream, params["boundary"].encode(), length, options)
+
+def spool_part(part):
+    """ Spool a part of a batch upload, named by its digest, returns (spool, rejection) """
+    report = PartSpool(part.name, part.content_type, part.filename)
+    while chunk := part.stream.read(upload_chunk_size):
+        if not report.write(chunk):
+            break
+    report.finish()
+    upload_bytes.observe(report.size)
+    return report, report.check()
+
+async def aspool_part(part):
+    report = PartSpool(part.name, part.content_type, part.filename)
+    while chunk := await part.stream.read(upload_chunk_size):
+        if not report.write(chunk):
+            break
+    report.finish()
+    upload_bytes.observe(report.size)
+    return report, report.check()
+
+def spool(stream, dig: str, contype: str, length=None):
+    """ Spool a report from a readable stream, returns (spool, rejection) """
+    report = ReportSpool(dig, contype)
+    if length is not None and length > report.max_size:
+        return report, too_large(length)
+    while chunk := stream.read(upload_chunk_size):
+        if not report.write(chunk):
+            break
+    upload_bytes.observe(report.size)
+    return report, report.check()
+
+async def aspool(stream, dig: str, contype: str, length=None):
+    """ Spool a report from an ASGI request stream, returns (spool, rejection) """
+    report = ReportSpool(dig, contype)
+    if length is not None and length > report.max_size:
+        return report, too_large(length)
+    async for chunk in stream:
+        if not report.write(chunk):
+            break
+    upload_bytes.observe(report.size)
+    # hashing a spooled multipart body reads it back from disk, keep that off the event loop
+    return report, await asyncio.to_thread(report.check)
@@ -0,0 +1,423 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+from app.cache import TTLCache
+from app.results import dumps, loads
+from app.verifier import setting
+
+# memory keeps the status in the worker process, redis shares it across workers and nodes,
+# lmdb keeps it on disk across restarts
+status_store = setting('STATUS_STORE', "memory").lower()
+status_store_url = setting('STATUS_STORE_URL', os.environ.get('CELERY_BACKEND', "redis://127.0.0.1:6379/0"))
+status_store_path = setting('STATUS_STORE_PATH', "/usr/local/var/regps/status")
+# upload status entries kept per AID, the oldest are dropped first
+status_history = setting('STATUS_HISTORY', 100, int)
+# seconds an AID's login and upload status live after its last activity
+status_ttl = setting('STATUS_TTL', 7 * 24 * 60 * 60, int)
+# most entries returned in one /status page
+status_page_limit = setting('STATUS_PAGE_LIMIT', 1000, int)
+# serialized /status pages kept in memory
+status_page_cache = setting('STATUS_PAGE_CACHE', 1024, int)
+
+class UploadStatusStore(object):
+    """ Logged in AIDs and the upload status entries of each, indexed by AID and digest
+
+    An AID is logged in once login() is called and stays so until status_ttl seconds pass
+    without a login or upload. Entries are kept in submission order, at most status_history
+    per AID, and the latest entry for a digest can be looked up with find().
+
+    Every added or updated entry gets the next sequence number of its AID in its "seq" field,
+    and version() is the latest one, so it changes whenever the entries do. Sequences start
+    from the time the AID was first logged in, in milliseconds, so they keep growing when an
+    expired AID logs in again.
+    """
+
+    def __init__(self, history=None, ttl=None):
+        self.history = status_history if history is None else history
+        self.ttl = status_ttl if ttl is None else ttl
+
+    def after_fork(self):
+        """ Called in each worker forked from a master that opened the store """
+
+    def login(self, aid: str):
+        raise NotImplementedError
+
+    def logged_in(self, aid: str) -> bool:
+        raise NotImplementedError
+
+    def version(self, aid: str):
+        """ Latest sequence number of aid, or None if it is not logged in """
+        raise NotImplementedError
+
+    def add(self, aid: str, dig: str, entry: dict):
+        """ Append an upload status entry for dig """
+        raise NotImplementedError
+
+    def update(self, aid: str, dig: str, entry: dict):
+        """ Replace the latest entry for dig, appending it if there is none """
+        raise NotImplementedError
+
+    def entries(self, aid: str) -> list:
+        raise NotImplementedError
+
+    def find(self, aid: str, dig: str):
+        """ Latest entry for dig, or None """
+        raise NotImplementedError
+
+    def page(self, aid: str, cursor=0, limit=None, since=None):
+        """ Entries changed after sequence number cursor, at most limit, and the cursor of the next page or None
+
+        Entries are paged in the order they were added or updated, and the cursor is the seq of
+        the last entry of a page, so trimmed or updated entries do not shift the pages after them.
+        since also only pages the entries added or updated after that sequence number.
+        """
+        after = max(cursor or 0, since or 0)
+        entries = sorted((entry for entry in self.entries(aid) if entry.get("seq", 0) > after),
+                         key=lambda entry: entry.get("seq", 0))
+        if limit is None or len(entries) <= limit:
+            return entries, None
+        return entries[:limit], entries[limit - 1].get("seq", 0)
+
+class MemoryStore(UploadStatusStore):
+
+    def __init__(self, history=None, ttl=None):
+        super().__init__(history, ttl)
+        self.lock = threading.Lock()
+        self.aids = {}
+
+    def _live(self, aid):
+        record = self.aids.get(aid)
+        if record is not None and time.time() - record["seen"] > self.ttl:
+            del self.aids[aid]
+            return None
+        return record
+
+    def _evict(self):
+        now = time.time()
+        for aid in [aid for aid, record in self.aids.items() if now - record["seen"] > self.ttl]:
+            del self.aids[aid]
+
+    def login(self, aid):
+        with self.lock:
+            self._evict()
+            record = self._live(aid)
+            if record is None:
+                self.aids[aid] = {"seen": time.time(), "seq": int(time.time() * 1000), "entries": []}
+            else:
+                record["seen"] = time.time()
+
+    def logged_in(self, aid):
+        with self.lock:
+            return self._live(aid) is not None
+
+    def version(self, aid):
+        with self.lock:
+            record = self._live(aid)
+            return None if record is None else record["seq"]
+
+    def add(self, aid, dig, entry):
+        with self.lock:
+            record = self._live(aid)
+            if record is None:
+                return
+            record["seen"] = time.time()
+            record["seq"] += 1
+            record["entries"].append({**entry, "dig": dig, "seq": record["seq"]})
+            del record["entries"][:-self.history]
+
+    def update(self, aid, dig, entry):
+        with self.lock:
+            record = self._live(aid)
+            if record is None:
+                return
+            record["seen"] = time.time()
+            record["seq"] += 1
+            for i in range(len(record["entries"]) - 1, -1, -1):
+                if record["entries"][i].get("dig") == dig:
+                    record["entries"][i] = {**entry, "dig": dig, "seq": record["seq"]}
+                    return
+            record["entries"].append({**entry, "dig": dig, "seq": record["seq"]})
+            del record["entries"][:-self.history]
+
+    def entries(self, aid):
+        with self.lock:
+            record = self._live(aid)
+            return [] if record is None else list(record["entries"])
+
+    def find(self, aid, dig):
+        with self.lock:
+            record = self._live(aid)
+            if record is None:
+                return None
+            for entry in reversed(record["entries"]):
+                if entry.get("dig") == dig:
+                    return entry
+            return None
+
+# adds the entry ARGV[2], JSON without its closing brace, for digest ARGV[1] to the status list KEYS[2] of a
+# logged in AID, in place of the latest entry of the digest when ARGV[3] is 1. The digest hash KEYS[3] maps
+# each listed digest to its latest entry, digests trimmed off the list are dropped from it too
+WRITE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local seq = redis.call('INCR', KEYS[4])
+local value = ARGV[2] .. ',"seq":' .. seq .. '}'
+local previous = redis.call('HGET', KEYS[3], ARGV[1])
+local replaced = false
+if ARGV[3] == '1' and previous then
+    local values = redis.call('LRANGE', KEYS[2], 0, -1)
+    for i = #values, 1, -1 do
+        if values[i] == previous then
+            redis.call('LSET', KEYS[2], i - 1, value)
+            replaced = true
+            break
+        end
+    end
+end
+if not replaced then
+    redis.call('RPUSH', KEYS[2], value)
+    local over = redis.call('LLEN', KEYS[2]) - tonumber(ARGV[4])
+    if over > 0 then
+        for _, dropped in ipairs(redis.call('LRANGE', KEYS[2], 0, over - 1)) do
+            local dig = cjson.decode(dropped)['dig']
+            if redis.call('HGET', KEYS[3], dig) == dropped then
+                redis.call('HDEL', KEYS[3], dig)
+            end
+        end
+        redis.call('LTRIM', KEYS[2], over, -1)
+    end
+end
+redis.call('HSET', KEYS[3], ARGV[1], value)
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return seq
+"""
+
+class RedisStore(UploadStatusStore):
+    """ Shared store, each AID has a login key, a sequence counter, a capped list of entries and a digest hash
+
+    Entries are written by a script, so concurrent writers of an AID never see its list half updated.
+    """
+
+    def __init__(self, url=None, history=None, ttl=None, prefix="regps"):
+        super().__init__(history, ttl)
+        import redis
+        self.redis = redis.Redis.from_url(url or status_store_url)
+        self.script = self.redis.register_script(WRITE)
+        self.prefix = prefix
+
+    def _keys(self, aid):
+        return (f"{self.prefix}:login:{aid}", f"{self.prefix}:status:{aid}", f"{self.prefix}:digests:{aid}")
+
+    def _seq(self, aid):
+        return f"{self.prefix}:seq:{aid}"
+
+    def _touch(self, pipe, aid):
+        for key in self._keys(aid) + (self._seq(aid),):
+            pipe.expire(key, self.ttl)
+
+    def login(self, aid):
+        login, _, _ = self._keys(aid)
+        with self.redis.pipeline() as pipe:
+            pipe.set(login, int(time.time()))
+            pipe.set(self._seq(aid), int(time.time() * 1000), nx=True)
+            self._touch(pipe, aid)
+            pipe.execute()
+
+    def logged_in(self, aid):
+        login, _, _ = self._keys(aid)
+        return bool(self.redis.exists(login))
+
+    def version(self, aid):
+        login, _, _ = self._keys(aid)
+        exists, seq = self.redis.pipeline().exists(login).get(self._seq(aid)).execute()
+        return int(seq) if exists and seq is not None else None
+
+    def _write(self, aid, dig, entry, replace):
+        # the script appends the seq it draws to the entry
+        value = dumps({**{k: v for k, v in entry.items() if k != "seq"}, "dig": dig})
+        self.script(keys=self._keys(aid) + (self._seq(aid),),
+                    args=[dig, value[:-1], int(replace), self.history, self.ttl])
+
+    def add(self, aid, dig, entry):
+        self._write(aid, dig, entry, False)
+
+    def update(self, aid, dig, entry):
+        # replaced in place so the entry keeps its position in the list
+        self._write(aid, dig, entry, True)
+
+    def entries(self, aid):
+        _, status, _ = self._keys(aid)
+        return [loads(value) for value in self.redis.lrange(status, 0, -1)]
+
+    def find(self, aid, dig):
+        _, _, digests = self._keys(aid)
+        value = self.redis.hget(digests, dig)
+        return None if value is None else loads(value)
+
+class LmdbStore(UploadStatusStore):
+    """ Durable store in a memory mapped LMDB environment, one JSON record per AID
+
+    An expiry index keyed by the time each AID was last seen lets login() evict the expired
+    AIDs without reading the others.
+    """
+
+    def __init__(self, path=None, history=None, ttl=None, map_size=1 << 30):
+        super().__init__(history, ttl)
+        import lmdb
+        path = path or status_store_path
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.map_size = map_size
+        self._open()
+
+    def _open(self):
+        import lmdb
+        self.env = lmdb.open(self.path, map_size=self.map_size, max_dbs=2)
+        self.aids = self.env.open_db(b"aids")
+        self.expiry = self.env.open_db(b"expiry")
+        with self.env.begin(write=True) as txn:
+            # stores written before the index existed are indexed once
+            if txn.stat(self.expiry)["entries"] == 0 and txn.stat(self.aids)["entries"] > 0:
+                with txn.cursor(db=self.aids) as cursor:
+                    for key, value in cursor:
+                        txn.put(self._index(loads(value)["seen"], key), b"", db=self.expiry)
+
+    @staticmethod
+    def _index(seen: float, key: bytes) -> bytes:
+        # big endian doubles of positive times sort in time order
+        return struct.pack(">d", seen) + key
+
+    def after_fork(self):
+        # an lmdb environment must not be used across a fork, each worker opens its own. closing
+        # the inherited one leaves the locks and reader slots of the parent alone
+        self.env.close()
+        self._open()
+
+    def _get(self, txn, aid):
+        value = txn.get(aid.encode("utf-8"), db=self.aids)
+        if value is None:
+            return None
+        record = loads(value)
+        if time.time() - record["seen"] > self.ttl:
+            return None
+        return record
+
+    def _put(self, txn, aid, record):
+        key = aid.encode("utf-8")
+        if "seen" in record:
+            txn.delete(self._index(record["seen"], key), db=self.expiry)
+        record["seen"] = time.time()
+        record.setdefault("seq", int(time.time() * 1000))
+        del record["entries"][:-self.history]
+        txn.put(key, dumps(record), db=self.aids)
+        txn.put(self._index(record["seen"], key), b"", db=self.expiry)
+
+    def _evict(self, txn):
+        horizon = struct.pack(">d", time.time() - self.ttl)
+        with txn.cursor(db=self.expiry) as cursor:
+            expired = []
+            for index in cursor.iternext(values=False):
+                if index[:8] >= horizon:
+                    break
+                expired.append(index)
+        for index in expired:
+            key = index[8:]
+            value = txn.get(key, db=self.aids)
+            # an AID that logged in again after expiring has a newer index entry
+            if value is not None and self._index(loads(value)["seen"], key) == index:
+                txn.delete(key, db=self.aids)
+            txn.delete(index, db=self.expiry)
+
+    def login(self, aid):
+        with self.env.begin(write=True) as txn:
+            self._evict(txn)
+            record = self._get(txn, aid) or {"entries": []}
+            self._put(txn, aid, record)
+
+    def logged_in(self, aid):
+        with self.env.begin() as txn:
+            return self._get(txn, aid) is not None
+
+    def version(self, aid):
+        with self.env.begin() as txn:
+            record = self._get(txn, aid)
+            return None if record is None else record["seq"]
+
+    def add(self, aid, dig, entry):
+        with self.env.begin(write=True) as txn:
+            record = self._get(txn, aid)
+            if record is None:
+                return
+            record["seq"] += 1
+            record["entries"].append({**entry, "dig": dig, "seq": record["seq"]})
+            self._put(txn, aid, record)
+
+    def update(self, aid, dig, entry):
+        with self.env.begin(write=True) as txn:
+            record = self._get(txn, aid)
+            if record is None:
+                return
+            record["seq"] += 1
+            for i in range(len(record["entries"]) - 1, -1, -1):
+                if record["entries"][i].get("dig") == dig:
+                    record["entries"][i] = {**entry, "dig": dig, "seq": record["seq"]}
+                    break
+            else:
+                record["entries"].append({**entry, "dig": dig, "seq": record["seq"]})
+            self._put(txn, aid, record)
+
+    def entries(self, aid):
+        with self.env.begin() as txn:
+            record = self._get(txn, aid)
+            return [] if record is None else record["entries"]
+
+    def find(self, aid, dig):
+        for entry in reversed(self.entries(aid)):
+            if entry.get("dig") == dig:
+                return entry
+        return None
+
+def open_store(kind=None) -> UploadStatusStore:
+    kind = kind or status_store
+    if kind == "redis":
+        return RedisStore()
+    if kind == "lmdb":
+        return LmdbStore()
+    return MemoryStore()
+
+store = open_store()
+os.register_at_fork(after_in_child=store.after_fork)
+
+class StatusPages(object):
+    """ Serialized /status pages with strong ETags, kept until the entries of their AID change
+
+    A page is identified by the AID's version and its cursor, limit and since, so it is
+    serialized once per change of the entries, and a client holding the current ETag can be
+    answered 304 from version() alone.
+    """
+
+    def __init__(self, store: UploadStatusStore, size=None):
+        self.store = store
+        self.pages = TTLCache(status_page_cache if size is None else size, status_ttl)
+
+    @staticmethod
+    def etag(aid, version, cursor=0, limit=None, since=None) -> str:
+        key = f"{aid}:{version}:{cursor}:{limit}:{since}".encode("utf-8")
+        return f'"{hashlib.sha256(key).hexdigest()[:32]}"'
+
+    def page(self, aid, version, cursor=0, limit=None, since=None):
+        """ Serialized page as {aid: entries} and the cursor of the next page or None """
+        key = (aid, version, cursor, limit, since)
+        page = self.pages.get(key)
+        if page is None:
+            entries, after = self.store.page(aid, cursor, limit, since)
+            page = (dumps({aid: entries}), after)
+            self.pages.set(key, page)
+        return page
+
+status_pages = StatusPages(store)
@@ -1,115 +1,395 @@
+from app.verifier import auths, presentations, reports, requests_verify
+from app.verifier import auths_url, presentations_url, reports_url, request_url
+from app.cache import TTLCache
+from app.events import hub, record
+from app.flights import flights
+from app.logs import begin, bind, payload
+from app.packages import packages
+from app.polling import expired, not_found, poller
+from app.quotas import scheduler
+from app.results import dumps, loads, parsed, portable, serialize, text
+from app.spool import ReportSpool
+from app.store import store
+from app.tracing import span
+from app.verifier import setting
+import base64
+from celery import Celery
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import falcon
-import os
-import requests
-from time import sleep
-
-auths_url = "http://127.0.0.1:7676/authorizations/"
-presentations_url = "http://127.0.0.1:7676/presentations/"
-reports_url = "http://127.0.0.1:7676/reports/"
-request_url = "http://localhost:7676/request/verify/"
-
-VERIFIER_AUTHORIZATIONS = os.environ.get('VERIFIER_AUTHORIZATIONS')
-if VERIFIER_AUTHORIZATIONS is None:
-        print(f"VERIFIER_AUTHORIZATIONS is not set. Using default {auths_url}")
-else:
-        print(f"VERIFIER_AUTHORIZATIONS is set. Using {VERIFIER_AUTHORIZATIONS}")
-        auths_url = VERIFIER_AUTHORIZATIONS
-        
-VERIFIER_PRESENTATIONS = os.environ.get('VERIFIER_PRESENTATIONS')
-if VERIFIER_PRESENTATIONS is None:
-        print(f"VERIFIER_PRESENTATIONS is not set. Using default {presentations_url}")
-else:
-        print(f"VERIFIER_PRESENTATIONS is set. Using {VERIFIER_PRESENTATIONS}")
-        presentations_url = VERIFIER_PRESENTATIONS
-
-VERIFIER_REPORTS = os.environ.get('VERIFIER_REPORTS')
-if VERIFIER_REPORTS is None:
-        print(f"VERIFIER_REPORTS is not set. Using default {reports_url}")
-else:
-        print(f"VERIFIER_REPORTS is set. Using {VERIFIER_REPORTS}")
-        reports_url = VERIFIER_REPORTS
-        
-VERIFIER_REQUESTS = os.environ.get('VERIFIER_REQUESTS')
-if VERIFIER_REQUESTS is None:
-        print(f"VERIFIER_REQUESTS is not set. Using default {request_url}")
-else:
-        print(f"VERIFIER_REQUESTS is set. Using {VERIFIER_REQUESTS}")
-        request_url = VERIFIER_REQUESTS
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+celery = Celery('regps',
+                broker=setting('CELERY_BROKER', "redis://127.0.0.1:6379/0"),
+                backend=setting('CELERY_BACKEND', "redis://127.0.0.1:6379/0"))
+celery.conf.update(task_serializer='json', result_serializer='json', accept_content=['json'],
+                   task_track_started=True, result_expires=setting('CELERY_RESULT_EXPIRES', 86400, int))
+
+# hand uploads and logins to the celery workers instead of verifying them inside the http request
+async_uploads = setting('ASYNC_UPLOADS', "false").lower() in ("true", "1")
+async_logins = setting('ASYNC_LOGINS', "false").lower() in ("true", "1")
+
+# reports of a batch upload posted to the verifier at the same time, and the most reports in a batch
+batch_concurrency = setting('BATCH_CONCURRENCY', 4, int)
+batch_max_reports = setting('BATCH_MAX_REPORTS', 64, int)
+
+# seconds an AID's authorization is answered without asking the verifier, and the shorter
+# time a 404 (not logged in) is remembered
+auth_state_ttl = setting('AUTH_STATE_TTL', 60, int)
+auth_state_negative_ttl = setting('AUTH_STATE_NEGATIVE_TTL', 2, int)
+# optional redis url sharing the authorizations between workers
+auth_state_redis = setting('AUTH_STATE_REDIS', None)
+
+class AuthorizationCache(object):
+    """ Serialized authorization results per AID, in process and optionally in redis
+
+    200 results are kept for ttl seconds and 404 results for negative_ttl seconds, anything
+    else always goes to the verifier. invalidate() drops an AID from both tiers.
+    """
+
+    def __init__(self, ttl=None, negative_ttl=None, url=None, size=10000, prefix="regps:auth"):
+        self.ttl = auth_state_ttl if ttl is None else ttl
+        self.negative_ttl = auth_state_negative_ttl if negative_ttl is None else negative_ttl
+        self.local = TTLCache(size, self.ttl)
+        url = auth_state_redis if url is None else url
+        self.redis = None
+        if url:
+            import redis
+            self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _ttl(self, result):
+        if result["status_code"] == falcon.http_status_to_code(falcon.HTTP_200):
+            return self.ttl
+        if result["status_code"] == falcon.http_status_to_code(falcon.HTTP_404):
+            return self.negative_ttl
+        return 0
+
+    def get(self, aid: str):
+        result = self.local.get(aid)
+        if result is None and self.redis is not None:
+            try:
+                value, ttl = self.redis.pipeline().get(f"{self.prefix}:{aid}").pttl(f"{self.prefix}:{aid}").execute()
+            except Exception as e:
+                logger.warning("AuthorizationCache.get: redis unavailable %s", e)
+                return None
+            if value is not None and ttl > 0:
+                result = loads(value)
+                self.local.set(aid, result, ttl / 1000)
+        return result
+
+    def put(self, aid: str, result: dict):
+        ttl = self._ttl(result)
+        if ttl <= 0:
+            return
+        self.local.set(aid, result, ttl)
+        if self.redis is not None:
+            try:
+                self.redis.set(f"{self.prefix}:{aid}", dumps(portable(result)), px=int(ttl * 1000))
+            except Exception as e:
+                logger.warning("AuthorizationCache.put: redis unavailable %s", e)
+
+    def invalidate(self, aid: str):
+        self.local.pop(aid)
+        if self.redis is not None:
+            try:
+                self.redis.delete(f"{self.prefix}:{aid}")
+            except Exception as e:
+                logger.warning("AuthorizationCache.invalidate: redis unavailable %s", e)
+
+authorizations = AuthorizationCache()
+
+# final upload results kept per AID and digest, and for how many seconds
+upload_index_size = setting('UPLOAD_INDEX_SIZE', 10000, int)
+upload_index_ttl = setting('UPLOAD_INDEX_TTL', 24 * 60 * 60, int)
+
+class UploadIndex(object):
+    """ Final verifier results of uploads by (AID, digest)
+
+    A digest names the report content, so once the verifier has verified or failed it the
+    result holds for any later upload or check of the same digest.
+    """
+
+    def __init__(self, size=None, ttl=None):
+        self.results = TTLCache(upload_index_size if size is None else size,
+                                upload_index_ttl if ttl is None else ttl)
+
+    @staticmethod
+    def final(result: dict) -> bool:
+        if result["status_code"] != falcon.http_status_to_code(falcon.HTTP_200):
+            return False
+        try:
+            return parsed(result).get("status") in ("verified", "failed")
+        except (ValueError, AttributeError):
+            return False
+
+    def result(self, aid: str, dig: str):
+        return self.results.get((aid, dig))
+
+    def record(self, aid: str, dig: str, result: dict):
+        if self.final(result):
+            self.results.set((aid, dig), result)
+
+upload_index = UploadIndex()
 
 def check_login(aid: str) -> dict:
-    return serialize(_login(aid))
+    """ Authorization of aid, concurrent checks of an AID share one call to the verifier """
+
+    def fetch():
+        with span("check"):
+            result = serialize(_login(aid))
+        authorizations.put(aid, result)
+        return result
+
+    return authorizations.get(aid) or flights.do(("auth", aid), fetch, poller.deadline) or fetch()
 
 def _login(aid: str) -> falcon.Response:
-    print(f"checking login: {aid}")
-    print(f"getting from {auths_url}{aid}")
-    gres = requests.get(f"{auths_url}{aid}", headers={"Content-Type": "application/json"})
-    print(f"login status: {gres}")
+    logger.debug("checking login: %s", aid)
+    logger.debug("getting from %s%s", auths_url, aid)
+    gres = auths.get(aid, headers={"Content-Type": "application/json"})
+    logger.debug("login status: %s", gres)
     return gres
 
 def verify_vlei(aid: str, said: str, vlei: str) -> dict:
     # first check to see if we're already logged in
-    print(f"Login verification started {aid} {said} {vlei[:50]}")
+    logger.debug("Login verification started %s %s %s", aid, said, payload(vlei))
 
-    login_response = _login(aid)
-    print(f"Login check {login_response.status_code} {login_response.text[:50]}")
+    login_result = check_login(aid)
+    logger.debug("Login check %s %s", login_result['status_code'], payload(login_result))
 
-    if str(login_response.status_code) == str(falcon.http_status_to_code(falcon.HTTP_OK)):
-        print("already logged in")
-        return serialize(login_response)
+    if login_result["status_code"] == falcon.http_status_to_code(falcon.HTTP_OK):
+        logger.debug("already logged in")
+        return login_result
     else:
-        print(f"putting to {presentations_url}{said}")
-        presentation_response = requests.put(f"{presentations_url}{said}", headers={"Content-Type": "application/json+cesr"}, data=vlei)
-        print(f"put response {presentation_response.text}")
-
-        if presentation_response.status_code == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
-            login_response = None
-            while(login_response == None or login_response.status_code == falcon.http_status_to_code(falcon.HTTP_404)):
-                login_response = _login(aid)
-                print(f"polling result {login_response}")
-                sleep (1)
-            return serialize(login_response)
+        # a presentation submitted again while it is being verified joins the first one
+        result = flights.do(("login", aid, said), lambda: _present(aid, said, vlei), poller.deadline)
+        if result is None:
+            return expired(True, f"Login verification for {aid} is still in progress", aid=aid, said=said)
+        return result
+
+def _present(aid: str, said: str, vlei: str) -> dict:
+    # waits its turn behind the logins and uploads of other AIDs
+    with scheduler.slot(aid):
+        # a new presentation may change the AID's authorization
+        authorizations.invalidate(aid)
+        logger.debug("putting to %s%s", presentations_url, said)
+        with span("present"):
+            presentation_result = serialize(presentations.put(said, key=aid, headers={"Content-Type": "application/json+cesr"}, data=vlei))
+        logger.debug("put response %s", payload(presentation_result))
+
+        if presentation_result["status_code"] == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
+            with span("poll", kind="login"):
+                login_response, final = poller.poll(lambda: _login(aid), not_found, kind="login")
+            logger.debug("polling result %s", login_response)
+            if not final:
+                return expired(login_response, f"Login verification for {aid} is still in progress", aid=aid, said=said)
+            login_result = serialize(login_response)
+            authorizations.put(aid, login_result)
+            hub.publish(aid, "login", status_entry(login_result, aid=aid, said=said, status="verified"))
+            return login_result
         else:
-            return serialize(presentation_response)
+            return presentation_result
         
 def verify_req(aid,cig,ser):
-    print("Request verification started aid = {}, cig = {}, ser = {}....".format(aid,cig,ser))
-    print("posting to {}".format(request_url+f"{aid}"))
-    print(f"verify_req headers {aid}")
-    pres = requests.post(request_url+aid, params={"sig": cig,"data": ser})
-    print("post response {}".format(pres.text))
-    return serialize(pres)
+    logger.debug("Request verification started aid = %s, cig = %s, ser = %s", aid, cig, ser)
+    logger.debug("posting to %s%s", request_url, aid)
+    logger.debug("verify_req headers %s", aid)
+    with span("verify-req"):
+        pres = serialize(requests_verify.post(aid, params={"sig": cig,"data": ser}))
+    logger.debug("post response %s", payload(pres))
+    return pres
         
 def check_upload(aid: str, dig: str) -> dict:
-    return serialize(_upload(aid, dig))
+    """ Verifier result of the report dig, concurrent checks of a digest share one call """
+
+    def fetch():
+        with span("check"):
+            result = serialize(_upload(aid, dig))
+        upload_index.record(aid, dig, result)
+        return result
+
+    return upload_index.result(aid, dig) or flights.do(("report", aid, dig), fetch, poller.deadline) or fetch()
 
 def _upload(aid: str, dig: str) -> falcon.Response:
-    print(f"checking upload: aid {aid} and dig {dig}")
-    print(f"getting from {reports_url}{aid}/{dig}")
-    reports_response = requests.get(f"{reports_url}{aid}/{dig}", headers={"Content-Type": "application/json"})
-    print(f"upload status: {reports_response}")
+    logger.debug("checking upload: aid %s and dig %s", aid, dig)
+    logger.debug("getting from %s%s/%s", reports_url, aid, dig)
+    reports_response = reports.get(f"{aid}/{dig}", headers={"Content-Type": "application/json"})
+    logger.debug("upload status: %s", reports_response)
     return reports_response
 
 def upload(aid: str, dig: str, contype: str, report) -> dict:
-    print(f"report type {type(report)}")
+    """ Post a report to the verifier and wait for its result, report is bytes or a ReportSpool
+
+    Digests with a final result are answered from the upload index, and an upload of a digest
+    that is already being posted, by this or with FLIGHT_REDIS any worker, waits for that one
+    instead of posting again. Packages failing their local check are failed without posting.
+    """
+    result = upload_index.result(aid, dig)
+    if result is not None:
+        logger.debug("already verified %s %s", aid, dig)
+        return result
+    result = packages.check(aid, dig, contype, report)
+    if result is not None:
+        upload_index.record(aid, dig, result)
+        return result
+
+    def post():
+        with scheduler.slot(aid):
+            result = _post_report(aid, dig, contype, report)
+        upload_index.record(aid, dig, result)
+        return result
+
+    result = flights.do(("upload", aid, dig), post, poller.deadline)
+    if result is None:
+        return expired(True, f"Report {dig} from {aid} is still being verified",
+                       submitter=aid, dig=dig, status="pending")
+    return result
+
+def _post_report(aid: str, dig: str, contype: str, report) -> dict:
+    logger.debug("report type %s", type(report))
     # first check to see if we've already uploaded
-    upload_response = _upload(aid, dig)
-    if upload_response.status_code == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
-        print("already uploaded")
-        return serialize(upload_response)
+    with span("check"):
+        upload_response = _upload(aid, dig)
+    checked = serialize(upload_response)
+    if upload_response.status_code == falcon.http_status_to_code(falcon.HTTP_ACCEPTED) or UploadIndex.final(checked):
+        logger.debug("already uploaded")
+        return checked
     else:
-        print(f"posting to {reports_url}{aid}/{dig}")
-        presentation_response = requests.post(f"{reports_url}{aid}/{dig}", headers={"Content-Type": contype}, data=report)
-        print(f"post response {presentation_response.text}")
-
-        if presentation_response.status_code == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
-            upload_response = None
-            while(upload_response == None or upload_response.status_code == falcon.http_status_to_code(falcon.HTTP_404)):
-                upload_response = _upload(aid,dig)
-                print(f"polling result {upload_response.text}")
-                sleep (1)
+        logger.debug("posting to %s%s/%s", reports_url, aid, dig)
+        headers = {"Content-Type": contype}
+        if isinstance(report, ReportSpool):
+            headers["Content-Length"] = str(report.size)
+            report = report.body()
+        with span("post", dig=dig):
+            presentation_result = serialize(reports.post(f"{aid}/{dig}", headers=headers, data=report))
+        logger.debug("post response %s", payload(presentation_result))
+
+        if presentation_result["status_code"] == falcon.http_status_to_code(falcon.HTTP_ACCEPTED):
+            with span("poll", kind="upload"):
+                upload_response, final = poller.poll(lambda: _upload(aid, dig), not_found, kind="upload")
+            logger.debug("polling result %s", upload_response)
+            if not final:
+                return expired(upload_response, f"Report {dig} from {aid} is still being verified",
+                               submitter=aid, dig=dig, status="pending")
             return serialize(upload_response)
         else:
-            return serialize(presentation_response)
-        
-def serialize(response: falcon.Response) -> dict:
-    return {"status_code": response.status_code, "text": response.text, "headers":{"Content-Type": response.headers['Content-Type']}}
\ No newline at end of file
+            return presentation_result
+
+def failure(e: Exception) -> dict:
+    if isinstance(e, falcon.HTTPError):
+        return {"status_code": e.status_code, "text": json.dumps({"status": "failed", "message": e.description}),
+                "headers": {"Content-Type": falcon.MEDIA_JSON}}
+    return {"status_code": falcon.http_status_to_code(falcon.HTTP_500),
+            "text": json.dumps({"status": "failed", "message": f"Exception: {e}"}),
+            "headers": {"Content-Type": falcon.MEDIA_JSON}}
+
+def batch_id(digs) -> str:
+    """ Id of a batch upload, the same for every upload of the same reports """
+    return hashlib.sha256(" ".join(sorted(digs)).encode("utf-8")).hexdigest()[:32]
+
+def upload_batch(aid: str, reports: list) -> list:
+    """ upload() each (dig, contype, report), at most batch_concurrency at a time, results in order """
+    if not reports:
+        return []
+    context = contextvars.copy_context()
+
+    def one(item):
+        dig, contype, report = item
+        bind(dig=dig)
+        try:
+            return upload(aid, dig, contype, report)
+        except Exception as e:
+            logger.exception("upload_batch: %s %s failed", aid, dig)
+            return failure(e)
+
+    with ThreadPoolExecutor(min(batch_concurrency, len(reports))) as pool:
+        return list(pool.map(lambda item: context.copy().run(one, item), reports))
+
+def batch_status(aid: str, batch: str, rejected=()):
+    """ Status of a batch upload aggregated from the entries of its reports, or None if it has none
+
+    verified once all of its reports are, failed once none is pending and any one failed.
+    rejected are the entries of reports that were never stored, for the answer to the upload.
+    """
+    entries = [entry for entry in store.entries(aid) if entry.get("batch") == batch] + list(rejected)
+    if not entries:
+        return None
+    counts = {}
+    for entry in entries:
+        counts[entry.get("status", "pending")] = counts.get(entry.get("status", "pending"), 0) + 1
+    if set(counts) == {"verified"}:
+        status = "verified"
+    elif set(counts) <= {"verified", "failed"}:
+        status = "failed"
+    else:
+        status = "pending"
+    return {"batch": batch, "submitter": aid, "status": status, "counts": counts, "reports": entries}
+
+@celery.task(name="regps.upload", bind=True)
+def upload_job(self, aid: str, dig: str, contype: str, report: str, batch=None) -> dict:
+    """ Celery task running upload() for a base64 encoded report
+
+    The result is also written to the upload status store, so web workers sharing a redis or
+    lmdb store see it without asking celery, and pushed to the AID's event subscribers.
+    """
+    begin(self.request.id)
+    bind(aid=aid, dig=dig)
+    result = upload(aid, dig, contype, base64.b64decode(report))
+    fields = {"submitter": aid, "job": self.request.id}
+    if batch is not None:
+        fields["batch"] = batch
+    record(aid, dig, status_entry(result, **fields))
+    # celery carries results as JSON
+    return portable(result)
+
+@celery.task(name="regps.login", bind=True)
+def login_job(self, aid: str, said: str, vlei: str) -> dict:
+    """ Celery task running verify_vlei() """
+    begin(self.request.id)
+    bind(aid=aid)
+    return portable(verify_vlei(aid, said, vlei))
+
+def enqueue_upload(aid: str, dig: str, contype: str, report: bytes, batch=None) -> dict:
+    job = upload_job.delay(aid, dig, contype, base64.b64encode(report).decode("utf-8"), batch)
+    entry = {"submitter": aid, "dig": dig, "contentType": contype, "size": len(report), "status": "queued",
+             "job": job.id}
+    if batch is not None:
+        entry["batch"] = batch
+    return entry
+
+def enqueue_login(aid: str, said: str, vlei: str) -> dict:
+    job = login_job.delay(aid, said, vlei)
+    return {"aid": aid, "said": said, "status": "queued", "job": job.id}
+
+def job_progress(entry: dict) -> dict:
+    """ Refresh a queued status entry from the state of its celery job
+
+    While the job runs the entry is returned with its status set to the lower cased celery
+    state (queued, started, retry). Once it is done the entry becomes the verifier result, with
+    the job id kept so later lookups can still find it.
+    """
+    job = celery.AsyncResult(entry["job"])
+    if not job.ready():
+        state = "queued" if job.state == "PENDING" else job.state.lower()
+        return {**entry, "status": state}
+    fields = {k: v for k, v in entry.items() if k != "status"}
+    if job.successful():
+        return status_entry(job.result, **fields)
+    return {**fields, "status": "failed", "message": str(job.result)}
+
+def status_entry(result: dict, **fields) -> dict:
+    """ Upload status entry for a serialized verifier result, on top of the given fields """
+    try:
+        final = dict(parsed(result))
+    except ValueError:
+        final = {"message": text(result)}
+    if result["status_code"] >= 400 and "status" not in final:
+        final["status"] = "failed"
+    return {**fields, **final}
+
+def job_pending(entry: dict) -> bool:
+    return "job" in entry and entry.get("status") in ("queued", "started", "retry")
@@ -0,0 +1,309 @@
+import atexit
+import contextvars
+import falcon
+import importlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import requests
+from app.logs import bind
+
+logger = logging.getLogger(__name__)
+
+# settings are read here and not with app.verifier.setting, whose calls to the verifier are traced with this module
+# where finished spans go, none, file, otlp or the module:Class of an exporter with an export(spans) method
+trace_exporter = os.environ.get('TRACE_EXPORTER', "none")
+# fraction of the requests without a sampled traceparent that are traced
+trace_sample = float(os.environ.get('TRACE_SAMPLE', "0.01"))
+# file the file exporter appends OTLP JSON lines to, - for stdout
+trace_file = os.environ.get('TRACE_FILE', "regps-traces.jsonl")
+# OTLP/HTTP JSON traces url of the collector the otlp exporter posts to
+trace_otlp_url = os.environ.get('TRACE_OTLP_URL', "http://127.0.0.1:4318/v1/traces")
+# spans waiting to be exported, spans finished while it is full are dropped
+trace_queue = int(os.environ.get('TRACE_QUEUE', "2048"))
+# add a Server-Timing header with the duration of each stage to the responses of traced requests
+trace_server_timing = os.environ.get('TRACE_SERVER_TIMING', "true").lower() in ("true", "1")
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# span kinds as numbered by OTLP
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+class Trace(object):
+    """ The spans of one request, sampled ones are recorded and exported """
+
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+
+class Span(object):
+    """ A timed stage of a request, the current span while it is entered """
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "attributes", "start", "started", "duration",
+                 "error", "token")
+
+    def __init__(self, trace: Trace, name: str, parent_id=None, kind=INTERNAL, span_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = span_id or os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+    def end(self, error=None):
+        self.duration = time.perf_counter() - self.started
+        self.error = error
+        if self.trace.sampled:
+            self.trace.spans.append(self)
+
+    def __enter__(self):
+        self.token = current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current.reset(self.token)
+        self.end(None if exc is None else repr(exc))
+
+class NoSpan(object):
+    """ Stands in for the spans of requests that are not traced """
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+no_span = NoSpan()
+
+# span of the request stage being handled
+current = contextvars.ContextVar("regps_span", default=None)
+
+def span(name: str, kind=INTERNAL, **attributes):
+    """ Context manager timing a stage of the current request as a child of the current span """
+    parent = current.get()
+    if parent is None or not parent.trace.sampled:
+        return no_span
+    return Span(parent.trace, name, parent.span_id, kind, attributes=attributes)
+
+def propagate() -> dict:
+    """ traceparent header continuing the current trace in a call to the verifier """
+    parent = current.get()
+    if parent is None:
+        return {}
+    return {"traceparent": parent.traceparent()}
+
+def begin(traceparent=None, name="request") -> Span:
+    """ Start the root span of a request, continuing the trace of a valid traceparent header
+
+    A traceparent decides the sampling of the request, other requests are sampled at
+    trace_sample. A request that is not sampled only passes its traceparent on.
+    """
+    matched = TRACEPARENT.match(traceparent or "")
+    if matched and matched.group(1) != "0" * 32 and matched.group(2) != "0" * 16:
+        trace_id, parent_id, flags = matched.groups()
+        trace = Trace(trace_id, bool(int(flags, 16) & 1))
+        root = Span(trace, name, parent_id, SERVER, span_id=None if trace.sampled else parent_id)
+    elif trace_sample > 0 and random.random() < trace_sample:
+        root = Span(Trace(os.urandom(16).hex(), True), name, kind=SERVER)
+    else:
+        current.set(None)
+        return None
+    current.set(root)
+    return root
+
+def finish(root: Span, status_code: int):
+    """ End the root span of a request and hand its spans to the exporter """
+    current.set(None)
+    if root is None or not root.trace.sampled:
+        return
+    root.set(**{"http.response.status_code": status_code})
+    root.end("error" if status_code >= 500 else None)
+    exporter.put(root.trace.spans)
+
+def server_timing(root: Span) -> str:
+    """ Server-Timing header value with the total time spent in each stage of a traced request """
+    stages = {}
+    for stage in root.trace.spans:
+        if stage is not root and stage.duration is not None:
+            stages[stage.name] = stages.get(stage.name, 0.0) + stage.duration
+    stages["total"] = time.perf_counter() - root.started if root.duration is None else root.duration
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items())
+
+def value(attribute) -> dict:
+    if isinstance(attribute, bool):
+        return {"boolValue": attribute}
+    if isinstance(attribute, int):
+        return {"intValue": str(attribute)}
+    if isinstance(attribute, float):
+        return {"doubleValue": attribute}
+    return {"stringValue": str(attribute)}
+
+def otlp(spans: list) -> dict:
+    """ OTLP/HTTP JSON document of spans """
+    encoded = []
+    for stage in spans:
+        encoded.append({
+            "traceId": stage.trace.trace_id, "spanId": stage.span_id, "parentSpanId": stage.parent_id or "",
+            "name": stage.name, "kind": stage.kind, "startTimeUnixNano": str(stage.start),
+            "endTimeUnixNano": str(stage.start + int(stage.duration * 1e9)),
+            "attributes": [{"key": key, "value": value(attribute)} for key, attribute in stage.attributes.items()],
+            "status": {"code": 2, "message": stage.error} if stage.error else {}})
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "regps"}}]},
+        "scopeSpans": [{"scope": {"name": "regps"}, "spans": encoded}]}]}
+
+class FileExporter(object):
+    """ Appends each batch of spans to a file as a line of OTLP JSON, for a collector to pick up """
+
+    def __init__(self, path=None):
+        self.path = trace_file if path is None else path
+
+    def export(self, spans: list):
+        line = json.dumps(otlp(spans)).encode("utf-8") + b"\n"
+        if self.path == "-":
+            os.write(1, line)
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+class OtlpExporter(object):
+    """ Posts each batch of spans to an OpenTelemetry collector over OTLP/HTTP JSON """
+
+    def __init__(self, url=None):
+        self.url = trace_otlp_url if url is None else url
+        self.session = requests.Session()
+
+    def export(self, spans: list):
+        response = self.session.post(self.url, data=json.dumps(otlp(spans)),
+                                     headers={"Content-Type": "application/json"}, timeout=5)
+        response.raise_for_status()
+
+def load(name: str):
+    if name == "none":
+        return None
+    if name == "file":
+        return FileExporter()
+    if name == "otlp":
+        return OtlpExporter()
+    module, _, attr = name.partition(":")
+    return getattr(importlib.import_module(module), attr)()
+
+class Exporter(object):
+    """ Hands finished traces to the configured exporter on a thread of its own
+
+    Request threads and the event loop only put spans on a bounded queue. The thread is started
+    with the first trace of a process, threads do not survive a fork.
+    """
+
+    def __init__(self, target=None, maxsize=None, batch=512):
+        self.target = load(trace_exporter) if target is None else target
+        self.maxsize = trace_queue if maxsize is None else maxsize
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.reset()
+
+    def reset(self):
+        self.spans = queue.Queue(self.maxsize)
+        self.thread = None
+
+    def put(self, spans: list):
+        if self.target is None:
+            return
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name="trace-exporter", daemon=True)
+                    self.thread.start()
+        for stage in spans:
+            try:
+                self.spans.put_nowait(stage)
+            except queue.Full:
+                self.dropped += 1
+
+    def drain(self, block=True) -> list:
+        spans = []
+        try:
+            spans.append(self.spans.get(block, 1.0))
+            while len(spans) < self.batch:
+                spans.append(self.spans.get_nowait())
+        except queue.Empty:
+            pass
+        return spans
+
+    def run(self):
+        while True:
+            self.flush(self.drain())
+
+    def flush(self, spans: list):
+        if not spans:
+            return
+        if self.dropped:
+            logger.warning("Exporter.flush: dropped %s spans with the queue full", self.dropped)
+            self.dropped = 0
+        try:
+            self.target.export(spans)
+        except Exception as e:
+            logger.warning("Exporter.flush: export failed %s", e)
+
+    def close(self):
+        # the spans of the last requests are exported before the process exits
+        if self.target is not None:
+            self.flush(self.drain(block=False))
+
+exporter = Exporter()
+atexit.register(exporter.close)
+os.register_at_fork(after_in_child=exporter.reset)
+
+class Tracing(object):
+    """ Traces sampled requests, with their stages as spans and a Server-Timing header """
+
+    def process_request(self, req, resp):
+        req.context.span = root = begin(req.get_header('traceparent'))
+        if root is not None and root.trace.sampled:
+            bind(trace_id=root.trace.trace_id)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        root = getattr(req.context, "span", None)
+        if root is None:
+            return
+        root.name = f"{req.method} {req.uri_template or 'unmatched'}"
+        root.set(**{"http.request.method": req.method, "http.route": req.uri_template or "unmatched"})
+        if root.trace.sampled and trace_server_timing:
+            resp.set_header('Server-Timing', server_timing(root))
+        finish(root, falcon.http_status_to_code(resp.status))
+
+class AsyncTracing(Tracing):
+
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super().process_response(req, resp, resource, req_succeeded)
@@ -0,0 +1,442 @@
+import asyncio
+import falcon
+import hashlib
+import httpx
+import logging
+import math
+import os
+import requests
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app import logs  # configures the app loggers before the settings are logged
+from app.metrics import circuit_state, upstream_rejected_total, upstream_seconds, verifier_up
+from app.tracing import CLIENT, propagate, span
+
+logger = logging.getLogger(__name__)
+
+def setting(name: str, default, cast=str):
+    """ Read a setting from the environment, falling back to default """
+    value = os.environ.get(name)
+    if value is None:
+        logger.info("%s is not set. Using default %s", name, default)
+        return default
+    logger.info("%s is set. Using %s", name, value)
+    return cast(value)
+
+# each endpoint takes a comma separated list of urls, one per verifier instance. urls on the same
+# host are the same instance, so the calls about an AID go to one instance across the endpoints
+auths_url = setting('VERIFIER_AUTHORIZATIONS', "http://127.0.0.1:7676/authorizations/")
+presentations_url = setting('VERIFIER_PRESENTATIONS', "http://127.0.0.1:7676/presentations/")
+reports_url = setting('VERIFIER_REPORTS', "http://127.0.0.1:7676/reports/")
+request_url = setting('VERIFIER_REQUESTS', "http://localhost:7676/request/verify/")
+
+# connections kept open per endpoint
+pool_size = setting('VERIFIER_POOL_SIZE', 10, int)
+# seconds an idle connection is kept alive, 0 closes the connection after every call
+keepalive = setting('VERIFIER_KEEPALIVE', 5.0, float)
+connect_timeout = setting('VERIFIER_CONNECT_TIMEOUT', 3.05, float)
+read_timeout = setting('VERIFIER_READ_TIMEOUT', 30.0, float)
+# retries of failed connections, and of 502/503/504 answers to idempotent calls, by both apps
+RETRY_STATUSES = (502, 503, 504)
+retries = setting('VERIFIER_RETRIES', 2, int)
+retry_backoff = setting('VERIFIER_RETRY_BACKOFF', 0.1, float)
+
+# outcomes of the calls to an endpoint in the last window seconds open its circuit once there
+# are at least min calls and the error rate of them failed, calls slower than slow seconds fail
+breaker_window = setting('BREAKER_WINDOW', 30.0, float)
+breaker_min_calls = setting('BREAKER_MIN_CALLS', 10, int)
+breaker_error_rate = setting('BREAKER_ERROR_RATE', 0.5, float)
+breaker_slow_call = setting('BREAKER_SLOW_CALL', 10.0, float)
+# seconds an open circuit fails calls at once before letting a trial call through
+breaker_open_time = setting('BREAKER_OPEN_TIME', 15.0, float)
+# seconds between health checks of the verifier instances, made when there is more than one
+health_interval = setting('VERIFIER_HEALTH_INTERVAL', 5.0, float)
+# path checked on each instance, the endpoint url by default, any answer under 500 is healthy
+health_path = setting('VERIFIER_HEALTH_PATH', None)
+# calls about an AID go to the next instance in its order once its own instance has this many
+# times one more than the average calls in flight of the endpoint's instances
+balance_factor = setting('VERIFIER_BALANCE_FACTOR', 1.25, float)
+# verifier calls in flight per worker process, more are answered 503 at once
+verifier_max_calls = setting('VERIFIER_MAX_CALLS', 64, int)
+# seconds a client is told to wait before retrying when the calls are at their cap
+verifier_retry_after = setting('VERIFIER_RETRY_AFTER', 2, int)
+
+class Unavailable(falcon.HTTPServiceUnavailable):
+    """ The verifier was not called, its circuit is open or too many calls are in flight """
+
+    def __init__(self, description: str, retry_after: int):
+        super().__init__(description=description, retry_after=retry_after)
+
+class CircuitBreaker(object):
+    """ Stops calling an endpoint that keeps failing or answering too slowly
+
+    While closed every call goes through and the outcomes of the last window seconds are kept.
+    Once at least min_calls of them are kept and error_rate of them failed (an error, a 5xx
+    answer or a call slower than slow_call seconds) the circuit opens and calls fail at once
+    for open_time seconds. It is then half-open and lets a single trial call through, which
+    closes it when it succeeds and opens it again when it fails.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half-open", "open"
+
+    def __init__(self, name: str, window=None, min_calls=None, error_rate=None, slow_call=None, open_time=None):
+        self.name = name
+        self.window = breaker_window if window is None else window
+        self.min_calls = breaker_min_calls if min_calls is None else min_calls
+        self.error_rate = breaker_error_rate if error_rate is None else error_rate
+        self.slow_call = breaker_slow_call if slow_call is None else slow_call
+        self.open_time = breaker_open_time if open_time is None else open_time
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.failures = 0
+        self.opened = 0.0
+        self.trying = False
+        self._set(self.CLOSED)
+
+    def _set(self, state):
+        self.state = state
+        circuit_state.labels(self.name).set((self.CLOSED, self.HALF_OPEN, self.OPEN).index(state))
+
+    def _open(self, now):
+        logger.warning("CircuitBreaker: %s opened after %s failures in %s calls", self.name, self.failures, len(self.calls))
+        self._set(self.OPEN)
+        self.opened = now
+        self.calls.clear()
+        self.failures = 0
+
+    def available(self) -> bool:
+        """ Whether allow() would let a call through, without taking the half-open trial """
+        with self.lock:
+            if self.state == self.OPEN:
+                return time.monotonic() >= self.opened + self.open_time
+            return not (self.state == self.HALF_OPEN and self.trying)
+
+    def allow(self):
+        """ Raises Unavailable unless a call may go through """
+        with self.lock:
+            if self.state == self.OPEN:
+                remaining = self.opened + self.open_time - time.monotonic()
+                if remaining > 0:
+                    upstream_rejected_total.labels(self.name, "open").inc()
+                    raise Unavailable(f"Verifier {self.name} is unavailable", math.ceil(remaining))
+                self._set(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self.trying:
+                    upstream_rejected_total.labels(self.name, "open").inc()
+                    raise Unavailable(f"Verifier {self.name} is recovering", 1)
+                self.trying = True
+
+    def record(self, failed: bool):
+        now = time.monotonic()
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trying = False
+                if failed:
+                    self._open(now)
+                else:
+                    logger.info("CircuitBreaker: %s closed", self.name)
+                    self._set(self.CLOSED)
+                return
+            if self.state == self.OPEN:
+                # a call let through before the circuit opened
+                return
+            self.calls.append((now, failed))
+            self.failures += failed
+            while self.calls[0][0] < now - self.window:
+                self.failures -= self.calls.popleft()[1]
+            if len(self.calls) >= self.min_calls and self.failures >= self.error_rate * len(self.calls):
+                self._open(now)
+
+class CallLimit(object):
+    """ Caps the verifier calls in flight in a worker process, calls over the cap fail at once """
+
+    def __init__(self, limit=None):
+        self.limit = verifier_max_calls if limit is None else limit
+        self.lock = threading.Lock()
+        self.active = 0
+
+    @property
+    def saturated(self) -> bool:
+        return self.active >= self.limit
+
+    def acquire(self, name: str):
+        with self.lock:
+            if self.active >= self.limit:
+                upstream_rejected_total.labels(name, "limit").inc()
+                raise Unavailable("Too many verifier calls in progress", verifier_retry_after)
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+call_limit = CallLimit()
+
+class Host(object):
+    """ A verifier instance, down after a failed health check or connection until a check passes """
+
+    def __init__(self, key: str, url: str):
+        self.key = key
+        self.url = url
+        self.up = True
+        verifier_up.labels(key).set(1)
+
+    def mark(self, up: bool):
+        if up != self.up:
+            logger.warning("Host: verifier %s is %s", self.key, "up" if up else "down")
+        self.up = up
+        verifier_up.labels(self.key).set(1 if up else 0)
+
+hosts = {}
+
+def host(url: str) -> Host:
+    parts = urlsplit(url)
+    if parts.netloc not in hosts:
+        check = f"{parts.scheme}://{parts.netloc}{health_path}" if health_path else url
+        hosts[parts.netloc] = Host(parts.netloc, check)
+    return hosts[parts.netloc]
+
+class HealthChecker(object):
+    """ Checks every verifier instance each interval seconds, on a thread started by the first call """
+
+    def __init__(self, interval=None):
+        self.interval = health_interval if interval is None else interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.session = requests.Session()
+
+    def watch(self):
+        # started in the worker making the calls, a thread does not survive a fork
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="regps-health", daemon=True)
+                self.thread.start()
+
+    def check(self, host: Host) -> bool:
+        try:
+            return self.session.get(host.url, timeout=(connect_timeout, connect_timeout)).status_code < 500
+        except requests.RequestException:
+            return False
+
+    def _run(self):
+        while True:
+            for host in list(hosts.values()):
+                host.mark(self.check(host))
+            time.sleep(self.interval)
+
+health = HealthChecker()
+
+def rank(key: str, host: Host) -> int:
+    """ Rendezvous weight of host for key, the calls about key go to the live host weighing most """
+    return int.from_bytes(hashlib.blake2b(f"{key}/{host.key}".encode("utf-8"), digest_size=8).digest(), "big")
+
+class Backend(object):
+    """ An endpoint on one verifier instance, with its circuit breaker and its calls in flight """
+
+    def __init__(self, name: str, url: str):
+        self.url = url
+        self.host = host(url)
+        self.breaker = CircuitBreaker(name)
+        self.outstanding = 0
+
+    @property
+    def live(self) -> bool:
+        return self.host.up and self.breaker.available()
+
+class Endpoint(object):
+    """ A verifier endpoint on one or more verifier instances, with its own pool of keep-alive connections
+
+    The blocking session is used by the WSGI app and the async client by the ASGI app,
+    both are created once per worker process and reused for every call to the endpoint.
+    Calls go through the circuit breaker of their instance and the process wide call limit,
+    and raise Unavailable instead of calling the verifier when either turns them away.
+
+    A call about an AID goes to the live instance the AID ranks first by rendezvous hashing,
+    unless that instance is balance_factor times busier than the average, and then to
+    the next one in the AID's order. The order is the same for every endpoint and worker, so
+    an AID keeps to one instance, and to one other instance while its own is down. A GET
+    failing to connect is repeated on the next instance.
+    """
+
+    def __init__(self, name: str, urls: str):
+        self.name = name
+        urls = [url.strip() for url in urls.split(",") if url.strip()]
+        if not urls:
+            raise ValueError(f"No url for verifier endpoint {name}")
+        self.backends = [Backend(name if len(urls) == 1 else f"{name}@{urlsplit(url).netloc}", url) for url in urls]
+        self.lock = threading.Lock()
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers = {} if keepalive > 0 else {"Connection": "close"}
+
+        # only idempotent calls are repeated, the verifier may already have taken a presentation
+        # PUT or report POST answered 5xx, while connections that failed never reached it
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=retry_backoff, status_forcelist=list(RETRY_STATUSES),
+                      allowed_methods=frozenset({"GET", "HEAD"}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=len(self.backends), pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created on first use so it binds to the event loop of the serving worker
+        if self._client is None:
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                                  keepalive_expiry=keepalive)
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=limits,
+                transport=httpx.AsyncHTTPTransport(limits=limits, retries=retries))
+        return self._client
+
+    def route(self, key=None, exclude=None) -> Backend:
+        """ Instance for a call about key, the least busy live instance without a key """
+        backends = [backend for backend in self.backends if backend is not exclude]
+        if len(backends) == 1:
+            return backends[0]
+        if len(hosts) > 1:
+            health.watch()
+        if key:
+            backends.sort(key=lambda backend: rank(key, backend.host), reverse=True)
+        else:
+            backends.sort(key=lambda backend: backend.outstanding)
+        live = [backend for backend in backends if backend.live] or backends
+        # one over the average, so a few calls about an AID at a time stay on its instance
+        capacity = balance_factor * (sum(backend.outstanding for backend in self.backends) / len(self.backends) + 1)
+        for backend in live:
+            if backend.outstanding < capacity:
+                return backend
+        return live[0]
+
+    def failover(self, backend: Backend, key, method: str):
+        """ Instance to repeat a call that could not connect to backend on, or None """
+        if len(self.backends) == 1:
+            return None
+        backend.host.mark(False)
+        # a body may be a stream that is already consumed
+        if method != "GET":
+            return None
+        other = self.route(key, exclude=backend)
+        logger.warning("Endpoint.failover: %s %s from %s to %s", self.name, key, backend.host.key, other.host.key)
+        return other
+
+    def _admit(self, backend: Backend):
+        call_limit.acquire(self.name)
+        try:
+            backend.breaker.allow()
+        except Unavailable:
+            call_limit.release()
+            raise
+        with self.lock:
+            backend.outstanding += 1
+
+    def _done(self, backend: Backend, method, status, started):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            backend.outstanding -= 1
+        call_limit.release()
+        backend.breaker.record(status == "error" or status.startswith("5") or elapsed > backend.breaker.slow_call)
+        upstream_seconds.labels(self.name, method, status).observe(elapsed)
+
+    def _request(self, backend: Backend, method: str, path: str, headers=None, **kwargs) -> requests.Response:
+        self._admit(backend)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            with span("verifier", CLIENT, endpoint=self.name, method=method, host=backend.host.key) as traced:
+                response = self.session.request(method, f"{backend.url}{path}",
+                                                headers={**self.headers, **(headers or {}), **propagate()},
+                                                timeout=self.timeout, **kwargs)
+                status = str(response.status_code)
+                traced.set(status=response.status_code)
+            return response
+        finally:
+            self._done(backend, method, status, started)
+
+    def request(self, method: str, path: str, headers=None, key=None, **kwargs) -> requests.Response:
+        """ Call path on the instance of key, the AID the call is about, which is the first segment of path by default """
+        key = key or path.split("/")[0]
+        backend = self.route(key)
+        try:
+            return self._request(backend, method, path, headers, **kwargs)
+        except requests.ConnectionError:
+            other = self.failover(backend, key, method)
+            if other is None:
+                raise
+            return self._request(other, method, path, headers, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    async def _arequest(self, backend: Backend, method: str, path: str, headers=None, **kwargs) -> httpx.Response:
+        self._admit(backend)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            with span("verifier", CLIENT, endpoint=self.name, method=method, host=backend.host.key) as traced:
+                # httpx only retries connections, 5xx answers to idempotent calls are retried here as
+                # the blocking session's Retry does
+                attempt = 0
+                while True:
+                    response = await self.client.request(method, f"{backend.url}{path}",
+                                                         headers={**self.headers, **(headers or {}), **propagate()},
+                                                         **kwargs)
+                    if method not in ("GET", "HEAD") or response.status_code not in RETRY_STATUSES or attempt >= retries:
+                        break
+                    attempt += 1
+                    await asyncio.sleep(retry_backoff * 2 ** (attempt - 1))
+                status = str(response.status_code)
+                traced.set(status=response.status_code)
+            return response
+        finally:
+            self._done(backend, method, status, started)
+
+    async def arequest(self, method: str, path: str, headers=None, key=None, **kwargs) -> httpx.Response:
+        key = key or path.split("/")[0]
+        backend = self.route(key)
+        try:
+            return await self._arequest(backend, method, path, headers, **kwargs)
+        except httpx.ConnectError:
+            other = self.failover(backend, key, method)
+            if other is None:
+                raise
+            return await self._arequest(other, method, path, headers, **kwargs)
+
+    async def aget(self, path: str, **kwargs) -> httpx.Response:
+        return await self.arequest("GET", path, **kwargs)
+
+    async def aput(self, path: str, **kwargs) -> httpx.Response:
+        return await self.arequest("PUT", path, **kwargs)
+
+    async def apost(self, path: str, **kwargs) -> httpx.Response:
+        return await self.arequest("POST", path, **kwargs)
+
+auths = Endpoint("authorizations", auths_url)
+presentations = Endpoint("presentations", presentations_url)
+reports = Endpoint("reports", reports_url)
+requests_verify = Endpoint("requests", request_url)
+
+endpoints = (auths, presentations, reports, requests_verify)
+
+def degraded() -> list:
+    """ Why calls to the verifier are being turned away, empty when they are not """
+    reasons = [f"{backend.breaker.name} circuit {backend.breaker.state}" for endpoint in endpoints
+               for backend in endpoint.backends if backend.breaker.state != CircuitBreaker.CLOSED]
+    reasons.extend(f"verifier {host.key} down" for host in hosts.values() if not host.up)
+    if call_limit.saturated:
+        reasons.append("verifier calls at capacity")
+    return reasons
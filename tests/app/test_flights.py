@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.flights import RELEASE, SingleFlight
+
+RESULT = {"status_code": 200, "text": "ok", "headers": {}}
+
+def shared(server) -> SingleFlight:
+    """ A worker's flights sharing calls through the fake redis server """
+    import fakeredis
+    flights = SingleFlight(url="")
+    flights.redis = fakeredis.FakeRedis(server=server)
+    flights.script = flights.redis.register_script(RELEASE)
+    return flights
+
+def test_do_coalesces_concurrent_calls():
+    """ Concurrent callers with one key share a single call """
+    flights = SingleFlight(url="")
+    calls = []
+
+    def call():
+        calls.append(1)
+        time.sleep(0.2)
+        return RESULT
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do(("k",), call, 5))) for _ in range(5)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert results == [RESULT] * 5
+    assert len(calls) == 1
+    assert not flights.flights
+
+def test_do_failed_call_is_made_again():
+    """ The leader's exception is its own, the callers that joined it make the call themselves """
+    flights = SingleFlight(url="")
+    calls = []
+
+    def call():
+        calls.append(1)
+        time.sleep(0.1)
+        if len(calls) == 1:
+            raise RuntimeError("verifier down")
+        return RESULT
+
+    results, errors = [], []
+
+    def run():
+        try:
+            results.append(flights.do(("k",), call, 5))
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    [thread.join() for thread in threads]
+    assert len(errors) == 1
+    assert results == [RESULT, RESULT]
+
+def test_do_join_times_out():
+    """ A caller waiting longer than timeout for the call in flight gets None """
+    flights = SingleFlight(url="")
+    started = threading.Event()
+
+    def call():
+        started.set()
+        time.sleep(0.3)
+        return RESULT
+
+    leader = threading.Thread(target=flights.do, args=(("k",), call, 5))
+    leader.start()
+    started.wait()
+    assert flights.do(("k",), call, 0.05) is None
+    leader.join()
+
+def test_ado_coalesces_concurrent_calls():
+    """ Concurrent coroutines with one key share a single call """
+    flights = SingleFlight(url="")
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return RESULT
+
+    async def run():
+        return await asyncio.gather(*(flights.ado(("k",), call, 5) for _ in range(5)))
+
+    assert asyncio.run(run()) == [RESULT] * 5
+    assert len(calls) == 1
+    assert not flights.aflights
+
+def test_ado_shared_between_workers():
+    """ Workers sharing a redis make one call, the others read the result the claimant leaves """
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    first, second = shared(server), shared(server)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return RESULT
+
+    async def run():
+        return await asyncio.gather(first.ado(("k",), call, 5), second.ado(("k",), call, 5))
+
+    assert asyncio.run(run()) == [RESULT, RESULT]
+    assert len(calls) == 1
+    # the claim is dropped once the call is done
+    assert first.redis.get(f"{first.prefix}:k") is None
@@ -0,0 +1,69 @@
+import asyncio
+import io
+import json
+import os
+import zipfile
+
+from app.manifest import inspect
+from app.packages import PackageChecker
+
+AID = "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"
+DIG = "EJt3ljR1YGnQzV9WnGcLg4wHAi6k-hRjX0aK9O0ih6dY"
+
+def zipped(files: dict) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+def manifest(*files) -> str:
+    return json.dumps({"documentInfo": {"signatures": [{"file": f"../reports/{name}", "aid": AID, "sigs": ["sig"]}
+                                                       for name in files]}})
+
+VALID = zipped({"pkg/META-INF/reports.json": manifest("a.csv", "b.csv"),
+                "pkg/reports/a.csv": "a", "pkg/reports/b.csv": "b"})
+
+def test_inspect_valid_package():
+    """ A zip whose manifest signs every report passes """
+    assert inspect(VALID) is None
+
+def test_inspect_invalid_packages():
+    """ Packages the verifier would fail are named with the reason it would give """
+    assert inspect(os.urandom(1024)) == "Report is not a valid zip file"
+    assert inspect(zipped({"pkg/reports/a.csv": "a"})) == "No manifest file found in report package"
+    assert inspect(zipped({"pkg/META-INF/reports.json": "{"})) == "Manifest file is not valid JSON"
+    assert inspect(zipped({"pkg/META-INF/reports.json": "{}"})) == "No signatures found in manifest file"
+    missing = zipped({"pkg/META-INF/reports.json": manifest("a.csv", "c.csv"), "pkg/reports/a.csv": "a"})
+    assert inspect(missing) == "Signed file ../reports/c.csv not found in report package"
+    unsigned = zipped({"pkg/META-INF/reports.json": manifest("a.csv"),
+                       "pkg/reports/a.csv": "a", "pkg/reports/b.csv": "b"})
+    assert inspect(unsigned) == "2 files in report package but 1 signed in manifest file"
+
+def test_check_in_pool():
+    """ Packages are checked in the pool, a failed one is answered like the verifier answers it """
+    checker = PackageChecker(enabled=True, workers=1, pending=2, timeout=30)
+    try:
+        assert checker.check(AID, DIG, "application/zip", VALID) is None
+        result = checker.check(AID, DIG, "application/zip", b"not a zip")
+        assert result["status_code"] == 200
+        assert json.loads(result["text"]) == {"submitter": AID, "filename": DIG, "status": "failed",
+                                              "contentType": "application/zip", "size": 9,
+                                              "message": "Report is not a valid zip file"}
+        assert asyncio.run(checker.acheck(AID, DIG, "application/zip", b"not a zip"))["status_code"] == 200
+    finally:
+        checker.close()
+
+def test_check_skipped(monkeypatch):
+    """ A package that can not be checked is posted unchecked, never failed """
+    checker = PackageChecker(enabled=True, workers=1, pending=1, timeout=30)
+
+    def broken(data):
+        raise RuntimeError("no pool")
+
+    monkeypatch.setattr(checker, "_submit", broken)
+    assert checker.check(AID, DIG, "application/zip", b"not a zip") is None
+    assert asyncio.run(checker.acheck(AID, DIG, "application/zip", b"not a zip")) is None
+    monkeypatch.setattr(checker, "_submit", lambda data: None)
+    assert checker.check(AID, DIG, "application/zip", b"not a zip") is None
+    assert PackageChecker(enabled=False).check(AID, DIG, "application/zip", b"not a zip") is None
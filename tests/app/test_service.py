@@ -0,0 +1,82 @@
+import json
+
+import falcon
+import falcon.testing
+import pytest
+
+from app import aioservice, service
+from app.store import MemoryStore, StatusPages
+
+AID = "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"
+LOGGED_IN = {"status_code": 200, "text": json.dumps({"aid": AID}), "headers": {"Content-Type": falcon.MEDIA_JSON}}
+LOGIN = {"aid": AID, "said": "EK_said", "vlei": "{}"}
+
+@pytest.fixture(params=["wsgi", "asgi"])
+def app(request, monkeypatch):
+    """ A client of the WSGI or the ASGI app, with its store in memory and the verifier answering logged in """
+    store = MemoryStore(history=4, ttl=60)
+    pages = StatusPages(store, size=10)
+    for module in (service, aioservice):
+        monkeypatch.setattr(module, "store", store)
+        monkeypatch.setattr(module, "status_pages", pages)
+    monkeypatch.setattr(service.quotas, "take_login", lambda addr: None)
+    if request.param == "wsgi":
+        monkeypatch.setattr(service, "check_login", lambda aid: LOGGED_IN)
+        monkeypatch.setattr(service, "verify_vlei", lambda aid, said, vlei: LOGGED_IN)
+        monkeypatch.setattr(service.verSig, "verify", lambda req: LOGGED_IN)
+        client = falcon.testing.TestClient(service.falcon_app())
+    else:
+        async def answer(*args):
+            return LOGGED_IN
+
+        monkeypatch.setattr(aioservice, "check_login", answer)
+        monkeypatch.setattr(aioservice, "verify_vlei", answer)
+        monkeypatch.setattr(aioservice.verSig, "verify", answer)
+        client = falcon.testing.TestClient(aioservice.falcon_app())
+    client.store = store
+    client.module = service if request.param == "wsgi" else aioservice
+    return client
+
+def test_login_logs_in(app):
+    """ A verified presentation logs the AID in to the status store """
+    result = app.simulate_post("/login", json=LOGIN)
+    assert result.status_code == 200
+    assert app.store.logged_in(AID)
+
+def test_checklogin_logs_in(app):
+    """ A login verified elsewhere, by a celery worker, is seen by checklogin """
+    result = app.simulate_get(f"/checklogin/{AID}")
+    assert result.status_code == 200
+    assert app.store.logged_in(AID)
+
+def test_async_login_queued(app, monkeypatch):
+    """ With ASYNC_LOGINS both apps queue the presentation and answer 202 with its job """
+    entry = {"job": "job-1", "status": "pending"}
+    monkeypatch.setattr(app.module, "async_logins", True)
+    monkeypatch.setattr(app.module, "enqueue_login", lambda aid, said, vlei: entry)
+    result = app.simulate_post("/login", json=LOGIN)
+    assert result.status_code == 202
+    assert result.json == entry
+    assert not app.store.logged_in(AID)
+
+def test_status_etag_and_cursor(app):
+    """ A status page carries its ETag and next cursor, and is answered 304 while the client has it """
+    assert app.simulate_get(f"/status/{AID}").status_code == 401
+    app.store.login(AID)
+    for dig in ("a", "b", "c"):
+        app.store.add(AID, dig, {"status": "pending"})
+    result = app.simulate_get(f"/status/{AID}", params={"limit": 2})
+    assert result.status_code == 200
+    assert [entry["dig"] for entry in result.json[AID]] == ["a", "b"]
+    cursor = result.headers["X-Next-Cursor"]
+    assert result.headers["X-Status-Seq"] == str(app.store.version(AID))
+    etag = result.headers["ETag"]
+    result = app.simulate_get(f"/status/{AID}", params={"limit": 2}, headers={"If-None-Match": etag})
+    assert result.status_code == 304
+    result = app.simulate_get(f"/status/{AID}", params={"limit": 2, "cursor": cursor}, headers={"If-None-Match": etag})
+    assert result.status_code == 200
+    assert [entry["dig"] for entry in result.json[AID]] == ["c"]
+    assert "X-Next-Cursor" not in result.headers
+    app.store.update(AID, "a", {"status": "verified"})
+    result = app.simulate_get(f"/status/{AID}", params={"limit": 2}, headers={"If-None-Match": etag})
+    assert result.status_code == 200 and result.headers["ETag"] != etag
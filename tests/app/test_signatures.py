@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from app.signatures import SignatureCache
+
+AID = "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"
+OK = {"status_code": 200, "text": "{}", "headers": {}}
+
+def inputage(created=None, expires=None, nonce=None, keyid="BPmhSfdhCPxr3EqjxzEtF8TVy0YX7ATo0Uc8oo2cnmY9"):
+    return SimpleNamespace(created=time.time() if created is None else created, expires=expires,
+                           nonce=nonce, keyid=keyid)
+
+def description(result) -> str:
+    return json.loads(result["text"])["description"]
+
+def test_screen_window():
+    """ Signatures created outside the window or past their expiry are rejected """
+    cache = SignatureCache(window=300, size=100)
+    assert cache.screen(AID, inputage(), "cig-fresh") is None
+    rejected = cache.screen(AID, inputage(created=time.time() - 301), "cig-stale")
+    assert rejected["status_code"] == 401
+    assert "outside the 300s window" in description(rejected)
+    rejected = cache.screen(AID, inputage(expires=time.time() - 1), "cig-expired")
+    assert "expired" in description(rejected)
+
+def test_screen_rejects_replay():
+    """ A signature is rejected the second time it is screened, before anything is looked up """
+    cache = SignatureCache(window=300, size=100)
+    signed = inputage()
+    assert cache.screen(AID, signed, "cig") is None
+    rejected = cache.screen(AID, signed, "cig")
+    assert rejected["status_code"] == 401
+    assert description(rejected) == "Signature was already used"
+    # the same signature from another AID is a different claim
+    assert cache.screen("EOther", signed, "cig") is None
+
+def test_screen_replay_race():
+    """ Only one of several concurrent requests with the same signature gets through """
+    cache = SignatureCache(window=300, size=100)
+    signed = inputage()
+    results = []
+    barrier = threading.Barrier(8)
+
+    def screen():
+        barrier.wait()
+        results.append(cache.screen(AID, signed, "cig"))
+
+    threads = [threading.Thread(target=screen) for _ in range(8)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert results.count(None) == 1
+
+def test_screen_nonce():
+    """ A nonce is accepted once per AID, after its signature verified """
+    cache = SignatureCache(window=300, size=100)
+    first = inputage(nonce="n1")
+    assert cache.screen(AID, first, "cig-1") is None
+    cache.remember(AID, first, "cig-1", "ser", OK)
+    rejected = cache.screen(AID, inputage(nonce="n1"), "cig-2")
+    assert "nonce n1" in description(rejected)
+
+def test_cache_without_replay_rejection():
+    """ With replay rejection off a repeated signature is answered from the cache """
+    cache = SignatureCache(window=300, size=100, reject_replay=False)
+    signed = inputage()
+    assert cache.screen(AID, signed, "cig") is None
+    assert cache.lookup(AID, signed, "cig", "ser") is None
+    cache.remember(AID, signed, "cig", "ser", OK)
+    assert cache.screen(AID, signed, "cig") is None
+    assert cache.lookup(AID, signed, "cig", "ser") == OK
+    # a verification is only cached for the rest of its window
+    old = inputage(created=time.time() - 300)
+    cache.remember(AID, old, "cig-old", "ser", OK)
+    assert cache.lookup(AID, old, "cig-old", "ser") is None
@@ -0,0 +1,85 @@
+import asyncio
+import io
+import json
+
+from keri.core import coring
+
+from app.spool import ReportSpool, aspool, spool
+
+REPORT = b"PK" + bytes(range(256)) * 64
+
+def dig(data: bytes, code=coring.DigDex.Blake3_256) -> str:
+    return coring.Diger(ser=data, code=code).qb64
+
+def form(data: bytes, boundary="b0undary") -> tuple:
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="upload"; filename="report.zip"\r\n'
+            f'Content-Type: application/zip\r\n\r\n').encode("utf-8") + data + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def description(result) -> str:
+    return json.loads(result["text"])["description"]
+
+def test_spool_matching_digest():
+    """ A report matching its digest is accepted and read back whole, in memory or from disk """
+    for threshold in (1 << 20, 1024):
+        report = ReportSpool(dig(REPORT), "application/zip", threshold=threshold)
+        with report:
+            for i in range(0, len(REPORT), 1000):
+                assert report.write(REPORT[i:i + 1000])
+            assert report.check() is None
+            assert report.size == len(REPORT)
+            assert report.read() == REPORT
+            assert b"".join(report.chunks()) == REPORT
+
+def test_spool_digest_mismatch():
+    """ A report that does not match the digest in the path is answered 400 """
+    report, rejected = spool(io.BytesIO(REPORT + b"x"), dig(REPORT), "application/zip")
+    with report:
+        assert rejected["status_code"] == 400
+        assert description(rejected) == f"Report does not match digest {dig(REPORT)}"
+
+def test_spool_digest_codes():
+    """ Digests are checked with the hash their code names """
+    for code in (coring.DigDex.Blake2b_256, coring.DigDex.SHA3_256, coring.DigDex.SHA2_256):
+        report, rejected = spool(io.BytesIO(REPORT), dig(REPORT, code), "application/zip")
+        with report:
+            assert rejected is None
+        report, rejected = spool(io.BytesIO(REPORT[1:]), dig(REPORT, code), "application/zip")
+        with report:
+            assert rejected["status_code"] == 400
+
+def test_spool_multipart_digest():
+    """ The digest of a multipart form is the one of its upload part """
+    body, contype = form(REPORT)
+    report, rejected = spool(io.BytesIO(body), dig(REPORT), contype, len(body))
+    with report:
+        assert rejected is None
+        assert report.upload_part().stream.read() == REPORT
+    report, rejected = spool(io.BytesIO(body), dig(body), contype, len(body))
+    with report:
+        assert rejected["status_code"] == 400
+
+def test_spool_too_large():
+    """ A body over max_size is answered 413, from its Content-Length or once it grows past it """
+    report, rejected = spool(io.BytesIO(REPORT), dig(REPORT), "application/zip", length=1 << 40)
+    with report:
+        assert rejected["status_code"] == 413
+    report = ReportSpool(dig(REPORT), "application/zip", max_size=100)
+    with report:
+        assert not report.write(REPORT)
+        assert report.check()["status_code"] == 413
+
+def test_aspool_digest_mismatch():
+    """ The ASGI spool checks the digest like the blocking one """
+
+    async def stream(data):
+        for i in range(0, len(data), 1000):
+            yield data[i:i + 1000]
+
+    async def run(data):
+        report, rejected = await aspool(stream(data), dig(REPORT), "application/zip")
+        report.close()
+        return rejected
+
+    assert asyncio.run(run(REPORT)) is None
+    assert asyncio.run(run(REPORT[:-1]))["status_code"] == 400
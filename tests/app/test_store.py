@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from app.store import LmdbStore, MemoryStore, RedisStore, StatusPages
+
+AID = "EBcIURLpxmVwahksgrsGW6_dUw0zBhyEHYFk17eWrZfk"
+
+@pytest.fixture(params=["memory", "lmdb", "redis"])
+def store(request, tmp_path, monkeypatch):
+    """ Each store backend keeping at most 4 entries per AID """
+    if request.param == "memory":
+        return MemoryStore(history=4, ttl=60)
+    if request.param == "lmdb":
+        pytest.importorskip("lmdb")
+        return LmdbStore(path=str(tmp_path / "status"), history=4, ttl=60, map_size=1 << 20)
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    import redis
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url: fakeredis.FakeRedis())
+    return RedisStore(url="redis://fake", history=4, ttl=60)
+
+def digs(entries) -> list:
+    return [entry["dig"] for entry in entries]
+
+def test_add_update_find(store):
+    """ Entries keep their order, update replaces the latest entry of a digest and bumps the version """
+    assert store.version(AID) is None
+    store.login(AID)
+    assert store.logged_in(AID)
+    store.add(AID, "d1", {"status": "pending"})
+    store.add(AID, "d2", {"status": "pending"})
+    version = store.version(AID)
+    store.update(AID, "d1", {"status": "verified"})
+    assert store.version(AID) > version
+    assert digs(store.entries(AID)) == ["d1", "d2"]
+    assert store.find(AID, "d1")["status"] == "verified"
+    assert store.find(AID, "missing") is None
+
+def test_history_cap(store):
+    """ Only the latest history entries are kept, and trimmed digests are no longer found """
+    store.login(AID)
+    for i in range(6):
+        store.add(AID, f"d{i}", {"status": "verified"})
+    assert digs(store.entries(AID)) == ["d2", "d3", "d4", "d5"]
+    assert store.find(AID, "d0") is None
+
+def test_page_cursor_is_seq(store):
+    """ Pages follow the order entries changed, and entries changed between pages do not shift them """
+    store.login(AID)
+    for dig in ("a", "b", "c"):
+        store.add(AID, dig, {"status": "pending"})
+    entries, cursor = store.page(AID, 0, 2)
+    assert digs(entries) == ["a", "b"]
+    assert cursor == entries[-1]["seq"]
+    # a is updated and d added, which trims nothing yet and moves a after c
+    store.update(AID, "a", {"status": "verified"})
+    store.add(AID, "d", {"status": "pending"})
+    entries, cursor = store.page(AID, cursor, 2)
+    assert digs(entries) == ["c", "a"]
+    entries, cursor = store.page(AID, cursor, 2)
+    assert digs(entries) == ["d"]
+    assert cursor is None
+
+def test_page_since(store):
+    """ since pages only the entries added or updated after that seq """
+    store.login(AID)
+    store.add(AID, "a", {"status": "pending"})
+    seq = store.version(AID)
+    assert store.page(AID, since=seq) == ([], None)
+    store.add(AID, "b", {"status": "pending"})
+    entries, cursor = store.page(AID, since=seq)
+    assert digs(entries) == ["b"] and cursor is None
+
+def test_status_pages_etag():
+    """ A page's ETag changes with the version and the page, and pages are kept until the version changes """
+    store = MemoryStore(history=10, ttl=60)
+    pages = StatusPages(store, size=10)
+    store.login(AID)
+    store.add(AID, "a", {"status": "pending"})
+    version = store.version(AID)
+    assert pages.etag(AID, version) == pages.etag(AID, version)
+    assert pages.etag(AID, version) != pages.etag(AID, version, limit=1)
+    body, after = pages.page(AID, version)
+    assert digs(json.loads(body)[AID]) == ["a"] and after is None
+    store.add(AID, "b", {"status": "pending"})
+    # the page of the old version is served from memory, a new version reads the entries again
+    assert pages.page(AID, version) == (body, None)
+    assert pages.etag(AID, store.version(AID)) != pages.etag(AID, version)
+    body, after = pages.page(AID, store.version(AID), limit=1)
+    assert digs(json.loads(body)[AID]) == ["a"]
+    assert after == store.find(AID, "a")["seq"]
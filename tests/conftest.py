@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app modules import each other as app, from the directory holding the app package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "regps"))